@@ -1,13 +1,4 @@
-from datetime import datetime
+from actions.utils.lazy import WARM_UP, start_warm_up
 
-import dateparser
-
-ddp = dateparser.DateDataParser(
-    languages=["de"],
-    settings={
-        "PREFER_DATES_FROM": "past",
-        "PREFER_DAY_OF_MONTH": "first",
-        "DATE_ORDER": "DMY",
-        "RELATIVE_BASE": datetime.now(),
-    },
-)
+if WARM_UP:
+    start_warm_up()
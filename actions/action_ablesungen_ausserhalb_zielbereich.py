@@ -1,28 +1,30 @@
-import pathlib
-from datetime import datetime
 from typing import Text
 
-import matplotlib.pyplot as plt
-import pandas as pd
-import seaborn as sns
+import numpy as np
 from rasa_sdk import Action
 
-from actions import ddp
-from actions.utils.db_utils import DBHandler
+from actions.utils import plots
+from actions.utils.dates import resolve_date
+from actions.utils.daytimes import Daytimes
+from actions.utils.plots import PlotSpec
 from actions.utils.utils import (
     get_blood_pressure_spans,
-    get_time_of_day,
+    get_bloodpressure_since,
+    get_bloodpressure_within,
+    get_times_of_day,
     zeitspanne_to_timespan,
     mehrzahl_zeitspanne,
-    recorded_at_to_datetime,
 )
 
+# the evening of the outliers starts in the afternoon already
+OUTLIER_DAYTIMES = Daytimes({"Morgen": (6, 12), "Abend": (16, 24)}, other="Andere")
+
 
 class ActionAblesungenAusserhalbZielbereich(Action):
     def name(self) -> Text:
         return "action_ablesungen_ausserhalb_zielbereich"
 
-    def run(self, dispatcher, tracker, domain):
+    async def run(self, dispatcher, tracker, domain):
         user_id = tracker.get_slot("user_id")
         zeitspanne = tracker.get_slot("timespan") or "Monat"
         zeitspanne_entity = next(tracker.get_latest_entity_values("timespan"), None)
@@ -30,35 +32,37 @@ class ActionAblesungenAusserhalbZielbereich(Action):
         direction = tracker.get_slot("direction") or "über"
         typ = tracker.get_slot("type") or None
         limit = tracker.get_slot("limit") or None
-        change_date_parsed = (
-            ddp.get_date_data(change_date_input).date_obj if change_date_input else None
-        )
+        change_date_parsed = resolve_date(change_date_input)
 
         if zeitspanne_entity:
-            date_filter = f"AND CAST(recorded_at AS timestamp) >= NOW() - INTERVAL '3 {zeitspanne_to_timespan[zeitspanne_entity]}'"
+            results = get_bloodpressure_within(
+                user_id, f"3 {zeitspanne_to_timespan[zeitspanne_entity]}"
+            )
         elif change_date_parsed:
-            date_filter = f"AND CAST(recorded_at AS timestamp) >= '{change_date_parsed.strftime('%Y-%m-%d')}'"
+            results = get_bloodpressure_since(user_id, change_date_parsed.date())
         else:
-            date_filter = f"AND CAST(recorded_at AS timestamp) >= NOW() - INTERVAL '3 {zeitspanne_to_timespan[zeitspanne]}'"
-        query = f"""
-                SELECT
-                    systolic,
-                    diastolic,
-                    pulse,
-                    recorded_at
-                FROM 
-                    bloodpressure
-                WHERE 
-                    user_id = {user_id}
-                    {date_filter}
-            """
-        results = DBHandler().execute_query(query)
+            results = get_bloodpressure_within(
+                user_id, f"3 {zeitspanne_to_timespan[zeitspanne]}"
+            )
         if not results:
             dispatcher.utter_message("Keine Daten gefunden.")
             return []
-        results = recorded_at_to_datetime(results)
+        hours = results.hours
         count_bp_measurements = len(results)
         systolic_span, diastolic_span, _ = get_blood_pressure_spans(tracker, user_id)
+        # the scatter plot shows the target corridor, not the asked limit, and
+        # renders while the messages go out
+        figure = plots.submit(
+            PlotSpec(
+                "daytime_scatter",
+                {
+                    "Systolic": results.systolic,
+                    "Diastolic": results.diastolic,
+                    "Tageszeit": get_times_of_day(hours),
+                },
+                {"systolic_span": systolic_span, "diastolic_span": diastolic_span},
+            )
+        )
         if limit:
             limit = int(limit)
         if typ == "systolisch" and limit:
@@ -66,16 +70,17 @@ class ActionAblesungenAusserhalbZielbereich(Action):
         elif typ == "diastolisch" and limit:
             diastolic_span = (limit, limit)
 
-        def message_bp_measurements(results, typ, span):
-            of_range_bp_measurements = [
-                (value, recorded_at)
-                for value, recorded_at in results
-                if (value > span[1] and direction == "über")
-                or (value < span[0] and direction == "unter")
-            ]
-            if not of_range_bp_measurements:
+        def message_bp_measurements(values, typ, span):
+            if direction == "über":
+                of_range = values > span[1]
+            elif direction == "unter":
+                of_range = values < span[0]
+            else:
                 return
-            of_range_quote = round(len(of_range_bp_measurements) / len(results) * 100)
+            of_range_hours = hours[of_range]
+            if not len(of_range_hours):
+                return
+            of_range_quote = round(len(of_range_hours) / len(values) * 100)
             dispatcher.utter_message(
                 text=(
                     f"Von den {count_bp_measurements} Blutdruckmessungen "
@@ -85,7 +90,7 @@ class ActionAblesungenAusserhalbZielbereich(Action):
                         else ("seit dem " + change_date_parsed.strftime("%d.%m.%Y"))
                     )
                     + " liegen "
-                    + str(len(of_range_bp_measurements))
+                    + str(len(of_range_hours))
                     + f" ({of_range_quote}%) der {typ} Blutdruckmessungen "
                     + str(direction)
                     + " "
@@ -94,22 +99,12 @@ class ActionAblesungenAusserhalbZielbereich(Action):
                 )
             )
 
-            morning_bp_measurements = [
-                (value, recorded_at)
-                for value, recorded_at in of_range_bp_measurements
-                if 6 <= recorded_at.hour < 12
-            ]
-            evening_bp_measurements = [
-                (value, recorded_at)
-                for value, recorded_at in of_range_bp_measurements
-                if 16 <= recorded_at.hour < 24
-            ]
-            quote_morning = round(
-                len(morning_bp_measurements) / len(of_range_bp_measurements) * 100
-            )
-            quote_evening = round(
-                len(evening_bp_measurements) / len(of_range_bp_measurements) * 100
+            count_morning, count_evening, _ = np.bincount(
+                OUTLIER_DAYTIMES.codes(of_range_hours),
+                minlength=len(OUTLIER_DAYTIMES.labels),
             )
+            quote_morning = round(count_morning / len(of_range_hours) * 100)
+            quote_evening = round(count_evening / len(of_range_hours) * 100)
             if 60 <= quote_morning < 98:
                 dispatcher.utter_message(
                     f"{quote_morning}% dieser Ausreißer wurden am Morgen aufgenommen."
@@ -133,73 +128,19 @@ class ActionAblesungenAusserhalbZielbereich(Action):
 
         if typ == "systolisch" or typ not in ["diastolisch", "systolisch"]:
             message_bp_measurements(
-                [
-                    (systolic, recorded_at)
-                    for systolic, diastolic, pulse, recorded_at in results
-                ],
+                results.systolic,
                 "systolisch",
                 systolic_span,
             )
         if typ == "diastolisch" or typ not in ["diastolisch", "systolisch"]:
             message_bp_measurements(
-                [
-                    (diastolic, recorded_at)
-                    for systolic, diastolic, pulse, recorded_at in results
-                ],
+                results.diastolic,
                 "diastolisch",
                 diastolic_span,
             )
 
-        data = {
-            "Systolic": [
-                systolic for systolic, diastolic, pulse, recorded_at in results
-            ],
-            "Diastolic": [
-                diastolic for systolic, diastolic, pulse, recorded_at in results
-            ],
-            "Tageszeit": [
-                get_time_of_day(recorded_at)
-                for systolic, diastolic, pulse, recorded_at in results
-            ],
-        }
-
-        df = pd.DataFrame(data)
-
-        # Create scatter plot using seaborn
-        joint_plot = sns.jointplot(
-            data=df,
-            x="Systolic",
-            y="Diastolic",
-            hue="Tageszeit",
-            palette="rocket",
-            alpha=0.6,  # Adjust transparency for better visibility
-            marginal_kws=dict(
-                common_norm=False
-            ),  # Ensure KDE plots are not normalized together
-        )
-
-        # Set the titles and labels
-        joint_plot.set_axis_labels(
-            "Systolisch (mmHg)\nBlutdruckmessungen gruppiert nach Tageszeit",
-            "Diastolisch (mmHg)",
-        )
-
-        # Adding blood pressure spans to the joint plot
-        systolic_span, diastolic_span, _ = get_blood_pressure_spans(tracker, user_id)
-        joint_plot.ax_joint.axvspan(
-            systolic_span[0], systolic_span[1], color="green", alpha=0.1
-        )
-        joint_plot.ax_joint.axhspan(
-            diastolic_span[0], diastolic_span[1], color="green", alpha=0.1
-        )
-
-        # plt to image and send
-        file_path = str(
-            pathlib.Path().parent.absolute()
-            / ("tmp_scatter_plot_" + str(datetime.now()) + ".png")
-        )
-        plt.savefig(file_path)
-        dispatcher.utter_message(image=str(file_path))
+        (image,) = await plots.images(figure)
+        dispatcher.utter_message(image=image)
         dispatcher.utter_message(
             buttons=[
                 {
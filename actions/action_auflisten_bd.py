@@ -1,11 +1,10 @@
-from datetime import datetime
 from typing import Any, Text, Dict, List
 
 from rasa_sdk import Action, Tracker
 from rasa_sdk.executor import CollectingDispatcher
 
-from actions.utils.db_utils import DBHandler
 from actions.utils.utils import (
+    get_bloodpressure_within,
     get_bp_range,
     get_patient_details,
     zeitspanne_to_timespan,
@@ -14,10 +13,6 @@ from actions.utils.utils import (
 
 
 class ActionAuflistenBd(Action):
-    def __init__(self):
-        self.dbhandler = DBHandler()
-        super().__init__()
-
     def name(self) -> Text:
         return "action_auflisten_bd"
 
@@ -41,42 +36,14 @@ class ActionAuflistenBd(Action):
             dispatcher.utter_message("Bitte geben Sie eine Benutzer-ID an.")
             return []
 
-        patient_details = get_patient_details(user_id, tracker)
+        patient_details = get_patient_details(user_id, tracker=tracker)
         systolic_range, diastolic_range = get_bp_range(
             patient_details["birthday"], bool(patient_details["medical_preconditions"])
         )
-        date_filter = (
-            f"AND CAST(recorded_at AS timestamp) >= NOW() - INTERVAL '3 {timespan}'"
-        )
         date_range_message = at_the_last_prefix.get(zeitspanne)
         date_range_message = date_range_message[0].lower() + date_range_message[1:]
 
-        query = f"""
-                SELECT
-                    systolic,
-                    diastolic,
-                    pulse,
-                    recorded_at
-                FROM 
-                    bloodpressure
-                WHERE 
-                    user_id = {user_id}
-                    {date_filter}
-                ORDER BY recorded_at DESC
-                LIMIT 30
-            """
-
-        results = self.dbhandler.execute_query(query)
-        # map recorded at to date time
-        results = [
-            (
-                systolic,
-                diastolic,
-                pulse,
-                datetime.strptime(recorded_at, "%Y-%m-%d %H:%M:%S.%f"),
-            )
-            for systolic, diastolic, pulse, recorded_at in results
-        ]
+        results = get_bloodpressure_within(user_id, f"3 {timespan}")[-30:]
         if not results:
             dispatcher.utter_message(
                 "Keine Blutdruckaufzeichnungen für den angegebenen Zeitraum gefunden."
@@ -84,18 +51,16 @@ class ActionAuflistenBd(Action):
             return []
         print(results)
 
-        systolic_values = [result[0] for result in results]
-        diastolic_values = [result[1] for result in results]
         if typ == "systolisch":
-            values = systolic_values
+            values = results.systolic
             range_values = systolic_range
         else:
-            values = diastolic_values
+            values = results.diastolic
             range_values = diastolic_range
 
-        # Output a list of all values with the date
+        # Output a list of all values with the date, latest first
         message = f"Die {typ}en Blutdruckwerte {date_range_message} sind: \n"
-        for i, value in enumerate(values):
-            message += f"- {value} mmHg am {results[i][3].strftime('%d.%m.%Y %H:%M')}\n"
+        for value, recorded_at in zip(values[::-1], results.datetimes()[::-1]):
+            message += f"- {value} mmHg am {recorded_at.strftime('%d.%m.%Y %H:%M')}\n"
         dispatcher.utter_message(message)
         return []
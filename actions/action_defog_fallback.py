@@ -1,17 +1,28 @@
+import asyncio
 from typing import Any, Text, Dict, List
 
-from openai import OpenAI
 from rasa_sdk import Action, Tracker
 from rasa_sdk.executor import CollectingDispatcher
 
+from actions.utils.assistants import assistants, client, threads
 from actions.utils.defog_utils import DefogHandler
-from actions.utils.utils import get_bp_range, get_patient_details
+from actions.utils.lazy import lazy_object
+from actions.utils.utils import get_bp_range, get_patient_details_async
+
+ANSWER_INSTRUCTIONS = (
+    "You will be provided with data to answer the question of the user "
+    "from the database potentially containing blood pressure and geo location data."
+    "Do not use any external sources, only the data provided."
+    "Do not mirror the user input or patient details, but provide a "
+    "professional and short medical answer addressed to the doctor of the patient."
+)
 
 
 class ActionDefogFallback(Action):
     def __init__(self):
-        self.defog = DefogHandler()
-        self.client = OpenAI()
+        # built on the first question, not when the action server starts
+        self.defog = lazy_object(DefogHandler, "defog handler")
+        self.client = client
 
         super().__init__()
 
@@ -29,56 +40,85 @@ class ActionDefogFallback(Action):
         if user_id is None or user_id == "-1":
             dispatcher.utter_message("Please provide a user id.")
             return []
-        patient_details = get_patient_details(user_id, force_reload=False)
+        patient_details = await get_patient_details_async(user_id, force_reload=False)
         systolic_range, diastolic_range = get_bp_range(
             patient_details["birthday"],
             (patient_details["medical_preconditions"] not in ["", None]),
         )
         background_info_string_for_llm = f"Patient Information: {str(patient_details)}, BP Target Range: {systolic_range}/{diastolic_range}"
 
-        defog_result = self.defog.ask_query(
-            user_input, user_id, background_info_string_for_llm
+        # Defog and the query block, they run in the default executor so the
+        # event loop keeps serving other conversations meanwhile
+        loop = asyncio.get_running_loop()
+        defog_result = await loop.run_in_executor(
+            None,
+            lambda: self.defog.ask_query(
+                user_input, user_id, background_info_string_for_llm
+            ),
         )
+        if defog_result["query_generated"]:
+            dispatcher.utter_message("SQL Query: " + defog_result["query_generated"])
+        if not defog_result["ran_successfully"]:
+            print(f"Defog query failed: {defog_result['error_message']}")
+            dispatcher.utter_message(
+                "Die Frage konnte nicht aus der Datenbank beantwortet werden: "
+                + defog_result["error_message"]
+            )
+            return []
         columns = defog_result["columns"]
         data = defog_result["data"]
-        dispatcher.utter_message("SQL Query: " + defog_result["query_generated"])
         pretty_data = (
             "\t".join([header for header in columns])
             + "\n"
             + "\n".join(["\t".join([str(cell) for cell in row]) for row in data])
         )
+        if defog_result["truncated"]:
+            pretty_data += f"\n(Nur die ersten {len(data)} Zeilen.)"
         dispatcher.utter_message("Query Result:\n" + pretty_data)
-        thread = self.client.beta.threads.create()
-        instructions = (
+        # the OpenAI round trips block as well
+        answers = await loop.run_in_executor(
+            None,
+            self._interpret,
+            tracker.sender_id,
             f"You are trying to answer the following question: '{user_input}'\n"
-            f"You will be provided with data to answer the question."
             f"About the following user {patient_details} (filter only by its id)."
-            f"'You will be provided with data to answer the question from the database "
-            f"potentially containing blood pressure and geo location data."
-            f"Do not use any external sources, only the data provided."
-            f"Do not mirror the user input or patient details, but provide a "
-            f"professional and short medical answer addressed to the doctor of the patient."
-        )
-        assistant = self.client.beta.assistants.create(
-            model="gpt-4o",
-            instructions=instructions,
-        )
-        self.client.beta.threads.messages.create(
-            thread_id=thread.id,
-            role="user",
-            content="'\nThe result of the SQL query was:\n"
+            + "'\nThe result of the SQL query was:\n"
             + pretty_data
             + "\nPlease provide a professional medical answer to the provided question "
             "earlier based only on the provided data."
             "KEEP SHORT AND PROFESSIONAL OTHERWISE I'LL GET FIRED. DO NOT MAKE UP ANY UNKNOWN INFORMATION AND MAKE THE ANSWER SHORT AND INTERPRETABLE"
             "Answer in German to me as a healthcare professional in my language.",
         )
-        self.client.beta.threads.runs.create_and_poll(
-            thread_id=thread.id, assistant_id=assistant.id
-        )
-        messages = self.client.beta.threads.messages.list(thread_id=thread.id)
-        for message in messages:
-            if message.role != "user":
-                dispatcher.utter_message(message.content[0].text.value)
+        for answer in answers:
+            dispatcher.utter_message(answer)
 
         return []
+
+    def _interpret(self, conversation_id, content) -> List[str]:
+        """
+        Asks the assistant on the thread of the conversation, blocking until the
+        run is done, and returns its answers.
+        """
+        # the same assistant for all questions, the question and the patient go
+        # into the message on the thread of the conversation
+        assistant = assistants.get(
+            name="Defog Result Interpreter",
+            model="gpt-4o",
+            instructions=ANSWER_INSTRUCTIONS,
+            api=self.client,
+        )
+        with threads.question(
+            conversation_id, assistant, content, api=self.client
+        ) as thread:
+            run = self.client.beta.threads.runs.create_and_poll(
+                thread_id=thread.id, assistant_id=assistant.id
+            )
+            # only the answer of this run, the thread may hold earlier ones
+            messages = self.client.beta.threads.messages.list(
+                thread_id=thread.id, run_id=run.id, order="asc"
+            )
+        return [
+            message.content[0].text.value
+            for message in messages
+            if message.role != "user"
+        ]
@@ -1,144 +1,102 @@
-import pathlib
 from datetime import datetime
 from typing import Text
 
-import matplotlib.pyplot as plt
-import matplotlib.transforms as transforms
-import pandas as pd
-import seaborn as sns
 from rasa_sdk import Action
 
-from actions import ddp
-from actions.utils import utils
-from actions.utils.db_utils import DBHandler
+from actions.utils import plots, utils
+from actions.utils.dates import resolve_date
+from actions.utils.lazy import lazy_import
+from actions.utils.outliers import iqr_outliers
+from actions.utils.plots import PlotSpec
 from actions.utils.utils import zeitspanne_to_timespan, at_the_last_prefix
 
+pd = lazy_import("pandas")
+
 
 class ActionDetailsAusreisser(Action):
     def name(self) -> Text:
         return "action_details_ausreisser"
 
-    def run(self, dispatcher, tracker, domain):
+    async def run(self, dispatcher, tracker, domain):
         user_id = tracker.get_slot("user_id") or 25601
         typ = tracker.get_slot("type") or None
         zeitspanne = next(tracker.get_latest_entity_values("timespan"), None)
         change_date_input = tracker.get_slot("change_date") or None
-        if change_date_input:
-            change_date_parsed = ddp.get_date_data(change_date_input).date_obj
-        else:
-            change_date_parsed = None
+        change_date_parsed = resolve_date(change_date_input)
         since_date = bool(change_date_parsed)
         systolic_span, diastolic_span, _ = utils.get_blood_pressure_spans(
             tracker, user_id
         )
 
+        # the analysed window and the readings before the change date are both
+        # slices of the cached series of the patient
+        series = utils.get_bloodpressure_series(user_id)
         if zeitspanne:
             timespan = zeitspanne_to_timespan.get(zeitspanne)
-            date_filter = (
-                f"AND CAST(recorded_at AS timestamp) >= NOW() - INTERVAL '3 {timespan}'"
-            )
+            resulti = series.since(utils.interval_start(f"3 {timespan}"))
         else:
             zeitspanne = tracker.get_slot("timespan") or "Monat"
             timespan = zeitspanne_to_timespan.get(zeitspanne)
             if since_date:
                 since_date = True
-                date_filter = f"AND CAST(recorded_at AS timestamp) >= '{change_date_parsed.strftime('%Y-%m-%d')}'"
+                resulti = series.since(change_date_parsed.date())
             else:
-                date_filter = f"AND CAST(recorded_at AS timestamp) >= NOW() - INTERVAL '3 {timespan}'"
-
-        query = f"""
-                SELECT
-                    systolic,
-                    diastolic,
-                    pulse,
-                    recorded_at
-                FROM 
-                    bloodpressure
-                WHERE 
-                    user_id = {user_id}
-                    {date_filter}
-                ORDER BY recorded_at ASC
-            """
-        resulti = DBHandler().execute_query(query)
+                resulti = series.since(utils.interval_start(f"3 {timespan}"))
         if not resulti:
             dispatcher.utter_message("Keine Daten gefunden.")
             return []
 
-        df = df_from_result(utils.recorded_at_to_datetime(resulti))
+        df = df_from_series(resulti)
 
-        # Function to detect outliers
-        def detect_outliers(series):
-            q1 = series.quantile(0.25)
-            q3 = series.quantile(0.75)
-            iqr = q3 - q1
-            lower_bound = q1 - 0.5 * iqr
-            upper_bound = q3 + 0.5 * iqr
-            return (series < lower_bound) | (series > upper_bound)
+        # outliers of the window and, for the comparison, of the readings before
+        # the change date, in one pass
+        windows = [slice(len(series) - len(resulti), None)]
+        if since_date:
+            before = series.before(change_date_parsed.date(), inclusive=True)
+            windows.append(slice(0, len(before)))
+        sys_outliers = iqr_outliers(series.systolic, windows)
+        dia_outliers = iqr_outliers(series.diastolic, windows)
 
         # Add outlier columns
-        df["Systolische Ausreißer"] = detect_outliers(df["Systolisch"])
-        df["Diastolische Ausreißer"] = detect_outliers(df["Diastolisch"])
+        df["Systolische Ausreißer"] = sys_outliers[0, windows[0]]
+        df["Diastolische Ausreißer"] = dia_outliers[0, windows[0]]
 
         df[zeitspanne.capitalize()] = (
             df["Datum"].dt.to_period(timespan.capitalize()[0]).astype(str)
         )
 
-        def plot_box_and_outliers(typ=typ):
-            color = "red" if typ == "systolisch" else "blue"
-            plt.figure(figsize=(10, 6))
-            sns.boxplot(
-                x=zeitspanne.capitalize(), y=typ.capitalize(), data=df, color=color
-            )
-            sns.scatterplot(
-                x=zeitspanne.capitalize(),
-                y=typ.capitalize(),
-                data=df[df[f"{typ.capitalize()}e Ausreißer"]],
-                hue="Tageszeit ",
-                color=color,
-            )
-            plt.title(
-                f"{typ.capitalize()}er Blutdruck Boxplot nach {zeitspanne.capitalize()}"
-            )
-
-            span = systolic_span if typ == "systolisch" else diastolic_span
-            # highlight target range
-            plt.axhspan(span[0], span[1], color="green", alpha=0.2)
-
-            # rotate x-axis labels
-            plt.xticks(rotation=45)
-
-            if since_date:
-                df["Änderungsdatum"] = pd.to_datetime(change_date_parsed).to_period(
-                    timespan.capitalize()[0]
-                )
-                vline = plt.axvline(
-                    x=df["Änderungsdatum"].astype(str).iloc[0],
-                    color="red",
-                    linestyle="--",
-                    label="Änderungsdatum"
-                    + f" ({change_date_parsed.strftime('%d.%m.%Y')})",
-                )
-                ax = plt.gca()
-                trans = transforms.blended_transform_factory(ax.transData, ax.transAxes)
-                vline.set_transform(
-                    trans
-                    + transforms.ScaledTranslation(
-                        -20 / 72.0, 0, plt.gcf().dpi_scale_trans
-                    )
-                )
-
-                plt.legend()
-            filename = str(
-                pathlib.Path().parent.absolute()
-                / (
-                    f"tmp_{typ}_boxplot_{zeitspanne}_and_outliers_"
-                    + str(datetime.now())
-                    + ".png"
+        # rendered while the messages go out
+        measures = (
+            [typ]
+            if typ in ["diastolisch", "systolisch"]
+            else ["systolisch", "diastolisch"]
+        )
+        figures = [
+            plots.submit(
+                PlotSpec(
+                    "outlier_boxplot",
+                    {
+                        column: df[column].values
+                        for column in (
+                            "Datum",
+                            measure.capitalize(),
+                            f"{measure.capitalize()}e Ausreißer",
+                            "Tageszeit ",
+                        )
+                    },
+                    {
+                        "typ": measure,
+                        "period_label": zeitspanne.capitalize(),
+                        "period": timespan.capitalize()[0],
+                        "span": (
+                            systolic_span if measure == "systolisch" else diastolic_span
+                        ),
+                        "change_date": change_date_parsed if since_date else None,
+                    },
                 )
             )
-            plt.tight_layout()
-            plt.savefig(filename)
-            return filename
+            for measure in measures
+        ]
 
         current_date_one_timespan_ago = (
             pd.to_datetime(datetime.now())
@@ -170,19 +128,16 @@ class ActionDetailsAusreisser(Action):
         if since_date:
             utter_change_in_outliers_since_date(
                 change_date_parsed,
-                detect_outliers,
+                sys_outliers[1, windows[1]],
+                dia_outliers[1, windows[1]],
                 df_recently,
                 dispatcher,
                 recent_dia_outliers,
                 recent_sys_outliers,
-                user_id,
             )
 
-        if typ in ["diastolisch", "systolisch"]:
-            dispatcher.utter_message(image=plot_box_and_outliers())
-        else:
-            dispatcher.utter_message(image=plot_box_and_outliers("systolisch"))
-            dispatcher.utter_message(image=plot_box_and_outliers("diastolisch"))
+        for image in await plots.images(*figures):
+            dispatcher.utter_message(image=image)
         dispatcher.utter_message(
             buttons=[
                 {
@@ -201,43 +156,22 @@ class ActionDetailsAusreisser(Action):
 # Die Anzahl der Ausreißer hat sich nach der Medikamentenänderung am ... signifikant auf 20% und 5% reduziert.
 def utter_change_in_outliers_since_date(
     change_date_parsed,
-    detect_outliers,
+    sys_outliers_before,
+    dia_outliers_before,
     df_recently,
     dispatcher,
     recent_dia_outliers,
     recent_sys_outliers,
-    user_id,
 ):
-    query = f"""
-                    SELECT
-                        systolic,
-                        diastolic,
-                        pulse,
-                        recorded_at
-                    FROM 
-                        bloodpressure
-                    WHERE 
-                        user_id = {user_id}
-                        AND CAST(recorded_at AS timestamp) <= '{change_date_parsed.strftime('%Y-%m-%d')}'
-                """
-    results = DBHandler().execute_query(query)
-    if not results:
+    if not len(sys_outliers_before):
         dispatcher.utter_message(
             "Keine Daten vor dem Änderungsdatum gefunden. Die Anzahl der Ausreißer kann nicht verglichen werden."
         )
         return
-    df_before = df_from_result(utils.recorded_at_to_datetime(results))
     sys_percent_after = len(recent_sys_outliers) / len(df_recently) * 100
     dia_percent_after = len(recent_dia_outliers) / len(df_recently) * 100
-    # Add outlier columns
-    df_before["Systolische Ausreißer"] = detect_outliers(df_before["Systolisch"])
-    df_before["Diastolische Ausreißer"] = detect_outliers(df_before["Diastolisch"])
-    sys_percent_before = (
-        len(df_before[df_before["Systolische Ausreißer"]]) / len(df_before) * 100
-    )
-    dia_percent_before = (
-        len(df_before[df_before["Diastolische Ausreißer"]]) / len(df_before) * 100
-    )
+    sys_percent_before = sys_outliers_before.mean() * 100
+    dia_percent_before = dia_outliers_before.mean() * 100
     dispatcher.utter_message(
         f"Die Quote der Ausreißer im systolischen Blutwert hat sich seit dem {change_date_parsed.strftime('%d.%m.%Y')} von {round(sys_percent_before)}% auf {round(sys_percent_after)}% "
         + ("erhöht." if sys_percent_after > sys_percent_before else "verringert.")
@@ -248,27 +182,11 @@ def utter_change_in_outliers_since_date(
     )
 
 
-def df_from_result(results):
-    data = {
-        "Datum": [recorded_at for systolic, diastolic, pulse, recorded_at in results],
-        "Systolisch": [
-            int(systolic) for systolic, diastolic, pulse, recorded_at in results
-        ],
-        "Diastolisch": [
-            int(diastolic) for systolic, diastolic, pulse, recorded_at in results
-        ],
-        "Puls": [int(pulse) for systolic, diastolic, pulse, recorded_at in results],
-        "Tageszeit ": [
-            utils.get_time_of_day(recorded_at) + " Ausreißer"
-            for systolic, diastolic, pulse, recorded_at in results
-        ],
-        "Tageszeit": [
-            utils.get_time_of_day(recorded_at)
-            for systolic, diastolic, pulse, recorded_at in results
-        ],
-    }
-    df_before = pd.DataFrame(data)
-    return df_before
+def df_from_series(series):
+    df = series.to_frame(("Systolisch", "Diastolisch", "Puls", "Datum"))
+    df["Tageszeit"] = utils.get_times_of_day(series.hours)
+    df["Tageszeit "] = df["Tageszeit"] + " Ausreißer"
+    return df
 
 
 # In der letzten Woche waren 50% der systolischen und 30% der diastolischen Messungen extreme Ausreißer.
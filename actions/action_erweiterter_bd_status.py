@@ -1,13 +1,13 @@
-from collections import defaultdict
-from datetime import datetime
 from typing import Any, Text, Dict, List
 
 from rasa_sdk import Action, Tracker
 from rasa_sdk.executor import CollectingDispatcher
 
-from actions import ddp
-from actions.utils.db_utils import DBHandler
+from actions.utils.dates import resolve_date
+from actions.utils.daytimes import DAYTIMES
 from actions.utils.utils import (
+    get_bloodpressure_since,
+    get_bloodpressure_within,
     get_bp_range,
     get_patient_details,
     calculate_percentages,
@@ -17,10 +17,6 @@ from actions.utils.utils import (
 
 
 class ActionErweiterterBDStatus(Action):
-    def __init__(self):
-        self.dbhandler = DBHandler()
-        super().__init__()
-
     def name(self) -> Text:
         return "action_erweiterter_bd_status"
 
@@ -36,9 +32,7 @@ class ActionErweiterterBDStatus(Action):
         user_id = tracker.get_slot("user_id")
         zeitspanne = tracker.get_slot("timespan") or "Monat"
         change_date = tracker.get_slot("change_date") or None
-        change_date_parsed = (
-            ddp.get_date_data(change_date).date_obj if change_date else None
-        )
+        change_date_parsed = resolve_date(change_date)
         change_date = (
             change_date_parsed.strftime("%Y-%m-%d") if change_date_parsed else None
         )
@@ -48,50 +42,21 @@ class ActionErweiterterBDStatus(Action):
             dispatcher.utter_message("Bitte geben Sie eine Benutzer-ID an.")
             return []
 
-        patient_details = get_patient_details(user_id, tracker)
+        patient_details = get_patient_details(user_id, tracker=tracker)
         systolic_range, diastolic_range = get_bp_range(
             patient_details["birthday"], bool(patient_details["medical_preconditions"])
         )
         if next(tracker.get_latest_entity_values("timespan"), None):
-            date_filter = (
-                f"AND CAST(recorded_at AS timestamp) >= NOW() - INTERVAL '3 {timespan}'"
-            )
+            results = get_bloodpressure_within(user_id, f"3 {timespan}")
             date_range_message = at_the_last_prefix.get(zeitspanne)
             date_range_message = date_range_message[0].lower() + date_range_message[1:]
         elif change_date:
-            date_filter = f"AND CAST(recorded_at AS timestamp) >= '{change_date}'"
+            results = get_bloodpressure_since(user_id, change_date)
             date_range_message = "seit dem " + change_date_parsed.strftime("%d.%m.%Y")
         else:
-            date_filter = (
-                f"AND CAST(recorded_at AS timestamp) >= NOW() - INTERVAL '3 {timespan}'"
-            )
+            results = get_bloodpressure_within(user_id, f"3 {timespan}")
             date_range_message = at_the_last_prefix.get(zeitspanne)
             date_range_message = date_range_message[0].lower() + date_range_message[1:]
-
-        query = f"""
-                SELECT
-                    systolic,
-                    diastolic,
-                    pulse,
-                    recorded_at
-                FROM 
-                    bloodpressure
-                WHERE 
-                    user_id = {user_id}
-                    {date_filter}
-            """
-
-        results = self.dbhandler.execute_query(query)
-        # map recorded at to date time
-        results = [
-            (
-                systolic,
-                diastolic,
-                pulse,
-                datetime.strptime(recorded_at, "%Y-%m-%d %H:%M:%S.%f"),
-            )
-            for systolic, diastolic, pulse, recorded_at in results
-        ]
         if not results:
             dispatcher.utter_message(
                 "Keine Blutdruckaufzeichnungen für den angegebenen Zeitraum gefunden."
@@ -99,20 +64,16 @@ class ActionErweiterterBDStatus(Action):
             return {}
         print(results)
 
-        systolic_values = [result[0] for result in results]
-        diastolic_values = [result[1] for result in results]
+        systolic_values = results.systolic
+        diastolic_values = results.diastolic
 
-        if not systolic_values or not diastolic_values:
-            dispatcher.utter_message("Keine Blutdruckdaten verfügbar.")
-            return {}
+        systolic_min = systolic_values.min()
+        systolic_max = systolic_values.max()
+        systolic_avg = systolic_values.mean()
 
-        systolic_min = min(systolic_values)
-        systolic_max = max(systolic_values)
-        systolic_avg = sum(systolic_values) / len(systolic_values)
-
-        diastolic_min = min(diastolic_values)
-        diastolic_max = max(diastolic_values)
-        diastolic_avg = sum(diastolic_values) / len(diastolic_values)
+        diastolic_min = diastolic_values.min()
+        diastolic_max = diastolic_values.max()
+        diastolic_avg = diastolic_values.mean()
 
         # Calculate percentages for systolic values
         (
@@ -156,31 +117,22 @@ class ActionErweiterterBDStatus(Action):
         #             )
 
         # Step 1 & 2: Categorize readings into morning and evening
-        morning_readings = defaultdict(list)
-        evening_readings = defaultdict(list)
-
-        for result in results:
-            systolic, diastolic, _, recorded_at = result
-            hour = recorded_at.hour
-            if 6 <= hour < 12:  # Define your own time range for morning
-                morning_readings["systolic"].append(systolic)
-                morning_readings["diastolic"].append(diastolic)
-            elif 18 <= hour < 24:  # Define your own time range for evening
-                evening_readings["systolic"].append(systolic)
-                evening_readings["diastolic"].append(diastolic)
+        daytimes = DAYTIMES.codes(results.recorded_at)
+        morning = daytimes == DAYTIMES.code("Morgen")
+        evening = daytimes == DAYTIMES.code("Abend")
 
         morning_systolic_percentages = calculate_percentages(
-            morning_readings["systolic"], systolic_range
+            systolic_values[morning], systolic_range
         )
         morning_diastolic_percentages = calculate_percentages(
-            morning_readings["diastolic"], diastolic_range
+            diastolic_values[morning], diastolic_range
         )
 
         evening_systolic_percentages = calculate_percentages(
-            evening_readings["systolic"], systolic_range
+            systolic_values[evening], systolic_range
         )
         evening_diastolic_percentages = calculate_percentages(
-            evening_readings["diastolic"], diastolic_range
+            diastolic_values[evening], diastolic_range
         )
 
         # Step 4: Generate messages
@@ -4,7 +4,7 @@ from rasa_sdk import Action, Tracker
 from rasa_sdk.executor import CollectingDispatcher
 
 from actions.utils.gpt_utils import GPTHandler
-from actions.utils.utils import get_bp_range, get_patient_details
+from actions.utils.utils import get_bp_range, get_patient_details_async
 
 
 class ActionGptFallback(Action):
@@ -22,7 +22,7 @@ class ActionGptFallback(Action):
         if user_id is None or user_id == "-1":
             dispatcher.utter_message("Please provide a user id.")
             return []
-        patient_details = get_patient_details(user_id, force_reload=False)
+        patient_details = await get_patient_details_async(user_id, force_reload=False)
         systolic_range, diastolic_range = get_bp_range(
             patient_details["birthday"],
             (patient_details["medical_preconditions"] not in ["", None]),
@@ -33,7 +33,8 @@ class ActionGptFallback(Action):
             f" and diastolic blood pressure: {diastolic_range}"
         )
         await GPTHandler(
-            basic_information=background_info_string_for_llm
+            basic_information=background_info_string_for_llm,
+            conversation_id=tracker.sender_id,
         ).execute_query(
             user_input, output_function=dispatcher.utter_message, stream=False
         )
@@ -5,15 +5,11 @@ from rasa_sdk import Action, Tracker
 from rasa_sdk.events import SlotSet
 from rasa_sdk.executor import CollectingDispatcher
 
-from actions.utils.db_utils import DBHandler
-from actions.utils.utils import get_bp_range, get_patient_details
+from actions.utils.rollups import get_rollup_stats
+from actions.utils.utils import get_bp_range, get_patient_details, interval_start
 
 
 class ActionGrundInfo(Action):
-    def __init__(self):
-        self.dbhandler = DBHandler()
-        super().__init__()
-
     def name(self) -> Text:
         return "action_grund_info"
 
@@ -47,37 +43,16 @@ class ActionGrundInfo(Action):
                     patient_details["birthday"],
                     (patient_details["medical_preconditions"] not in ["", None]),
                 )
-                query = f"""
-                    SELECT
-                        user_id,
-                        COUNT(CASE WHEN systolic BETWEEN {systolic_range[0]} AND {systolic_range[1]} THEN 1 END) AS systolic_in_range,
-                        COUNT(CASE WHEN systolic < {systolic_range[0]} THEN 1 END) AS systolic_below_range,
-                        COUNT(CASE WHEN systolic > {systolic_range[1]} THEN 1 END) AS systolic_above_range,
-                        
-                        COUNT(CASE WHEN diastolic BETWEEN {diastolic_range[0]} AND {diastolic_range[1]} THEN 1 END) AS diastolic_in_range,
-                        COUNT(CASE WHEN diastolic < {diastolic_range[0]} THEN 1 END) AS diastolic_below_range,
-                        COUNT(CASE WHEN diastolic > {diastolic_range[1]} THEN 1 END) AS diastolic_above_range,
-                        
-                        COUNT(CASE WHEN pulse BETWEEN 60 AND 100 THEN 1 END) AS pulse_in_range,
-                        COUNT(CASE WHEN pulse < 60 THEN 1 END) AS pulse_below_range,
-                        COUNT(CASE WHEN pulse > 100 THEN 1 END) AS pulse_above_range,
-                        
-                        COUNT(*) AS total,
-                        COUNT(CASE WHEN systolic BETWEEN {systolic_range[0]} AND {systolic_range[1]} 
-                                   AND diastolic BETWEEN {diastolic_range[0]} AND {diastolic_range[1]} 
-                                   AND pulse BETWEEN 60 AND 100 THEN 1 END) AS all_normal
-                    FROM 
-                        bloodpressure
-                    WHERE 
-                        user_id = {user_id}
-                        AND CAST(recorded_at AS timestamp) >= NOW() - INTERVAL '3 MONTHS'
-                    GROUP BY 
-                        user_id;
-                """
                 sex = patient_details["sex"]
                 pre_existing_conditions = patient_details["medical_preconditions"]
-                result = self.dbhandler.execute_query(query)
-                if not result or len(result) == 0:
+                result = get_rollup_stats(
+                    user_id,
+                    (systolic_range, diastolic_range),
+                    "daily",
+                    since=interval_start("3 months"),
+                    group_by=(),
+                )
+                if not result:
                     dispatcher.utter_message(
                         "No blood pressure records found for the past three months for the provided user id."
                     )
@@ -86,18 +61,18 @@ class ActionGrundInfo(Action):
                 result = result[0]
                 print(sex)
 
-                total = result[10]
-                systolic_in_range = result[1]
-                systolic_below_range = result[2]
-                systolic_above_range = result[3]
+                total = result.count
+                systolic_in_range = result.systolic_within
+                systolic_below_range = result.systolic_below
+                systolic_above_range = result.systolic_above
 
-                diastolic_in_range = result[4]
-                diastolic_below_range = result[5]
-                diastolic_above_range = result[6]
+                diastolic_in_range = result.diastolic_within
+                diastolic_below_range = result.diastolic_below
+                diastolic_above_range = result.diastolic_above
 
-                pulse_in_range = result[7]
-                pulse_below_range = result[8]
-                pulse_above_range = result[9]
+                pulse_in_range = result.pulse_within
+                pulse_below_range = result.pulse_below
+                pulse_above_range = result.pulse_above
 
                 systolic_total_out_of_range = (
                     systolic_below_range + systolic_above_range
@@ -106,8 +81,10 @@ class ActionGrundInfo(Action):
                     diastolic_below_range + diastolic_above_range
                 )
                 pulse_total_out_of_range = pulse_below_range + pulse_above_range
+                # readings without pulse only count for the blood pressure
+                pulse_total = result.pulse_count
 
-                all_normal = result[11]
+                all_normal = result.all_within
 
                 age = (
                     datetime.today().year
@@ -137,9 +114,9 @@ class ActionGrundInfo(Action):
                         f"Diastolische Messungen:\t{diastolic_above_range / total * 100:.0f}% darüber,\t{diastolic_below_range / total * 100:.0f}% darunter.\n"
                     )
 
-                if pulse_total_out_of_range / total > 0.1:
+                if pulse_total and pulse_total_out_of_range / pulse_total > 0.1:
                     dispatcher.utter_message(
-                        f"{pulse_above_range / total * 100:.0f}% der Puls-Messungen liegen darüber, {pulse_below_range / total * 100:.0f}% darunter.\n"
+                        f"{pulse_above_range / pulse_total * 100:.0f}% der Puls-Messungen liegen darüber, {pulse_below_range / pulse_total * 100:.0f}% darunter.\n"
                     )
 
             else:
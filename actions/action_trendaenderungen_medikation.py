@@ -1,25 +1,26 @@
-import pathlib
-from datetime import datetime
 from typing import Text
 
-import pandas as pd
-import seaborn as sns
-from matplotlib import pyplot as plt
+import numpy as np
 from rasa_sdk import Action
 
-from actions import ddp
-from actions.utils import utils
-from actions.utils.db_utils import DBHandler
+from actions.utils import plots, utils
+from actions.utils.corridors import Corridor
+from actions.utils.dates import resolve_date
+from actions.utils.lazy import lazy_import
+from actions.utils.plots import PlotSpec
+from actions.utils.stats import series_stats
+
+pd = lazy_import("pandas")
 
 
 class ActionTrendanderungenMedikation(Action):
     def name(self) -> Text:
         return "action_trendaenderungen_medikation"
 
-    def run(self, dispatcher, tracker, domain):
+    async def run(self, dispatcher, tracker, domain):
         user_id = tracker.get_slot("user_id") or 25601
         change_date = tracker.get_slot("change_date") or None
-        change_date = ddp.get_date_data(change_date).date_obj if change_date else None
+        change_date = resolve_date(change_date)
         if not change_date:
             dispatcher.utter_message(
                 "Bitte geben Sie ein Datum der relevanten Medikationsänderung an."
@@ -29,183 +30,71 @@ class ActionTrendanderungenMedikation(Action):
         systolic_span, diastolic_span, _ = utils.get_blood_pressure_spans(
             tracker, user_id
         )
-        query = f"""
-                        SELECT
-                            systolic,
-                            diastolic,
-                            pulse,
-                            recorded_at
-                        FROM 
-                            bloodpressure
-                        WHERE 
-                            user_id = {user_id}
-                            AND CAST(recorded_at AS timestamp) >= '{pd.to_datetime(change_date) - pd.Timedelta(4, 'W')}'
-                        ORDER BY recorded_at ASC
-                    """
-        results = DBHandler().execute_query(query)
+        results = utils.get_bloodpressure_since(
+            user_id, pd.to_datetime(change_date) - pd.Timedelta(4, "W")
+        )
         if not results:
             dispatcher.utter_message("Keine Daten gefunden.")
             return []
-        bp_data = pd.DataFrame(
-            results, columns=["Systolic", "Diastolic", "Pulse", "Date"]
-        )
-        bp_data["Event"] = bp_data["Date"] >= change_date.strftime("%Y-%m-%d")
-        bp_data["Date"] = pd.to_datetime(bp_data["Date"])
-        # Add a column to identify the event
-        bp_data["Date_num"] = (bp_data["Date"] - bp_data["Date"].min()).dt.days
-        bp_data_after = bp_data[bp_data["Date"] >= change_date]
-        bp_data_before = bp_data[bp_data["Date"] < change_date]
-        plt.figure(figsize=(12, 6))
-
-        sns.scatterplot(
-            data=bp_data,
-            x="Date_num",
-            y="Systolic",
-            hue="Event",
-            style="Event",
-            palette="Reds",
-            markers=["o"],
-            s=20,
-            legend=False,
-        )
-        sns.regplot(
-            data=bp_data[bp_data["Event"] == False],
-            x="Date_num",
-            y="Systolic",
-            scatter=False,
-            label="Trend Systolisch",
-            color="red",
-        )
-        sns.regplot(
-            data=bp_data[bp_data["Event"] == True],
-            x="Date_num",
-            y="Systolic",
-            scatter=False,
-            label=None,
-            color="red",
-        )
-        sys_avg_before = bp_data_before["Systolic"].mean()
-        sys_avg_after = bp_data_after["Systolic"].mean()
-        sys_max_before = bp_data_before["Systolic"].max()
-        sys_max_after = bp_data_after["Systolic"].max()
-        sys_min_before = bp_data_before["Systolic"].min()
-        sys_min_after = bp_data_after["Systolic"].min()
-
-        sys_below_before, sys_within_before, sys_above_before = (
-            utils.calculate_percentages(bp_data_before["Systolic"], systolic_span)
-        )
-        sys_below_after, sys_within_after, sys_above_after = (
-            utils.calculate_percentages(bp_data_after["Systolic"], systolic_span)
-        )
-
-        plt.axhline(
-            y=sys_avg_before,
-            color="red",
-            linestyle="--",
-            label=f"Sys. Durch. vorher: {sys_avg_before:.1f}",
-            alpha=0.5,
-        )
-        plt.axhline(
-            y=sys_avg_after,
-            color="red",
-            linestyle="--",
-            label=f"Sys. Durch. nachher: {sys_avg_after:.1f}",
-            alpha=0.5,
-        )
-
-        # Same for diastolic
-        sns.scatterplot(
-            data=bp_data,
-            x="Date_num",
-            y="Diastolic",
-            hue="Event",
-            style="Event",
-            palette="Blues",
-            markers=["o"],
-            s=20,
-            legend=False,
-        )
-        sns.regplot(
-            data=bp_data[bp_data["Event"] == False],
-            x="Date_num",
-            y="Diastolic",
-            scatter=False,
-            label="Trend Diastolisch",
-            color="blue",
-        )
-        sns.regplot(
-            data=bp_data[bp_data["Event"] == True],
-            x="Date_num",
-            y="Diastolic",
-            scatter=False,
-            label=None,
-            color="blue",
-        )
-
-        dia_avg_before = bp_data_before["Diastolic"].mean()
-        dia_avg_after = bp_data_after["Diastolic"].mean()
-        dia_max_before = bp_data_before["Diastolic"].max()
-        dia_max_after = bp_data_after["Diastolic"].max()
-        dia_min_before = bp_data_before["Diastolic"].min()
-        dia_min_after = bp_data_after["Diastolic"].min()
-
-        dia_below_before, dia_within_before, dia_above_before = (
-            utils.calculate_percentages(bp_data_before["Diastolic"], diastolic_span)
-        )
-        dia_below_after, dia_within_after, dia_above_after = (
-            utils.calculate_percentages(bp_data_after["Diastolic"], diastolic_span)
-        )
-
-        plt.axhline(
-            y=dia_avg_before,
-            color="blue",
-            linestyle="--",
-            label=f"Dias. Durch. vorher: {dia_avg_before:.1f}",
-            alpha=0.5,
-        )
-        plt.axhline(
-            y=dia_avg_after,
-            color="blue",
-            linestyle="--",
-            label=f"Dias. Durch. nachher: {dia_avg_after:.1f}",
-            alpha=0.5,
+        bp_data = results.to_frame(("Systolic", "Diastolic", "Pulse", "Date"))
+        bp_data["Event"] = bp_data["Date"] >= pd.Timestamp(change_date.date())
+        # all figures of both periods at once, the event marks the readings after
+        stats = series_stats(
+            results,
+            Corridor(systolic_span, diastolic_span),
+            bp_data["Event"].to_numpy(dtype=np.intp),
+            ("before", "after"),
         )
-
-        filters = bp_data["Date"] <= change_date
-        if filters.any():
-            # Add vertical line for the event date
-            respective_id = bp_data[filters].iloc[-1]["Date_num"]
-            plt.axvline(
-                x=respective_id,
-                color="black",
-                linestyle="--",
-                label="Änderungsdatum" + f" ({pretty_change_date})",
-                linewidth=1,
+        (
+            sys_min_before,
+            sys_avg_before,
+            sys_max_before,
+            sys_below_before,
+            sys_within_before,
+            sys_above_before,
+        ) = summary(stats, "before", "systolic")
+        (
+            sys_min_after,
+            sys_avg_after,
+            sys_max_after,
+            sys_below_after,
+            sys_within_after,
+            sys_above_after,
+        ) = summary(stats, "after", "systolic")
+        (
+            dia_min_before,
+            dia_avg_before,
+            dia_max_before,
+            dia_below_before,
+            dia_within_before,
+            dia_above_before,
+        ) = summary(stats, "before", "diastolic")
+        (
+            dia_min_after,
+            dia_avg_after,
+            dia_max_after,
+            dia_below_after,
+            dia_within_after,
+            dia_above_after,
+        ) = summary(stats, "after", "diastolic")
+        figure = plots.submit(
+            PlotSpec(
+                "medication_trends",
+                {
+                    column: bp_data[column].values
+                    for column in ("Date", "Systolic", "Diastolic", "Event")
+                },
+                {
+                    "change_date": change_date,
+                    "averages": {
+                        "sys_before": sys_avg_before,
+                        "sys_after": sys_avg_after,
+                        "dia_before": dia_avg_before,
+                        "dia_after": dia_avg_after,
+                    },
+                },
             )
-
-        # Add titles and labels
-        plt.title(
-            "Trendänderung im systolischen und diastolischen Blutdruck seit Medikationsänderung"
-        )
-        plt.xlabel("Datum")
-        plt.ylabel("Systolische und Diastolische Werte (mmHg)")
-
-        xticks = bp_data["Date_num"]
-        xlabels = bp_data["Date"].dt.strftime("%Y-%m-%d")
-        plt.xticks(
-            ticks=xticks[:: max(1, int(len(xticks) / 10))],
-            labels=xlabels[:: max(1, int(len(xticks) / 10))],
-            rotation=45,
-        )
-
-        # Display the plot
-        plt.legend(title="Legend", bbox_to_anchor=(1.05, 1), loc="upper left")
-        plt.tight_layout()
-        filename = str(
-            pathlib.Path().parent.absolute()
-            / f"tmp_{user_id}_medikation_trendaenderung_{datetime.now().strftime('%Y%m%d%H%M%S')}.png"
         )
-        plt.savefig(filename)
 
         def generate_arrow(before, after):
             if before > after:
@@ -216,16 +105,14 @@ class ActionTrendanderungenMedikation(Action):
                 return "→"
 
         (
-            dispatcher.utter_message(
-                f"""
+            dispatcher.utter_message(f"""
         In den Wochen nach dem {pretty_change_date} lagen die Blutdruckmessungen zwischen {sys_min_after}/{dia_min_after} und {sys_max_after}/{dia_max_after} mmHg und hatten einen Durchschnitt von {sys_avg_after:.2f}({generate_arrow(sys_avg_before, sys_avg_after)})/{dia_avg_after:.2f}({generate_arrow(dia_avg_before, dia_avg_after)}) mmHg.
         
         - Innerhalb des Ziels:\t{sys_within_after:.0f}% ({generate_arrow(sys_within_before, sys_within_after)}) systolisch,\t{dia_within_after:.0f}% ({generate_arrow(dia_within_before, dia_within_after)}) diastolisch
         - Unterhalb des Ziels:\t{sys_below_after:.0f}% ({generate_arrow(sys_below_before, sys_below_after)}) systolisch,\t{dia_below_after:.0f}% ({generate_arrow(dia_below_before, dia_below_after)}) diastolisch
         - Über dem Ziel:\t{sys_above_after:.0f}% ({generate_arrow(sys_above_before, sys_above_after)}) systolisch,\t{dia_above_after:.0f}% ({generate_arrow(dia_above_before, dia_above_after)}) diastolisch
-        """
-            )
-            if len(bp_data_after) > 0
+        """)
+            if "after" in stats
             else dispatcher.utter_message(
                 f"Es wurden keine Messungen nach dem {pretty_change_date} gefunden."
             )
@@ -239,12 +126,13 @@ class ActionTrendanderungenMedikation(Action):
         - Über dem Ziel:\t{sys_above_before:.0f}% systolisch,\t{dia_above_before:.0f}% diastolisch
         """
             )
-            if len(bp_data_before) > 0
+            if "before" in stats
             else dispatcher.utter_message(
                 f"Es wurden keine Messungen vor dem {pretty_change_date} gefunden."
             )
         )
-        dispatcher.utter_message(image=filename)
+        (image,) = await plots.images(figure)
+        dispatcher.utter_message(image=image)
         dispatcher.utter_message(
             buttons=[
                 {
@@ -262,3 +150,19 @@ class ActionTrendanderungenMedikation(Action):
             ]
         )
         return []
+
+
+def summary(stats, period, measure):
+    """
+    Min, mean, max and the percentages below, within and above the corridor of
+    measure in period, NaN and zero percent without readings.
+    """
+    if period not in stats:
+        return (np.nan, np.nan, np.nan, 0, 0, 0)
+    group = stats[period]
+    return (
+        group.min(measure),
+        group.mean(measure),
+        group.max(measure),
+        *group.percentages(measure),
+    )
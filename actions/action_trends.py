@@ -1,33 +1,37 @@
-import pathlib
-from datetime import datetime
 from typing import Text
 
-import pandas as pd
-import seaborn as sns
-from matplotlib import pyplot as plt
 from rasa_sdk import Action
 
-from actions import ddp
-from actions.utils.db_utils import DBHandler
-from actions.utils.utils import get_patient_details, get_bp_range, month_to_german
+from actions.utils import plots
+from actions.utils.dates import resolve_date
+from actions.utils.lazy import lazy_import
+from actions.utils.plots import PlotSpec
+from actions.utils.rollups import get_rollup_stats
+from actions.utils.trend import run_bounds, segment_trends
+from actions.utils.utils import (
+    get_patient_details,
+    get_bp_range,
+    month_to_german,
+    get_bloodpressure_since,
+)
+
+pd = lazy_import("pandas")
 
 
 class ActionTrends(Action):
     def name(self) -> Text:
         return "action_trends"
 
-    def run(self, dispatcher, tracker, domain):
+    async def run(self, dispatcher, tracker, domain):
         user_id = tracker.get_slot("user_id")
         change_date = tracker.get_slot("change_date") or None
-        change_date_parsed = (
-            ddp.get_date_data(change_date).date_obj if change_date else None
-        )
+        change_date_parsed = resolve_date(change_date)
 
         if user_id is None or user_id == "-1":
             dispatcher.utter_message("Bitte geben Sie eine Benutzer-ID an.")
             return []
 
-        patient_details = get_patient_details(user_id, tracker)
+        patient_details = get_patient_details(user_id, tracker=tracker)
         systolisch_span, diastolic_span = get_bp_range(
             patient_details["birthday"], bool(patient_details["medical_preconditions"])
         )
@@ -36,134 +40,40 @@ class ActionTrends(Action):
             .replace(day=1)
             .strftime("%Y-%m-%d")
         )
-        query = f"""
-                SELECT
-                    systolic,
-                    diastolic,
-                    pulse,
-                    recorded_at
-                FROM 
-                    bloodpressure
-                WHERE 
-                    user_id = {user_id}
-                    AND CAST(recorded_at AS timestamp) >= '{six_months_ago_beginning_of_month}'
-            """
-
-        results = DBHandler().execute_query(query)
+        results = get_bloodpressure_since(user_id, six_months_ago_beginning_of_month)
         if not results:
             dispatcher.utter_message("Keine Daten gefunden.")
             return []
-        bp_data = pd.DataFrame(
-            results, columns=["Systolisch", "Diastolisch", "Puls", "Datum"]
-        )
-
-        bp_data["Datum"] = pd.to_datetime(bp_data["Datum"])
-        bp_data["Datum_num"] = (bp_data["Datum"] - bp_data["Datum"].min()).dt.days
-        bp_data["Month"] = bp_data["Datum"].dt.month
-        bp_data["Monthly_average_systolic"] = bp_data.groupby("Month")[
-            "Systolisch"
-        ].transform("mean")
-        bp_data["Monthly_average_diastolic"] = bp_data.groupby("Month")[
-            "Diastolisch"
-        ].transform("mean")
+        bp_data = results.to_frame(("Systolisch", "Diastolisch", "Puls", "Datum"))
 
-        plt.figure(figsize=(12, 8))
-
-        # Scatter plot for Systolisch
-        sns.scatterplot(
-            data=bp_data, x="Datum_num", y="Systolisch", color="red", legend=False
-        )
-
-        # Regression lines for Systolisch by month
-        first = True
-        for month, group in bp_data.groupby("Month"):
-            sns.regplot(
-                data=group,
-                x="Datum_num",
-                y="Systolisch",
-                scatter=False,
-                label=f"Systolische Trends" if first else "",
-                truncate=True,
-                color="r",
-            )
-            first = False
-
-        # Scatter plot for Diastolic
-        sns.scatterplot(
-            data=bp_data, x="Datum_num", y="Diastolisch", color="blue", legend=False
-        )
-
-        # Regression lines for Diastolic by month
-        first = True
-        for month, group in bp_data.groupby("Month"):
-            sns.regplot(
-                data=group,
-                x="Datum_num",
-                y="Diastolisch",
-                scatter=False,
-                label=f"Diastolische Trends" if first else "",
-                truncate=True,
-                color="b",
-            )
-            first = False
-
-        # Add vertical line for the event date
-        if change_date_parsed:
-            respective_id = bp_data[bp_data["Datum"] <= change_date_parsed].iloc[-1][
-                "Datum_num"
-            ]
-            plt.axvline(
-                x=respective_id,
-                color="black",
-                linestyle="--",
-                label="Änderungsdatum"
-                + f" ({change_date_parsed.strftime('%d.%m.%Y')})",
-                linewidth=1,
+        figure = plots.submit(
+            PlotSpec(
+                "trends",
+                {
+                    "Datum": results.recorded_at,
+                    "Systolisch": results.systolic,
+                    "Diastolisch": results.diastolic,
+                },
+                {
+                    "systolic_span": systolisch_span,
+                    "diastolic_span": diastolic_span,
+                    "change_date": change_date_parsed,
+                },
             )
-
-        # Add target coridors for systolic and diastolic
-        plt.axhspan(
-            diastolic_span[0],
-            diastolic_span[1],
-            color="green",
-            alpha=0.1,
-            label="Normalbereiche",
-        )
-        plt.axhspan(systolisch_span[0], systolisch_span[1], color="green", alpha=0.1)
-
-        # Add titles and labels
-        plt.title("Blutdruckentwicklung der letzten 6 Monate")
-        plt.xlabel("Datum")
-        plt.ylabel("Blutdruck Diastolisch und Systolisch (mmHg)")
-        plt.legend()
-
-        # Add x-axis labels
-        xticks = bp_data["Datum_num"]
-        # pretty date labels month and year
-        xlabels = bp_data["Datum"].dt.strftime("%b %Y")
-        # Filter always first appearing date of month if available otherwise next larger
-        xticks = xticks[~xlabels.duplicated(keep="first")]
-        xlabels = xlabels[~xlabels.duplicated(keep="first")]
-        plt.xticks(
-            ticks=xticks,
-            labels=xlabels,
-            rotation=45,
-        )
-
-        # Display the plot
-        plt.tight_layout()
-        filename = str(
-            pathlib.Path().parent.absolute()
-            / f"tmp_{user_id}_{datetime.now().strftime('%Y%m%d%H%M%S')}_trends.png"
         )
-        plt.savefig(filename)
+        bp_data["Datum_num"] = (bp_data["Datum"] - bp_data["Datum"].min()).dt.days
 
-        trend_messages = generate_trend_messages(
-            bp_data, systolisch_span, diastolic_span
+        monthly_stats = get_rollup_stats(
+            user_id,
+            (systolisch_span, diastolic_span),
+            "monthly",
+            since=six_months_ago_beginning_of_month,
         )
+        trend_messages = generate_trend_messages(bp_data, monthly_stats)
         for message in trend_messages:
             dispatcher.utter_message(message)
-        dispatcher.utter_message(image=filename)
+        (image,) = await plots.images(figure)
+        dispatcher.utter_message(image=image)
         dispatcher.utter_message(
             buttons=[
                 {
@@ -183,93 +93,53 @@ class ActionTrends(Action):
         return []
 
 
-from sklearn.linear_model import LinearRegression
-
-
-def generate_trend_messages(bp_data, systolisch_span, diastolic_span):
+def generate_trend_messages(bp_data, monthly_stats):
     trend_messages = []
-    months = bp_data["Month"].unique()
     bp_data["Month_Year"] = bp_data["Datum"].dt.strftime("%Y-%m")
-    month_and_years = bp_data["Month_Year"].unique()
+    months, bounds = run_bounds(bp_data["Month_Year"].values)
+    month_index = {month: i for i, month in enumerate(months)}
+    x = bp_data["Datum_num"].values
+    systolic_trends = segment_trends(x, bp_data["Systolisch"].values, bounds)
+    diastolic_trends = segment_trends(x, bp_data["Diastolisch"].values, bounds)
     previous_month_values = None
     # only the last three analyzed
-    month_and_years = sorted(month_and_years)[-4:]
-    for month_and_year in month_and_years:
-        month_data = bp_data[bp_data["Month_Year"] == month_and_year]
-        year = month_data["Datum"].dt.strftime("%Y").iloc[0]
-        month_id = month_data["Datum"].dt.strftime("%m").iloc[0]
-        monat = month_to_german[month_id]
-        systolic_min = month_data["Systolisch"].min()
-        systolic_max = month_data["Systolisch"].max()
-        systolic_avg = month_data["Systolisch"].mean()
-        diastolic_min = month_data["Diastolisch"].min()
-        diastolic_max = month_data["Diastolisch"].max()
-        diastolic_avg = month_data["Diastolisch"].mean()
-        pulse_min = month_data["Puls"].min()
-        pulse_max = month_data["Puls"].max()
-        pulse_avg = month_data["Puls"].mean()
-
-        systolic_within_target = (
-            month_data[
-                (month_data["Systolisch"] >= systolisch_span[0])
-                & (month_data["Systolisch"] <= systolisch_span[1])
-            ].shape[0]
-            / month_data.shape[0]
-            * 100
-        )
-        systolic_below_target = (
-            month_data[month_data["Systolisch"] < systolisch_span[0]].shape[0]
-            / month_data.shape[0]
-            * 100
-        )
-        systolic_above_target = (
-            month_data[month_data["Systolisch"] > systolisch_span[1]].shape[0]
-            / month_data.shape[0]
-            * 100
-        )
-
-        diastolic_within_target = (
-            month_data[
-                (month_data["Diastolisch"] >= diastolic_span[0])
-                & (month_data["Diastolisch"] <= diastolic_span[1])
-            ].shape[0]
-            / month_data.shape[0]
-            * 100
-        )
-        diastolic_below_target = (
-            month_data[month_data["Diastolisch"] < diastolic_span[0]].shape[0]
-            / month_data.shape[0]
-            * 100
-        )
-        diastolic_above_target = (
-            month_data[month_data["Diastolisch"] > diastolic_span[1]].shape[0]
-            / month_data.shape[0]
-            * 100
-        )
+    for stats in monthly_stats[-4:]:
+        i = month_index.get(stats.bucket.strftime("%Y-%m"))
+        if i is None:
+            continue
+        year = stats.bucket.strftime("%Y")
+        monat = month_to_german[stats.bucket.strftime("%m")]
+        systolic_min = stats.systolic_min
+        systolic_max = stats.systolic_max
+        systolic_avg = stats.mean("systolic")
+        diastolic_min = stats.diastolic_min
+        diastolic_max = stats.diastolic_max
+        diastolic_avg = stats.mean("diastolic")
+        pulse_min = stats.pulse_min
+        pulse_max = stats.pulse_max
+        pulse_avg = stats.mean("pulse")
+
+        (
+            systolic_below_target,
+            systolic_within_target,
+            systolic_above_target,
+        ) = stats.percentages("systolic")
+        (
+            diastolic_below_target,
+            diastolic_within_target,
+            diastolic_above_target,
+        ) = stats.percentages("diastolic")
 
-        # Perform linear regression for systolic trend
-        X_systolic = month_data["Datum_num"].values.reshape(-1, 1)
-        y_systolic = month_data["Systolisch"].values
-        systolic_model = LinearRegression().fit(X_systolic, y_systolic)
         systolic_trend = (
-            "Aufwärtstrend" if systolic_model.coef_[0] > 0 else "Abwärtstrend"
+            "Aufwärtstrend" if systolic_trends.slope[i] > 0 else "Abwärtstrend"
         )
-
-        # Calculate systolic regression start and end values
-        systolic_start = systolic_model.predict([[X_systolic.min()]])[0]
-        systolic_end = systolic_model.predict([[X_systolic.max()]])[0]
-
-        # Perform linear regression for diastolic trend
-        X_diastolic = month_data["Datum_num"].values.reshape(-1, 1)
-        y_diastolic = month_data["Diastolisch"].values
-        diastolic_model = LinearRegression().fit(X_diastolic, y_diastolic)
+        systolic_start = systolic_trends.start[i]
+        systolic_end = systolic_trends.end[i]
         diastolic_trend = (
-            "Aufwärtstrend" if diastolic_model.coef_[0] > 0 else "Abwärtstrend"
+            "Aufwärtstrend" if diastolic_trends.slope[i] > 0 else "Abwärtstrend"
         )
-
-        # Calculate diastolic regression start and end values
-        diastolic_start = diastolic_model.predict([[X_diastolic.min()]])[0]
-        diastolic_end = diastolic_model.predict([[X_diastolic.max()]])[0]
+        diastolic_start = diastolic_trends.start[i]
+        diastolic_end = diastolic_trends.end[i]
 
         # Compare with previous month
         if previous_month_values:
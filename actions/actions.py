@@ -1,29 +1,41 @@
 from datetime import datetime
 from typing import Any, Text, Dict, List, Tuple, Optional
 
+import numpy as np
 from rasa_sdk import Action, Tracker
 from rasa_sdk.events import SlotSet, FollowupAction
 from rasa_sdk.executor import CollectingDispatcher
 
+from actions.utils.assistants import threads
+from actions.utils.corridors import Corridor
+from actions.utils.daytimes import Daytimes
 from actions.utils.db_utils import DBHandler
 from actions.utils.gpt_utils import GPTHandler
+from actions.utils.patient_cache import patient_cache
+from actions.utils.rollups import get_rollup_stats
+from actions.utils.stats import series_stats
 from actions.utils.utils import (
     get_within,
     get_trend,
     is_critical,
     get_bloodpressure,
-    check_most_recent_geofence,
+    get_bloodpressure_async,
+    get_bloodpressure_within,
+    get_geofence_stati,
     get_days_ago,
     get_blood_pressure_spans,
     geofence_data_available,
+    get_bp_range,
+    get_patient_details,
+    interval_start,
 )
 
+TIME_OF_DAY = Daytimes(
+    {"morning": (6, 12), "afternoon": (12, 18), "evening": (18, 24), "night": (0, 6)}
+)
 
-class ActionAskGPT(Action):
-    def __init__(self):
-        self.gpt_handler = None
-        super().__init__()
 
+class ActionAskGPT(Action):
     def name(self) -> Text:
         return "action_ask_gpt"
 
@@ -45,7 +57,7 @@ class ActionAskGPT(Action):
         if tracker.latest_message.get("text") == "exit":
             dispatcher.utter_message("Exiting GPT.")
             print("Exiting GPT.")
-            self.gpt_handler = None
+            threads.forget(tracker.sender_id)
             return [SlotSet("gpt_confirmed", False), FollowupAction("action_listen")]
         dispatcher.utter_message(
             "Currently using GPT to answer your question. Please wait a moment."
@@ -53,16 +65,14 @@ class ActionAskGPT(Action):
         user_input = tracker.latest_message.get("text")
         patient_details = str(tracker.slots)
         print("Patient details log " + patient_details)
-        if not self.gpt_handler:
-            self.gpt_handler = GPTHandler(basic_information=patient_details)
-
         if user_input is None:
             raise ValueError("No user input provided to ask to GPT.")
             return []
 
-        await self.gpt_handler.execute_query(
-            user_input, output_function=dispatcher.utter_message
-        )
+        # follow-up questions continue the thread of the conversation
+        await GPTHandler(
+            basic_information=patient_details, conversation_id=tracker.sender_id
+        ).execute_query(user_input, output_function=dispatcher.utter_message)
         return [FollowupAction("action_set_gpt_confirmed")]
 
 
@@ -78,7 +88,9 @@ class ActionOnceAskGPT(Action):
     ) -> List[Dict[Text, Any]]:
         user_input = tracker.latest_message.get("text")
         patient_details = str(tracker.slots)
-        await GPTHandler(basic_information=patient_details).execute_query(
+        await GPTHandler(
+            basic_information=patient_details, conversation_id=tracker.sender_id
+        ).execute_query(
             user_input, output_function=dispatcher.utter_message, stream=False
         )
         return []
@@ -116,7 +128,7 @@ class ActionRecentBloodPressureReadings(Action):
         if user_id is None or user_id == "-1":
             dispatcher.utter_message("Please provide a user id.")
             return []
-        result = get_bloodpressure(user_id, 1)
+        result = await get_bloodpressure_async(user_id, 1)
         if not result:
             dispatcher.utter_message(
                 "No blood pressure readings found for the provided user id."
@@ -145,9 +157,8 @@ class ActionGetUserNickname(Action):
         if user_id is None or user_id == "-1":
             dispatcher.utter_message("Please provide a user id.")
             return []
-        query = f"""SELECT nickname FROM patient WHERE user_id = {user_id};"""
-        result = DBHandler().execute_query(query)
-        nickname = result[0][0] if result else None
+        profile = patient_cache.get(user_id)
+        nickname = profile.nickname if profile else None
         if nickname is None:
             dispatcher.utter_message("No user found with the provided user id.")
             print(nickname)
@@ -172,25 +183,18 @@ class ActionGetBloodPressureTrendsThreeMonths(Action):
             dispatcher.utter_message("Please provide a user id.")
             return []
 
-        query = f"""
-    SELECT
-        DATE_TRUNC('month', CAST(recorded_at AS timestamp)) AS month,
-        MAX(systolic) AS max_systolic,
-        MIN(systolic) AS min_systolic,
-        AVG(systolic) AS avg_systolic,
-        MAX(diastolic) AS max_diastolic,
-        MIN(diastolic) AS min_diastolic,
-        AVG(diastolic) AS avg_diastolic,
-        MAX(pulse) AS max_pulse,
-        MIN(pulse) AS min_pulse,
-        AVG(pulse) AS avg_pulse,
-        COUNT(*) AS measurement_count
-    FROM bloodpressure
-    WHERE user_id = {user_id} AND CAST(recorded_at AS timestamp) >= NOW() - INTERVAL '3 MONTHS'
-    GROUP BY month
-    ORDER BY month;
-"""
-        results = DBHandler().execute_query(query)
+        patient_details = get_patient_details(user_id, tracker=tracker) or {}
+        corridor = get_bp_range(
+            patient_details.get("birthday"),
+            bool(patient_details.get("medical_preconditions")),
+        )
+        results = get_rollup_stats(
+            user_id,
+            corridor,
+            "daily",
+            since=interval_start("3 months"),
+            group_by=("month",),
+        )
         if not results:
             dispatcher.utter_message(
                 "No blood pressure records found for the past three months for the provided user id."
@@ -199,20 +203,18 @@ class ActionGetBloodPressureTrendsThreeMonths(Action):
 
         response = "Blood pressure trends for the past three months:"
         prev = None
-        for record in results:
-            (
-                month,
-                max_systolic,
-                min_systolic,
-                avg_systolic,
-                max_diastolic,
-                min_diastolic,
-                avg_diastolic,
-                max_pulse,
-                min_pulse,
-                avg_pulse,
-                measurement_count,
-            ) = record
+        for stats in results:
+            month = stats.bucket
+            max_systolic = stats.systolic_max
+            min_systolic = stats.systolic_min
+            avg_systolic = stats.mean("systolic")
+            max_diastolic = stats.diastolic_max
+            min_diastolic = stats.diastolic_min
+            avg_diastolic = stats.mean("diastolic")
+            max_pulse = stats.pulse_max
+            min_pulse = stats.pulse_min
+            avg_pulse = stats.mean("pulse")
+            measurement_count = stats.count
             response += f"\nMonth: {month.strftime('%B %Y')}\n"
             response += f"Measurements: {measurement_count}"
             if prev:
@@ -277,6 +279,12 @@ class ActionHighBloodPressureReadings(Action):
             "3 "
             + str(next(tracker.get_latest_entity_values("timespan"), "month")).upper()
         )
+        # the column name can not be bound as a parameter
+        if bp_type not in ["systolic", "diastolic", "pulse"]:
+            dispatcher.utter_message(
+                "Invalid type. Please provide either 'systolic', 'diastolic' or 'pulse'."
+            )
+            return []
 
         # Define the SQL query
         if "low" in direction:
@@ -302,18 +310,18 @@ class ActionHighBloodPressureReadings(Action):
         query = f"""
         SELECT recorded_at, systolic, diastolic, pulse
         FROM bloodpressure
-        WHERE user_id = {user_id} AND {bp_type} {operator} {limit} 
-        AND CAST(recorded_at AS timestamp) > NOW() - INTERVAL '{time_span}'
-        ORDER BY recorded_at DESC;
+        WHERE user_id = %s AND {bp_type} {operator} %s 
+        AND recorded_ts > NOW() - CAST(%s AS interval)
+        ORDER BY recorded_ts DESC;
         """
-        count_all_measurements = f"""
+        count_all_measurements = """
         SELECT COUNT(*)
         FROM bloodpressure
-        WHERE user_id = {user_id} AND CAST(recorded_at AS timestamp) > NOW() - INTERVAL '{time_span}';
+        WHERE user_id = %s AND recorded_ts > NOW() - CAST(%s AS interval);
         """
 
         # Execute the query
-        results = DBHandler().execute_query(query)
+        results = DBHandler().execute_query(query, (user_id, limit, time_span))
         if not results:
             dispatcher.utter_message(
                 f"No {bp_type} measurements {direction} than {limit} {'mmhg ' if type != 'pulse' else ''}"
@@ -323,7 +331,7 @@ class ActionHighBloodPressureReadings(Action):
 
         # Format the response
         response = (
-            f"Of the {DBHandler().execute_query(count_all_measurements)[0][0]} blood pressure measurements "
+            f"Of the {DBHandler().execute_query(count_all_measurements, (user_id, time_span))[0][0]} blood pressure measurements "
             f"in the last {time_span.lower()}s "
             f"there are {len(results)} {bp_type.capitalize()} blood pressure readings {direction} than {limit}"
             f"{' mmhg' if type != 'pulse' else ''}:\n"
@@ -355,15 +363,15 @@ class ActionBloodPressureGeofenceCorrelation(Action):
             return []
 
         # Define the SQL query to get blood pressure readings and geofence status
-        query = f"""
+        query = """
         SELECT recorded_at, systolic, diastolic, pulse
         FROM bloodpressure
-        WHERE user_id = {user_id} AND CAST(recorded_at AS timestamp) >= NOW() - INTERVAL '3 MONTH'
-        ORDER BY recorded_at DESC;
+        WHERE user_id = %s AND recorded_ts >= NOW() - INTERVAL '3 MONTH'
+        ORDER BY recorded_ts DESC;
         """
 
         # Execute the query
-        results = DBHandler().execute_query(query)
+        results = DBHandler().execute_query(query, (user_id,))
         if not results:
             dispatcher.utter_message(
                 "No blood pressure readings in the past month for the provided user id."
@@ -455,7 +463,8 @@ class ActionBloodPressureTimeOfDay(Action):
             dispatcher.utter_message("Please provide a user id.")
             return []
 
-        results = get_bloodpressure(user_id)
+        # the 100 most recent readings of the last three months
+        results = get_bloodpressure_within(user_id, "3 months")[-100:]
 
         if not results:
             dispatcher.utter_message(
@@ -463,40 +472,24 @@ class ActionBloodPressureTimeOfDay(Action):
             )
             return []
 
-        time_of_day_readings = {
-            "morning": [],
-            "afternoon": [],
-            "evening": [],
-            "night": [],
-        }
-        for record in results:
-            recorded_at, systolic, diastolic, pulse = record
-            hour = datetime.strptime(recorded_at, "%Y-%m-%d %H:%M:%S.%f").hour
-            if 6 <= hour < 12:
-                time_of_day_readings["morning"].append((systolic, diastolic))
-            elif 12 <= hour < 18:
-                time_of_day_readings["afternoon"].append((systolic, diastolic))
-            elif 18 <= hour < 24:
-                time_of_day_readings["evening"].append((systolic, diastolic))
-            else:
-                time_of_day_readings["night"].append((systolic, diastolic))
+        # attach reasonable spans for this user
+        systolic_span, diastolic_span, age = get_blood_pressure_spans(tracker, user_id)
+        stats = series_stats(
+            results,
+            Corridor(systolic_span, diastolic_span),
+            TIME_OF_DAY.codes(results.recorded_at),
+            TIME_OF_DAY.labels,
+        )
 
         response = "Statistics about blood pressure readings by time of day:\n"
-        for time_of_day, readings in time_of_day_readings.items():
-            if readings:
-                avg_systolic = sum(r[0] for r in readings) / len(readings)
-                avg_diastolic = sum(r[1] for r in readings) / len(readings)
-                max_systolic = max(r[0] for r in readings)
-                min_systolic = min(r[0] for r in readings)
-                max_diastolic = max(r[1] for r in readings)
-                min_diastolic = min(r[1] for r in readings)
+        for time_of_day in TIME_OF_DAY.labels:
+            if time_of_day in stats:
+                group = stats[time_of_day]
                 response += (
-                    f"{time_of_day.capitalize()}: Systolic - Avg: {avg_systolic:.2f}, Max: {max_systolic}, Min: {min_systolic}, N: {len(readings)}; "
-                    f"Diastolic - Avg: {avg_diastolic:.2f}, Max: {max_diastolic}, Min: {min_diastolic}, N: {len(readings)};\n"
+                    f"{time_of_day.capitalize()}: Systolic - Avg: {group.mean('systolic'):.2f}, Max: {group.max('systolic')}, Min: {group.min('systolic')}, N: {group.count}; "
+                    f"Diastolic - Avg: {group.mean('diastolic'):.2f}, Max: {group.max('diastolic')}, Min: {group.min('diastolic')}, N: {group.count};\n"
                 )
 
-        # attach reasonable spans for this user
-        systolic_span, diastolic_span, age = get_blood_pressure_spans(tracker, user_id)
         response += (
             f"Normal blood pressure spans for this user:\n"
             f"Systolic: {systolic_span[0]} - {systolic_span[1]}\n"
@@ -532,13 +525,15 @@ class ActionCriticalBloodPressureAlerts(Action):
             return []
 
         systolic_span, diastolic_span, age = get_blood_pressure_spans(tracker, user_id)
-        critical_readings = [
-            record
-            for record in results
-            if is_critical(
-                record[1], record[2], record[3], systolic_span, diastolic_span
-            )
-        ]
+        _, systolic, diastolic, pulse = zip(*results)
+        critical = is_critical(
+            np.array(systolic, dtype=np.float64),
+            np.array(diastolic, dtype=np.float64),
+            np.array(pulse, dtype=np.float64),
+            systolic_span,
+            diastolic_span,
+        )
+        critical_readings = [record for record, flag in zip(results, critical) if flag]
 
         if not critical_readings:
             dispatcher.utter_message(
@@ -594,7 +589,7 @@ class ActionGetLocationSpecificBloodPressure(Action):
         if user_id is None or user_id == "-1":
             dispatcher.utter_message("Please provide a user id.")
             return []
-        results = get_bloodpressure(user_id, 1000)
+        results = get_bloodpressure_within(user_id, "3 months")[-1000:]
         if not results:
             dispatcher.utter_message(
                 "No blood pressure readings found for the provided user id."
@@ -606,7 +601,7 @@ class ActionGetLocationSpecificBloodPressure(Action):
             )
             return []
 
-        # a) for each reading classify if outside according to check_most_recent_geofence
+        # a) for each reading classify if outside according to the most recent geofence status
         # b) calculate most recent and average, min and max systolic, diastolic as well as pulse
         valid_geostati = {
             "inside": ["IN_GEOFENCE", "RETURNED_TO_GEOFENCE", "IN"],
@@ -619,12 +614,8 @@ class ActionGetLocationSpecificBloodPressure(Action):
         }
         location = next(tracker.get_latest_entity_values("location"), "inside")
         print("valid values" + str(valid_geostati[location]))
-        results = [
-            record
-            for record in results
-            if check_most_recent_geofence(record[0], user_id)
-            in valid_geostati[location]
-        ]
+        geofence_stati = get_geofence_stati(user_id, results.recorded_at)
+        results = results[np.isin(geofence_stati, valid_geostati[location])]
         print("afterwars" + str(results))
         if not results:
             dispatcher.utter_message(
@@ -633,31 +624,24 @@ class ActionGetLocationSpecificBloodPressure(Action):
             )
             return []
 
-        response = f"Blood pressure readings {location} the geofence:\n"
-        most_recent = results[0]
-        avg_systolic = sum(r[1] for r in results) / len(results)
-        avg_diastolic = sum(r[2] for r in results) / len(results)
-        avg_pulse = sum(r[3] for r in results) / len(results)
-        max_systolic = max(r[1] for r in results)
-        min_systolic = min(r[1] for r in results)
-        max_diastolic = max(r[2] for r in results)
-        min_diastolic = min(r[2] for r in results)
-        max_pulse = max(r[3] for r in results)
-        min_pulse = min(r[3] for r in results)
+        corridor = get_blood_pressure_spans(tracker, user_id)
+        stats = series_stats(results, Corridor(corridor[0], corridor[1]))[None]
 
+        response = f"Blood pressure readings {location} the geofence:\n"
+        most_recent = results[-1:]
         response += (
-            f"Most recent reading {location} geofence was recorded {get_days_ago(most_recent[0])} days ago.\n"
-            f"Systolic: {most_recent[1]} mmHg, Diastolic: {most_recent[2]} mmHg, Pulse: {most_recent[3]}\n"
+            f"Most recent reading {location} geofence was recorded {get_days_ago(most_recent.last_recorded_at)} days ago.\n"
+            f"Systolic: {most_recent.systolic[0]} mmHg, Diastolic: {most_recent.diastolic[0]} mmHg, Pulse: {most_recent.pulse[0]:.0f}\n"
         )
-        response += (
-            f"Min, Average and Max Values:\n"
-            f"Systolic: {min_systolic}, {avg_systolic:.2f}, {max_systolic}\n"
-            f"Diastolic: {min_diastolic}, {avg_diastolic:.2f}, {max_diastolic}\n"
-            f"Pulse: {min_pulse}, {avg_pulse:.2f}, {max_pulse}\n"
+        response += "Min, Average and Max Values:\n" + "".join(
+            f"{label}: {stats.min(measure)}, {stats.mean(measure):.2f}, {stats.max(measure)}\n"
+            for label, measure in (
+                ("Systolic", "systolic"),
+                ("Diastolic", "diastolic"),
+                ("Pulse", "pulse"),
+            )
         )
 
-        corridor = get_blood_pressure_spans(tracker, user_id)
-
         response += (
             f"Recommended blood pressure spans for patients in this age group:\n"
             f"Systolic: {corridor[0][0]} - {corridor[0][1]}\n"
@@ -701,7 +685,7 @@ class ActionUserMedicalPreconditions(Action):
             return []
 
         medical_preconditions, response = (
-            ActionUserMedicalPreconditions.get_medical_preconditions(user_id)
+            await ActionUserMedicalPreconditions.get_medical_preconditions(user_id)
         )
         if not medical_preconditions or medical_preconditions == "":
             dispatcher.utter_message(
@@ -716,16 +700,12 @@ class ActionUserMedicalPreconditions(Action):
         return []
 
     @staticmethod
-    def get_medical_preconditions(user_id) -> Tuple[Optional[str], str]:
+    async def get_medical_preconditions(user_id) -> Tuple[Optional[str], str]:
         try:
-            query = (
-                f"SELECT medical_preconditions FROM patient WHERE user_id = {user_id};"
-            )
-            result = DBHandler().execute_query(query)
-            print(result)
+            profile = await patient_cache.get_async(user_id)
             medical_preconditions = None
-            if result:
-                medical_preconditions = result[0][0]
+            if profile:
+                medical_preconditions = profile.medical_preconditions
                 response = (
                     medical_preconditions
                     if medical_preconditions
@@ -0,0 +1,200 @@
+"""
+Reuse of OpenAI assistants and threads across the messages of the action server.
+
+Creating an assistant and a thread costs two API round trips before a question
+is even asked. The assistant registry creates each configuration (name, model,
+instructions and tools) once per process and finds it again by a hash of that
+configuration. The thread registry keeps one thread per conversation, keyed by
+the sender id of the tracker, so follow-up questions continue the same thread.
+A thread takes no messages while a run on it is active, so the questions of a
+conversation take turns, see ThreadRegistry.question().
+
+The client is the shared openai.OpenAI(), which honours OPENAI_BASE_URL, e.g.
+to run against the stub server of debugging/stub_openai.py.
+"""
+
+import hashlib
+import json
+import os
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import Any, Dict, List, Optional
+
+from actions.utils.lazy import lazy_import, lazy_object
+
+openai = lazy_import("openai")
+
+# assistant configurations and conversation threads kept per process
+ASSISTANT_CACHE_SIZE = int(os.environ.get("INSIGHTS_GPT_ASSISTANT_CACHE_SIZE", "256"))
+THREAD_CACHE_SIZE = int(os.environ.get("INSIGHTS_GPT_THREAD_CACHE_SIZE", "1024"))
+
+# built on the first question, not when the action server starts
+client = lazy_object(lambda: openai.OpenAI(), "openai client", warm_up=False)
+
+
+def assistant_key(
+    name: str, model: str, instructions: str, tools: Optional[List[Dict]] = None
+) -> str:
+    """
+    Hash of an assistant configuration, equal for equal instructions and tools.
+    """
+    configuration = json.dumps(
+        {
+            "name": name,
+            "model": model,
+            "instructions": instructions,
+            "tools": tools or [],
+        },
+        sort_keys=True,
+    )
+    return hashlib.blake2b(configuration.encode(), digest_size=16).hexdigest()
+
+
+class _Registry:
+    """
+    Process wide LRU of API objects by key, the least recently used ones are
+    forgotten beyond max_size. The objects themselves are left on the server.
+    """
+
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _get(self, key) -> Any:
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                return self._entries[key]
+        return None
+
+    def _put(self, key, value) -> Any:
+        with self._lock:
+            # a concurrent request may have created one meanwhile, keep the first
+            value = self._entries.setdefault(key, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+            return value
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+
+class AssistantRegistry(_Registry):
+    """
+    Assistants by the hash of their configuration, created on first use.
+    """
+
+    def __init__(self, max_size: int = ASSISTANT_CACHE_SIZE):
+        super().__init__(max_size)
+
+    def get(
+        self,
+        name: str,
+        model: str,
+        instructions: str,
+        tools: Optional[List[Dict]] = None,
+        api=None,
+    ):
+        key = assistant_key(name, model, instructions, tools)
+        assistant = self._get(key)
+        if assistant is None:
+            api = api or client
+            assistant = api.beta.assistants.create(
+                name=name,
+                model=model,
+                instructions=instructions,
+                tools=tools or [],
+                metadata={"configuration": key},
+            )
+            assistant = self._put(key, assistant)
+        return assistant
+
+
+class ThreadRegistry(_Registry):
+    """
+    One thread per conversation and assistant, so follow-ups keep their
+    context. Without a conversation id every call gets a new thread.
+    """
+
+    def __init__(self, max_size: int = THREAD_CACHE_SIZE):
+        super().__init__(max_size)
+        # per thread key the lock of the question asked and the number of
+        # questions holding or waiting for it
+        self._turns: Dict[tuple, list] = {}
+
+    def get(self, conversation_id: Optional[str], assistant, api=None):
+        api = api or client
+        if conversation_id is None:
+            return api.beta.threads.create()
+        key = (conversation_id, assistant.id)
+        thread = self._get(key)
+        if thread is None:
+            thread = self._put(key, api.beta.threads.create())
+        return thread
+
+    @contextmanager
+    def question(self, conversation_id: Optional[str], assistant, content, api=None):
+        """
+        Posts content to the thread of the conversation and yields the thread
+        to run the assistant on, until the run is done no other question of the
+        conversation gets to it. A thread stuck with an active run, e.g. after
+        a stream broke off, is given up for a new one.
+        """
+        api = api or client
+        with self._turn((conversation_id, assistant.id)):
+            thread = self.get(conversation_id, assistant, api)
+            try:
+                api.beta.threads.messages.create(
+                    thread_id=thread.id, role="user", content=content
+                )
+            except openai.BadRequestError as e:
+                if conversation_id is None or "active" not in str(e):
+                    raise e
+                print(
+                    f"Thread {thread.id} of conversation {conversation_id} has an "
+                    f"active run, continuing in a new thread: {e}"
+                )
+                with self._lock:
+                    self._entries.pop((conversation_id, assistant.id), None)
+                thread = self.get(conversation_id, assistant, api)
+                api.beta.threads.messages.create(
+                    thread_id=thread.id, role="user", content=content
+                )
+            yield thread
+
+    @contextmanager
+    def _turn(self, key):
+        if key[0] is None:
+            # a new thread for every question, nothing to wait for
+            yield
+            return
+        with self._lock:
+            turn = self._turns.setdefault(key, [threading.Lock(), 0])
+            turn[1] += 1
+        try:
+            with turn[0]:
+                yield
+        finally:
+            with self._lock:
+                turn[1] -= 1
+                if not turn[1]:
+                    del self._turns[key]
+
+    def forget(self, conversation_id: str):
+        """
+        Starts the next question of the conversation in a new thread.
+        """
+        with self._lock:
+            for key in [key for key in self._entries if key[0] == conversation_id]:
+                del self._entries[key]
+
+
+assistants = AssistantRegistry()
+threads = ThreadRegistry()
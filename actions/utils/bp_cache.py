@@ -0,0 +1,134 @@
+import os
+import threading
+import time
+from collections import OrderedDict
+
+import numpy as np
+
+from actions.utils.db_utils import DBHandler
+from actions.utils.series import BloodPressureSeries
+
+# upper bound for the cached series of all patients together, 0 disables the cache
+CACHE_MAX_BYTES = int(os.environ.get("INSIGHTS_BP_CACHE_MAX_BYTES", str(64 * 2**20)))
+# seconds a cached series is served without asking the database for new readings
+CACHE_REFRESH_INTERVAL = float(os.environ.get("INSIGHTS_BP_CACHE_REFRESH", "60"))
+
+
+class _Entry:
+    __slots__ = ("series", "last_id", "checked_at")
+
+    def __init__(self, series: BloodPressureSeries, last_id, checked_at: float):
+        self.series = series
+        self.last_id = last_id
+        self.checked_at = checked_at
+
+
+class BloodPressureCache:
+    """
+    Process wide cache of the complete blood pressure series per patient.
+
+    Actions slice the time window they need out of the cached series. Once the
+    refresh interval has passed only the readings inserted since, by their id
+    like the rollups (see actions.utils.rollups), are fetched and merged in by
+    recording time, so readings that arrive late with an older timestamp are
+    picked up as well. Readings changed or deleted afterwards show up only after
+    invalidate(). Least recently used patients are evicted when the cached series
+    exceed max_bytes.
+    """
+
+    def __init__(
+        self,
+        max_bytes: int = CACHE_MAX_BYTES,
+        refresh_interval: float = CACHE_REFRESH_INTERVAL,
+    ):
+        self.max_bytes = max_bytes
+        self.refresh_interval = refresh_interval
+        self._entries = OrderedDict()
+        self._nbytes = 0
+        self._lock = threading.Lock()
+
+    def get(self, user_id) -> BloodPressureSeries:
+        key = str(user_id)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                if time.monotonic() - entry.checked_at < self.refresh_interval:
+                    return entry.series
+        # query outside of the lock, so other patients are not blocked meanwhile
+        checked_at = time.monotonic()
+        db = DBHandler(silent=True)
+        last_id = db.execute_named("series_last_id", (user_id,))[0][0]
+        if last_id is None:
+            series = BloodPressureSeries.empty()
+        elif entry is None or entry.last_id is None:
+            series = db.fetch_series("series_all", (user_id, last_id))
+        elif last_id > entry.last_id:
+            series = merge(
+                entry.series,
+                db.fetch_series("series_after", (user_id, entry.last_id, last_id)),
+            )
+        else:
+            series = entry.series
+        with self._lock:
+            current = self._entries.get(key)
+            # another thread may have refreshed the patient in the meantime
+            if current is not None and _newer_or_equal(current.last_id, last_id):
+                current.checked_at = max(current.checked_at, checked_at)
+                return current.series
+            self._store(key, _Entry(series, last_id, checked_at))
+        return series
+
+    def invalidate(self, user_id=None):
+        """
+        Drops the cached series of a patient, or of all patients without user_id.
+        """
+        with self._lock:
+            if user_id is None:
+                self._entries.clear()
+                self._nbytes = 0
+            else:
+                entry = self._entries.pop(str(user_id), None)
+                if entry is not None:
+                    self._nbytes -= entry.series.nbytes
+
+    @property
+    def nbytes(self) -> int:
+        return self._nbytes
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def _store(self, key: str, entry: _Entry):
+        previous = self._entries.pop(key, None)
+        if previous is not None:
+            self._nbytes -= previous.series.nbytes
+        if entry.series.nbytes > self.max_bytes:
+            return
+        self._entries[key] = entry
+        self._nbytes += entry.series.nbytes
+        while self._nbytes > self.max_bytes:
+            _, evicted = self._entries.popitem(last=False)
+            self._nbytes -= evicted.series.nbytes
+
+
+def merge(
+    series: BloodPressureSeries, newer: BloodPressureSeries
+) -> BloodPressureSeries:
+    """
+    series with the readings of newer, both oldest first, ordered by recording
+    time. Readings recorded at the same time keep series first.
+    """
+    if not len(newer):
+        return series
+    merged = BloodPressureSeries.concatenate(series, newer)
+    if not len(series) or newer.recorded_at[0] >= series.recorded_at[-1]:
+        return merged
+    return merged[np.argsort(merged.recorded_at, kind="stable")]
+
+
+def _newer_or_equal(last_id, other_id) -> bool:
+    return other_id is None or (last_id is not None and last_id >= other_id)
+
+
+blood_pressure_cache = BloodPressureCache()
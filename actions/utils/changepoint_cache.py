@@ -0,0 +1,180 @@
+import os
+import threading
+from collections import OrderedDict
+from typing import List, Optional
+
+import numpy as np
+
+from actions.utils.changepoints import (
+    JUMP,
+    MIN_SIZE,
+    L2Cost,
+    detect_changepoints,
+    update_tail,
+)
+
+# number of (patient, signal) states kept in memory, 0 disables the cache
+CHANGEPOINT_CACHE_SIZE = int(os.environ.get("INSIGHTS_CHANGEPOINT_CACHE_SIZE", "256"))
+# full search once the tail segments cost more per reading than this multiple of
+# the average cost per reading of the last full search
+CHANGEPOINT_TAIL_THRESHOLD = float(
+    os.environ.get("INSIGHTS_CHANGEPOINT_TAIL_THRESHOLD", "1.5")
+)
+
+
+class _State:
+    __slots__ = ("cost", "bkps", "recorded_at", "reference", "search")
+
+    def __init__(self, cost, bkps, recorded_at, reference, search):
+        self.cost = cost
+        self.bkps = bkps
+        self.recorded_at = recorded_at
+        self.reference = reference
+        self.search = search
+
+
+class ChangepointCache:
+    """
+    Process wide changepoint state per patient and signal: the cumulative sums of
+    the cost, the last breakpoints and the recording times of the readings they
+    cover.
+
+    If the window of the signal only moved on since the last call, i.e. new
+    readings were appended and, for a rolling window like the last 3 months, the
+    oldest ones dropped out, the sums are sliced and continued, the breakpoints
+    shifted and only the last one is placed again (see changepoints.update_tail).
+    A full search runs for new patients, a window that starts earlier, after
+    known readings changed, when the first segment gets shorter than min_size
+    and once the tail, the two segments around the moved breakpoint, costs more
+    per reading than tail_threshold times the average of the last full search.
+    That indicates a new regime the earlier breakpoints may have to move for.
+    """
+
+    def __init__(
+        self,
+        size: int = CHANGEPOINT_CACHE_SIZE,
+        tail_threshold: float = CHANGEPOINT_TAIL_THRESHOLD,
+    ):
+        self.size = size
+        self.tail_threshold = tail_threshold
+        self._states = OrderedDict()
+        self._lock = threading.Lock()
+
+    def breakpoints(
+        self,
+        user_id,
+        key: str,
+        signal,
+        recorded_at,
+        n_bkps: Optional[int] = None,
+        pen: Optional[float] = None,
+        backend: Optional[str] = None,
+        min_size: int = MIN_SIZE,
+        jump: int = JUMP,
+    ) -> List[int]:
+        """
+        detect_changepoints() of signal, whose readings were recorded at the
+        ascending recorded_at. key tells apart the signals of a patient, e.g. the
+        type of the values.
+        """
+        signal = np.asarray(signal)
+        recorded_at = np.asarray(recorded_at, dtype="datetime64[us]")
+        search = (n_bkps, pen, backend, min_size, jump)
+        state_key = (str(user_id), key)
+        with self._lock:
+            state = self._states.get(state_key)
+            if state is not None:
+                self._states.move_to_end(state_key)
+
+        bkps = None
+        dropped = self._dropped(state, recorded_at, search)
+        shifted = None
+        if dropped is not None:
+            shifted = self._shift(state.bkps, dropped, min_size, jump)
+        if shifted is not None:
+            kept = state.cost.n_samples - dropped
+            if not dropped and kept == len(signal):
+                return list(state.bkps)
+            cost = state.cost.drop_head(dropped) if dropped else state.cost
+            if kept < len(signal):
+                cost = cost.extend(signal[kept:])
+            tail = update_tail(cost, shifted + [cost.n_samples], min_size, jump)
+            # the re-evaluated tail: the segments before and after the moved breakpoint
+            starts = ([0] + tail[:-1])[-2:]
+            ends = tail[-2:]
+            tail_cost = float(cost.error(starts, ends).sum())
+            if tail_cost / (ends[-1] - starts[0]) <= (
+                self.tail_threshold * state.reference
+            ):
+                bkps, reference = tail, state.reference
+        if bkps is None:
+            cost = L2Cost(signal)
+            bkps = detect_changepoints(
+                cost,
+                n_bkps=n_bkps,
+                pen=pen,
+                backend=backend,
+                min_size=min_size,
+                jump=jump,
+            )
+            reference = cost.sum_of_costs(bkps) / max(cost.n_samples, 1)
+
+        if len(recorded_at) and self.size > 0:
+            with self._lock:
+                self._states[state_key] = _State(
+                    cost, bkps, recorded_at, reference, search
+                )
+                self._states.move_to_end(state_key)
+                while len(self._states) > self.size:
+                    self._states.popitem(last=False)
+        return list(bkps)
+
+    def invalidate(self, user_id=None):
+        """
+        Drops the states of a patient, or of all patients without user_id.
+        """
+        with self._lock:
+            if user_id is None:
+                self._states.clear()
+            else:
+                for state_key in [k for k in self._states if k[0] == str(user_id)]:
+                    del self._states[state_key]
+
+    def __len__(self) -> int:
+        return len(self._states)
+
+    @staticmethod
+    def _dropped(state: Optional[_State], recorded_at, search) -> Optional[int]:
+        """
+        How many of the oldest readings of state recorded_at no longer starts
+        with, if it continues the rest of them with newer ones only, else None.
+        """
+        if state is None or state.search != search or not len(recorded_at):
+            return None
+        known = state.recorded_at
+        dropped = int(np.searchsorted(known, recorded_at[0]))
+        kept = len(known) - dropped
+        if kept <= 0 or kept > len(recorded_at):
+            return None
+        if not np.array_equal(recorded_at[:kept], known[dropped:]):
+            return None
+        if kept < len(recorded_at) and recorded_at[kept] <= known[-1]:
+            return None
+        return dropped
+
+    @staticmethod
+    def _shift(bkps, dropped: int, min_size: int, jump: int) -> Optional[List[int]]:
+        """
+        The inner breakpoints of bkps after the first dropped points fell out of
+        the window, rounded down to multiples of jump. None if a segment would
+        get shorter than min_size.
+        """
+        shifted = [(bkp - dropped) // jump * jump for bkp in bkps[:-1]]
+        ends = shifted + [bkps[-1] - dropped]
+        lengths = np.diff([0] + ends)
+        if len(lengths) and lengths.min() < min_size:
+            return None
+        return shifted
+
+
+changepoint_cache = ChangepointCache()
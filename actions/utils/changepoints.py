@@ -0,0 +1,350 @@
+"""
+Changepoint detection on blood pressure series.
+
+All searches minimise the L2 cost, the squared error of every segment around its
+mean. It is evaluated in O(1) per segment, and for whole arrays of segments at
+once, from cumulative sums of the signal and of its squares:
+
+    cost(a, b) = sum(x[a:b] ** 2) - sum(x[a:b]) ** 2 / (b - a)
+
+A signal may have several channels, e.g. systolic and diastolic values as two
+columns, whose costs are added up.
+
+Breakpoints follow the ruptures convention: the sorted end indices of the
+segments, the last one being len(signal). Like in ruptures, breakpoints are
+multiples of jump and every segment has at least min_size points.
+
+Backends:
+
+dynp      exact optimum for a fixed number of breakpoints. Same admissible
+          breakpoints and tie breaking as ruptures.Dynp, vectorised over all
+          segment ends instead of a memoised recursion.
+binseg    greedy binary segmentation, as ruptures.Binseg
+pelt      exact optimum for a penalty, with pruning, as ruptures.Pelt. For a
+          fixed number of breakpoints the penalty is searched.
+ruptures  ruptures.Dynp (or ruptures.Pelt with pen) itself, for comparison
+"""
+
+import math
+import os
+from typing import Callable, Dict, List, Optional
+
+import numpy as np
+
+MIN_SIZE = int(os.environ.get("INSIGHTS_CHANGEPOINT_MIN_SIZE", "10"))
+JUMP = int(os.environ.get("INSIGHTS_CHANGEPOINT_JUMP", "2"))
+# one of BACKENDS
+CHANGEPOINT_BACKEND = os.environ.get("INSIGHTS_CHANGEPOINT_BACKEND", "dynp")
+
+# upper bound for the number of cost matrix entries evaluated at once
+_BLOCK_ENTRIES = 2**21
+# bisection steps of the penalty search of pelt for a fixed number of breakpoints
+_PENALTY_STEPS = 40
+
+
+class L2Cost:
+    """
+    L2 segment cost of a signal with one or more channels (columns).
+    """
+
+    __slots__ = (
+        "signal",
+        "n_samples",
+        "_offset",
+        "_sums",
+        "_squares",
+        "_total_squares",
+    )
+
+    def __init__(self, signal):
+        self.signal = np.asarray(signal)
+        values = self.signal.astype(np.float64)
+        if values.ndim == 1:
+            values = values.reshape(-1, 1)
+        # centering keeps the cumulative sums small and the differences exact
+        self._offset = values.mean(axis=0)
+        values = values - self._offset
+        self.n_samples = len(values)
+        # one row per channel, so every channel is a contiguous array
+        self._sums = np.zeros((values.shape[1], self.n_samples + 1))
+        np.cumsum(values.T, axis=1, out=self._sums[:, 1:])
+        self._squares = np.zeros_like(self._sums)
+        np.cumsum(values.T**2, axis=1, out=self._squares[:, 1:])
+        # the squares only enter the cost summed over the channels
+        self._total_squares = self._squares.sum(axis=0)
+
+    def extend(self, signal) -> "L2Cost":
+        """
+        Cost of this signal followed by signal, continuing the cumulative sums.
+        """
+        signal = np.asarray(signal)
+        values = signal.astype(np.float64).reshape(len(signal), -1) - self._offset
+        cost = L2Cost.__new__(L2Cost)
+        cost.signal = np.concatenate([self.signal, signal])
+        cost.n_samples = self.n_samples + len(signal)
+        cost._offset = self._offset
+        cost._sums = np.concatenate(
+            [self._sums, self._sums[:, -1:] + np.cumsum(values.T, axis=1)], axis=1
+        )
+        cost._squares = np.concatenate(
+            [self._squares, self._squares[:, -1:] + np.cumsum(values.T**2, axis=1)],
+            axis=1,
+        )
+        cost._total_squares = cost._squares.sum(axis=0)
+        return cost
+
+    def drop_head(self, count: int) -> "L2Cost":
+        """
+        Cost of this signal without its first count points. The costs only use
+        differences of the cumulative sums, so these are sliced, not recomputed.
+        """
+        cost = L2Cost.__new__(L2Cost)
+        cost.signal = self.signal[count:]
+        cost.n_samples = self.n_samples - count
+        cost._offset = self._offset
+        cost._sums = self._sums[:, count:]
+        cost._squares = self._squares[:, count:]
+        cost._total_squares = self._total_squares[count:]
+        return cost
+
+    @property
+    def n_channels(self) -> int:
+        return len(self._sums)
+
+    def channel(self, index: int) -> "L2Cost":
+        """
+        Cost of a single channel, sharing the cumulative sums of this cost.
+        """
+        cost = L2Cost.__new__(L2Cost)
+        cost.signal = self.signal[:, index] if self.signal.ndim > 1 else self.signal
+        cost.n_samples = self.n_samples
+        cost._offset = self._offset[index : index + 1]
+        cost._sums = self._sums[index : index + 1]
+        cost._squares = self._squares[index : index + 1]
+        cost._total_squares = self._squares[index]
+        return cost
+
+    def error(self, start, end):
+        """
+        Cost of the segments [start, end), elementwise for arrays. Empty segments
+        cost 0.
+        """
+        start = np.asarray(start)
+        end = np.asarray(end)
+        spread = 0.0
+        for sums in self._sums:
+            difference = sums[end] - sums[start]
+            spread = spread + difference * difference
+        squares = self._total_squares[end] - self._total_squares[start]
+        return squares - spread / np.maximum(end - start, 1)
+
+    def sum_of_costs(self, bkps) -> float:
+        starts = np.concatenate(([0], bkps[:-1]))
+        return float(self.error(starts, np.asarray(bkps)).sum())
+
+
+def min_samples(n_bkps: int, min_size: int = MIN_SIZE, jump: int = JUMP) -> int:
+    """
+    The fewest points that allow n_bkps breakpoints, n_bkps + 1 segments of at
+    least min_size points starting at multiples of jump.
+    """
+    return n_bkps * math.ceil(min_size / jump) * jump + min_size
+
+
+def _sanity_check(n_samples: int, n_bkps: int, jump: int, min_size: int) -> bool:
+    """
+    Whether n_bkps breakpoints fit into n_samples points, as ruptures.utils.sanity_check.
+    """
+    if n_bkps > n_samples // jump:
+        return False
+    return min_samples(n_bkps, min_size, jump) <= n_samples
+
+
+def dynp(cost: L2Cost, n_bkps: int, pen=None, min_size=MIN_SIZE, jump=JUMP):
+    n_samples = cost.n_samples
+    if n_bkps is None or not _sanity_check(n_samples, n_bkps, jump, min_size):
+        raise ValueError(f"{n_samples} points do not allow {n_bkps} breakpoints.")
+    grid = np.arange(0, n_samples, jump)
+    # best[i] is the minimal cost of [0, grid[i]) split into k + 1 segments
+    best = np.where(grid >= min_size, cost.error(0, grid), np.inf)
+    choices = []
+    for k in range(1, n_bkps + 1):
+        ends = grid if k < n_bkps else np.array([n_samples])
+        # breakpoints that leave room for k - 1 breakpoints before them
+        admissible = (grid // jump >= k - 1) & (
+            (k - 1) * math.ceil(min_size / jump) * jump + min_size <= grid
+        )
+        previous = np.where(admissible, best, np.inf)
+        best = np.full(len(ends), np.inf)
+        choice = np.zeros(len(ends), dtype=np.intp)
+        block = max(1, _BLOCK_ENTRIES // len(grid))
+        for first in range(0, len(ends), block):
+            block_ends = ends[first : first + block]
+            # only breakpoints at least min_size before the last end of the block
+            width = np.searchsorted(grid, block_ends[-1] - min_size, side="right")
+            if not width:
+                continue
+            candidates = grid[:width]
+            total = previous[:width] + cost.error(candidates, block_ends[:, None])
+            total[candidates > block_ends[:, None] - min_size] = np.inf
+            # argmin takes the first minimum, the smallest breakpoint like Dynp
+            choice[first : first + block] = np.argmin(total, axis=1)
+            best[first : first + block] = total[
+                np.arange(len(block_ends)), choice[first : first + block]
+            ]
+        choices.append(choice)
+    bkps = [n_samples]
+    position = 0
+    for choice in reversed(choices):
+        position = choice[position]
+        bkps.append(int(grid[position]))
+    return sorted(bkps)
+
+
+def binseg(cost: L2Cost, n_bkps=None, pen=None, min_size=MIN_SIZE, jump=JUMP):
+    if n_bkps is None and pen is None:
+        raise ValueError("Either n_bkps or pen is required.")
+    n_samples = cost.n_samples
+    bkps = [n_samples]
+    splits = {}
+    while n_bkps is None or len(bkps) - 1 < n_bkps:
+        for start, end in zip([0] + bkps[:-1], bkps):
+            if (start, end) not in splits:
+                splits[start, end] = _best_split(cost, start, end, min_size, jump)
+        bkp, gain = max(
+            (splits[start, end] for start, end in zip([0] + bkps[:-1], bkps)),
+            key=lambda split: split[1],
+        )
+        if bkp is None or (n_bkps is None and gain <= pen):
+            break
+        bkps = sorted(bkps + [bkp])
+    return bkps
+
+
+def _best_split(cost: L2Cost, start: int, end: int, min_size: int, jump: int):
+    candidates = np.arange(start, end, jump)
+    candidates = candidates[
+        (candidates - start >= min_size) & (end - candidates >= min_size)
+    ]
+    if not len(candidates):
+        return None, 0
+    gains = (
+        cost.error(start, end)
+        - cost.error(start, candidates)
+        - cost.error(candidates, end)
+    )
+    # the last of equal gains, like the tuple comparison of ruptures.Binseg
+    best = len(gains) - 1 - np.argmax(gains[::-1])
+    return int(candidates[best]), float(gains[best])
+
+
+def update_tail(cost: L2Cost, bkps: List[int], min_size=MIN_SIZE, jump=JUMP):
+    """
+    Breakpoints of a signal that grew since bkps were searched on its beginning.
+    Only the last breakpoint is placed again, between its predecessor and the new
+    end, the earlier ones are kept.
+    """
+    inner = list(bkps[:-1])
+    if not inner:
+        return [cost.n_samples]
+    start = inner[-2] if len(inner) > 1 else 0
+    bkp, _ = _best_split(cost, start, cost.n_samples, min_size, jump)
+    return inner[:-1] + [inner[-1] if bkp is None else bkp, cost.n_samples]
+
+
+def pelt(cost: L2Cost, n_bkps=None, pen=None, min_size=MIN_SIZE, jump=JUMP):
+    if pen is not None:
+        return _pelt(cost, pen, min_size, jump)
+    if n_bkps is None:
+        raise ValueError("Either n_bkps or pen is required.")
+    # more breakpoints the lower the penalty, bisect it on a log scale between no
+    # penalty and the cost of the whole signal, where no breakpoint pays off
+    low, high = 1e-9, max(float(cost.error(0, cost.n_samples)), 1.0)
+    closest = _pelt(cost, high, min_size, jump)
+    for _ in range(_PENALTY_STEPS):
+        penalty = math.sqrt(low * high)
+        bkps = _pelt(cost, penalty, min_size, jump)
+        if abs(len(bkps) - 1 - n_bkps) < abs(len(closest) - 1 - n_bkps):
+            closest = bkps
+        if len(bkps) - 1 == n_bkps:
+            return bkps
+        if len(bkps) - 1 > n_bkps:
+            low = penalty
+        else:
+            high = penalty
+    return closest
+
+
+def _pelt(cost: L2Cost, pen: float, min_size: int, jump: int) -> List[int]:
+    n_samples = cost.n_samples
+    ends = [k for k in range(0, n_samples, jump) if k >= min_size] + [n_samples]
+    # best[t] is the minimal penalised cost of [0, t), NaN where [0, t) can not be split
+    best = np.full(n_samples + 1, np.nan)
+    best[0] = 0.0
+    previous = np.zeros(n_samples + 1, dtype=np.intp)
+    admissible = np.empty(0, dtype=np.intp)
+    for end in ends:
+        admissible = np.append(admissible, (end - min_size) // jump * jump)
+        starts = admissible[~np.isnan(best[admissible])]
+        totals = best[starts] + cost.error(starts, end) + pen
+        position = np.argmin(totals)
+        best[end] = totals[position]
+        previous[end] = starts[position]
+        admissible = starts[totals <= best[end] + pen]
+    bkps = [n_samples]
+    while previous[bkps[-1]]:
+        bkps.append(int(previous[bkps[-1]]))
+    return sorted(bkps)
+
+
+def _ruptures(cost: L2Cost, n_bkps=None, pen=None, min_size=MIN_SIZE, jump=JUMP):
+    import ruptures as rpt
+
+    if n_bkps is None:
+        algo = rpt.Pelt(model="l2", min_size=min_size, jump=jump)
+        return algo.fit(cost.signal).predict(pen=pen)
+    algo = rpt.Dynp(model="l2", min_size=min_size, jump=jump)
+    return algo.fit(cost.signal).predict(n_bkps=n_bkps)
+
+
+BACKENDS: Dict[str, Callable[..., List[int]]] = {
+    "dynp": dynp,
+    "binseg": binseg,
+    "pelt": pelt,
+    "ruptures": _ruptures,
+}
+
+
+def detect_changepoints(
+    signal,
+    n_bkps: Optional[int] = None,
+    pen: Optional[float] = None,
+    backend: Optional[str] = None,
+    min_size: int = MIN_SIZE,
+    jump: int = JUMP,
+    per_channel: bool = False,
+):
+    """
+    Breakpoints of signal, the last one being len(signal). Either n_bkps
+    breakpoints or as many as pay off against the penalty pen.
+
+    A signal with several channels (columns) is segmented jointly: one search
+    whose breakpoints are shared by all channels. With per_channel a list of
+    breakpoints per channel is returned instead, the searches share the
+    cumulative sums.
+    """
+    backend = backend or CHANGEPOINT_BACKEND
+    if backend not in BACKENDS:
+        raise ValueError(
+            f"Unknown changepoint backend {backend}, use one of {', '.join(BACKENDS)}."
+        )
+    cost = signal if isinstance(signal, L2Cost) else L2Cost(signal)
+    search = BACKENDS[backend]
+    if per_channel:
+        return [
+            search(
+                cost.channel(i), n_bkps=n_bkps, pen=pen, min_size=min_size, jump=jump
+            )
+            for i in range(cost.n_channels)
+        ]
+    return search(cost, n_bkps=n_bkps, pen=pen, min_size=min_size, jump=jump)
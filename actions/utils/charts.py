@@ -0,0 +1,427 @@
+"""
+The charts of the actions, drawn with the pyplot state of the calling process.
+
+Every chart takes columnar data (a dict of equally long arrays) and keyword
+options and draws one figure. They are run by the rendering workers of
+actions.utils.plots, which save the figure as PNG; use plots.submit() instead
+of calling them directly.
+"""
+
+from typing import Dict
+
+import numpy as np
+
+from actions.utils.lazy import lazy_import
+from actions.utils.trend import run_bounds, segment_trends
+
+# imported by the plot workers only, after the Agg backend is selected
+mpatches = lazy_import("matplotlib.patches", warm_up=False)
+transforms = lazy_import("matplotlib.transforms", warm_up=False)
+sns = lazy_import("seaborn", warm_up=False)
+plt = lazy_import("matplotlib.pyplot", warm_up=False)
+pd = lazy_import("pandas")
+
+
+def trends(data: Dict[str, np.ndarray], systolic_span, diastolic_span, change_date):
+    """
+    Readings of the last months with a trend line per month, ActionTrends.
+    """
+    bp_data = pd.DataFrame(data)
+    bp_data["Datum_num"] = (bp_data["Datum"] - bp_data["Datum"].min()).dt.days
+    bp_data["Month"] = bp_data["Datum"].dt.month
+
+    plt.figure(figsize=(12, 8))
+
+    # Scatter plot for Systolisch
+    sns.scatterplot(
+        data=bp_data, x="Datum_num", y="Systolisch", color="red", legend=False
+    )
+
+    # Regression lines for Systolisch and Diastolisch by month
+    _, month_bounds = run_bounds(bp_data["Month"].values)
+    plot_monthly_trends(bp_data, "Systolisch", month_bounds, "r", "Systolische Trends")
+
+    # Scatter plot for Diastolic
+    sns.scatterplot(
+        data=bp_data, x="Datum_num", y="Diastolisch", color="blue", legend=False
+    )
+
+    plot_monthly_trends(
+        bp_data, "Diastolisch", month_bounds, "b", "Diastolische Trends"
+    )
+
+    # Add vertical line for the event date
+    if change_date:
+        filtered = bp_data["Datum"] <= change_date
+        if filtered.any():
+            plt.axvline(
+                x=bp_data[filtered].iloc[-1]["Datum_num"],
+                color="black",
+                linestyle="--",
+                label="Änderungsdatum" + f" ({change_date.strftime('%d.%m.%Y')})",
+                linewidth=1,
+            )
+
+    # Add target coridors for systolic and diastolic
+    plt.axhspan(
+        diastolic_span[0],
+        diastolic_span[1],
+        color="green",
+        alpha=0.1,
+        label="Normalbereiche",
+    )
+    plt.axhspan(systolic_span[0], systolic_span[1], color="green", alpha=0.1)
+
+    # Add titles and labels
+    plt.title("Blutdruckentwicklung der letzten 6 Monate")
+    plt.xlabel("Datum")
+    plt.ylabel("Blutdruck Diastolisch und Systolisch (mmHg)")
+    plt.legend()
+
+    # Add x-axis labels
+    xticks = bp_data["Datum_num"]
+    # pretty date labels month and year
+    xlabels = bp_data["Datum"].dt.strftime("%b %Y")
+    # Filter always first appearing date of month if available otherwise next larger
+    xticks = xticks[~xlabels.duplicated(keep="first")]
+    xlabels = xlabels[~xlabels.duplicated(keep="first")]
+    plt.xticks(
+        ticks=xticks,
+        labels=xlabels,
+        rotation=45,
+    )
+    plt.tight_layout()
+
+
+def plot_monthly_trends(bp_data, column, bounds, color, label):
+    x = bp_data["Datum_num"].values
+    segments = segment_trends(x, bp_data[column].values, bounds)
+    for i, (first, end) in enumerate(zip(bounds[:-1], bounds[1:])):
+        plt.plot(
+            [x[first], x[end - 1]],
+            [segments.start[i], segments.end[i]],
+            color=color,
+            label=label if i == 0 else None,
+        )
+
+
+def turning_points(data: Dict[str, np.ndarray], typ, breakpoints, span, change_date):
+    """
+    Readings of one measure with the turning points and the trend line of every
+    segment between them, ActionWendepunkte.
+    """
+    data = pd.DataFrame(data)
+    data["idx"] = range(len(data))
+    color = "red" if typ == "systolisch" else "blue"
+    plt.figure(figsize=(12, 6))
+    sns.scatterplot(data=data, x="idx", y=typ, color=color, label="Messwerte")
+    bounds = [0, *breakpoints, len(data)]
+    # trends per reading for the plotted lines
+    lines = segment_trends(data["idx"].values, data[typ].values, bounds)
+    for i, (first, end) in enumerate(zip(bounds[:-1], bounds[1:])):
+        if first:
+            plt.axvline(
+                x=data["idx"].iloc[first],
+                color=color,
+                linestyle="--",
+                label="Wendepunkt" if i == 1 else None,
+            )
+        plt.plot(
+            [first, end - 1],
+            [lines.start[i], lines.end[i]],
+            color=color,
+            label="Trendlinie" if i == 0 else None,
+        )
+    plt.axhspan(span[0], span[1], color="green", alpha=0.1, label="Normalbereich")
+    if change_date:
+        filtered = data["recorded_at"] <= pd.to_datetime(change_date)
+        if filtered.any():
+            plt.axvline(
+                x=data[filtered].iloc[-1]["idx"],
+                color="g",
+                linestyle="--",
+                label="Änderungsdatum" + f' ({change_date.strftime("%d.%m.%Y")})',
+            )
+    # Adjust x-axis to display datetime values
+    ax = plt.gca()
+    plt.xlabel("Datum")
+    ax.set_xticks(range(0, len(data), 30))  # <--- set the ticks first
+    ax.set_xticklabels(
+        data["recorded_at"][range(0, len(data), 30)].dt.strftime("%Y-%m-%d")
+    )
+    plt.xticks(rotation=45)
+    plt.ylabel(f"{typ.capitalize()}er Wert")
+    plt.title(f"Wendepunkte in den {typ.capitalize()}en Blutdruckwerten")
+    plt.legend(bbox_to_anchor=(1.05, 1), loc="upper left")
+    plt.tight_layout()
+
+
+def outlier_boxplot(
+    data: Dict[str, np.ndarray], typ, period_label, period, span, change_date
+):
+    """
+    Boxplot of one measure per period with its outliers by time of day,
+    ActionDetailsAusreisser. period is the pandas period frequency, e.g. "M".
+    """
+    df = pd.DataFrame(data)
+    df[period_label] = df["Datum"].dt.to_period(period).astype(str)
+    color = "red" if typ == "systolisch" else "blue"
+    plt.figure(figsize=(10, 6))
+    sns.boxplot(x=period_label, y=typ.capitalize(), data=df, color=color)
+    sns.scatterplot(
+        x=period_label,
+        y=typ.capitalize(),
+        data=df[df[f"{typ.capitalize()}e Ausreißer"]],
+        hue="Tageszeit ",
+        color=color,
+    )
+    plt.title(f"{typ.capitalize()}er Blutdruck Boxplot nach {period_label}")
+
+    # highlight target range
+    plt.axhspan(span[0], span[1], color="green", alpha=0.2)
+
+    # rotate x-axis labels
+    plt.xticks(rotation=45)
+
+    if change_date:
+        vline = plt.axvline(
+            x=str(pd.to_datetime(change_date).to_period(period)),
+            color="red",
+            linestyle="--",
+            label="Änderungsdatum" + f" ({change_date.strftime('%d.%m.%Y')})",
+        )
+        ax = plt.gca()
+        trans = transforms.blended_transform_factory(ax.transData, ax.transAxes)
+        vline.set_transform(
+            trans
+            + transforms.ScaledTranslation(-20 / 72.0, 0, plt.gcf().dpi_scale_trans)
+        )
+
+        plt.legend()
+    plt.tight_layout()
+
+
+def daytime_histogram(
+    data: Dict[str, np.ndarray], span, period_label, type_label, daytimes, means
+):
+    """
+    Histogram of one measure per daytime with the target corridor and the means
+    of the morning and the evening, ActionVeraenderungUeberTag. daytimes are the
+    hue categories, means maps the daytimes to their mean.
+    """
+    bp_data = pd.DataFrame(data)
+    plt.figure(figsize=(12, 6))
+    palette = (
+        sns.color_palette("Reds", 3)
+        if type_label == "Systolisch"
+        else sns.color_palette("Blues", 3)
+    )
+    time_categories = list(daytimes)
+    existing_categories = bp_data["Daytime"].unique()
+
+    # Create the histogram with KDE for systolic blood pressure values grouped by daytime side by side
+    sns.histplot(
+        data=bp_data,
+        x=type_label,
+        hue="Daytime",
+        multiple="dodge",
+        kde=True,
+        bins=10,
+        palette=palette,
+        hue_order=time_categories,
+    )
+    handles = [
+        mpatches.Patch(color=palette[i], label=time_categories[i])
+        for i in range(3)
+        if time_categories[i] in existing_categories
+    ]
+    # Add shaded area for target range
+    plt.axvspan(span[0], span[1], color="lightgreen", alpha=0.3, label="Zielkorridor")
+
+    if "Morgen" in means:
+        plt.axvline(means["Morgen"], color=palette[0], linestyle="--")
+        handles.append(
+            mpatches.Patch(color=palette[0], label=f"µ_morgen: {means['Morgen']:.2f}")
+        )
+    if "Abend" in means:
+        plt.axvline(means["Abend"], color=palette[1], linestyle="--")
+        handles.append(
+            mpatches.Patch(color=palette[1], label=f"µ_abend: {means['Abend']:.2f}")
+        )
+
+    # Add titles and labels
+    plt.title(f"Histogramm der {type_label.lower()}en Blutdruckwerte {period_label}")
+    plt.xlabel(f"{type_label}er Blutdruck (mmHg)")
+    plt.ylabel("Frequenz")
+
+    # Use palette and time categories to create custom legend
+    handles.append(mpatches.Patch(color="lightgreen", label="Zielkorridor"))
+    plt.legend(
+        title="Tageszeit",
+        handles=handles,
+        loc="upper left",
+        framealpha=0.3,
+        frameon=True,
+    )
+    plt.tight_layout()
+
+
+def medication_trends(
+    data: Dict[str, np.ndarray], change_date, averages: Dict[str, float]
+):
+    """
+    Readings around a medication change with the trends and averages before and
+    after it, ActionTrendanderungenMedikation. averages holds the keys
+    sys_before, sys_after, dia_before and dia_after.
+    """
+    bp_data = pd.DataFrame(data)
+    bp_data["Date_num"] = (bp_data["Date"] - bp_data["Date"].min()).dt.days
+    plt.figure(figsize=(12, 6))
+
+    sns.scatterplot(
+        data=bp_data,
+        x="Date_num",
+        y="Systolic",
+        hue="Event",
+        style="Event",
+        palette="Reds",
+        markers=["o"],
+        s=20,
+        legend=False,
+    )
+    # trends before and after the change, the readings are sorted by date
+    event_bounds = [0, int((~bp_data["Event"]).sum()), len(bp_data)]
+    plot_trends(bp_data, "Systolic", event_bounds, "red", "Trend Systolisch")
+    plt.axhline(
+        y=averages["sys_before"],
+        color="red",
+        linestyle="--",
+        label=f"Sys. Durch. vorher: {averages['sys_before']:.1f}",
+        alpha=0.5,
+    )
+    plt.axhline(
+        y=averages["sys_after"],
+        color="red",
+        linestyle="--",
+        label=f"Sys. Durch. nachher: {averages['sys_after']:.1f}",
+        alpha=0.5,
+    )
+
+    # Same for diastolic
+    sns.scatterplot(
+        data=bp_data,
+        x="Date_num",
+        y="Diastolic",
+        hue="Event",
+        style="Event",
+        palette="Blues",
+        markers=["o"],
+        s=20,
+        legend=False,
+    )
+    plot_trends(bp_data, "Diastolic", event_bounds, "blue", "Trend Diastolisch")
+    plt.axhline(
+        y=averages["dia_before"],
+        color="blue",
+        linestyle="--",
+        label=f"Dias. Durch. vorher: {averages['dia_before']:.1f}",
+        alpha=0.5,
+    )
+    plt.axhline(
+        y=averages["dia_after"],
+        color="blue",
+        linestyle="--",
+        label=f"Dias. Durch. nachher: {averages['dia_after']:.1f}",
+        alpha=0.5,
+    )
+
+    filters = bp_data["Date"] <= change_date
+    if filters.any():
+        # Add vertical line for the event date
+        plt.axvline(
+            x=bp_data[filters].iloc[-1]["Date_num"],
+            color="black",
+            linestyle="--",
+            label="Änderungsdatum" + f" ({change_date.strftime('%d.%m.%Y')})",
+            linewidth=1,
+        )
+
+    # Add titles and labels
+    plt.title(
+        "Trendänderung im systolischen und diastolischen Blutdruck seit Medikationsänderung"
+    )
+    plt.xlabel("Datum")
+    plt.ylabel("Systolische und Diastolische Werte (mmHg)")
+
+    xticks = bp_data["Date_num"]
+    xlabels = bp_data["Date"].dt.strftime("%Y-%m-%d")
+    plt.xticks(
+        ticks=xticks[:: max(1, int(len(xticks) / 10))],
+        labels=xlabels[:: max(1, int(len(xticks) / 10))],
+        rotation=45,
+    )
+
+    plt.legend(title="Legend", bbox_to_anchor=(1.05, 1), loc="upper left")
+    plt.tight_layout()
+
+
+def plot_trends(bp_data, column, bounds, color, label):
+    x = bp_data["Date_num"].values
+    segments = segment_trends(x, bp_data[column].values, bounds)
+    labelled = False
+    for i, (first, end) in enumerate(zip(bounds[:-1], bounds[1:])):
+        # a line needs at least two readings
+        if end - first < 2:
+            continue
+        plt.plot(
+            [x[first], x[end - 1]],
+            [segments.start[i], segments.end[i]],
+            color=color,
+            label=None if labelled else label,
+        )
+        labelled = True
+
+
+def daytime_scatter(data: Dict[str, np.ndarray], systolic_span, diastolic_span):
+    """
+    Systolic against diastolic values by time of day with marginal densities,
+    ActionAblesungenAusserhalbZielbereich.
+    """
+    df = pd.DataFrame(data)
+
+    # Create scatter plot using seaborn
+    joint_plot = sns.jointplot(
+        data=df,
+        x="Systolic",
+        y="Diastolic",
+        hue="Tageszeit",
+        palette="rocket",
+        alpha=0.6,  # Adjust transparency for better visibility
+        marginal_kws=dict(
+            common_norm=False
+        ),  # Ensure KDE plots are not normalized together
+    )
+
+    # Set the titles and labels
+    joint_plot.set_axis_labels(
+        "Systolisch (mmHg)\nBlutdruckmessungen gruppiert nach Tageszeit",
+        "Diastolisch (mmHg)",
+    )
+
+    # Adding blood pressure spans to the joint plot
+    joint_plot.ax_joint.axvspan(
+        systolic_span[0], systolic_span[1], color="green", alpha=0.1
+    )
+    joint_plot.ax_joint.axhspan(
+        diastolic_span[0], diastolic_span[1], color="green", alpha=0.1
+    )
+
+
+CHARTS = {
+    "trends": trends,
+    "turning_points": turning_points,
+    "outlier_boxplot": outlier_boxplot,
+    "daytime_histogram": daytime_histogram,
+    "medication_trends": medication_trends,
+    "daytime_scatter": daytime_scatter,
+}
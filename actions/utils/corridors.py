@@ -0,0 +1,111 @@
+from datetime import date, datetime
+from functools import lru_cache
+from typing import NamedTuple, Optional, Tuple
+
+import numpy as np
+
+# the pulse corridor does not depend on the patient
+PULSE_RANGE = (60, 100)
+
+# classes of classify(), LABELS[code] is the name used in the messages
+BELOW, WITHIN, ABOVE, UNKNOWN = 0, 1, 2, 3
+LABELS = np.array(["below", "within", "above", "unknown"])
+
+# systolic target per category: <65 with, >=65 with and without pre-existing conditions
+_SYSTOLIC_TARGET = {1: (119, 131), 2: (128, 141), 3: (120, 135)}
+_DIASTOLIC_TARGET = {1: (70, 79), 2: (70, 79), 3: (71, 84)}
+
+# systolic and diastolic span per age bracket, by upper age limit
+_AGE_SPANS = (
+    (18, (90, 120), (60, 80)),
+    (40, (110, 130), (70, 85)),
+    (60, (120, 140), (75, 90)),
+    (None, (130, 150), (80, 95)),
+)
+_DEFAULT_AGE_SPANS = ((120, 130), (80, 85))
+
+
+class Corridor(NamedTuple):
+    """
+    Inclusive (low, high) span per measure.
+    """
+
+    systolic: Tuple[int, int]
+    diastolic: Tuple[int, int]
+    pulse: Tuple[int, int] = PULSE_RANGE
+
+
+def parse_birthday(birthday) -> Optional[date]:
+    if birthday in ("", None):
+        return None
+    if isinstance(birthday, datetime):
+        return birthday.date()
+    if isinstance(birthday, date):
+        return birthday
+    return datetime.strptime(birthday, "%Y-%m-%d").date()
+
+
+# Both resolvers take the current day as argument, so the age of a patient is
+# derived at most once per day and process, no matter how often an action asks.
+
+
+@lru_cache(maxsize=4096)
+def target_corridor(
+    birthday, has_pre_existing_conditions: bool, today: date
+) -> Corridor:
+    """
+    Target corridor by age and pre-existing conditions, see utils.get_bp_range.
+    """
+    category = 3
+    born = parse_birthday(birthday)
+    if born is not None and has_pre_existing_conditions:
+        age = (
+            today.year - born.year - ((today.month, today.day) < (born.month, born.day))
+        )
+        category = 1 if age < 65 else 2
+    return Corridor(_SYSTOLIC_TARGET[category], _DIASTOLIC_TARGET[category])
+
+
+@lru_cache(maxsize=4096)
+def age_corridor(birthday, today: date) -> Tuple[Corridor, str]:
+    """
+    Corridor by age bracket and the age as shown to the user, "unknown" without
+    birthday, see utils.get_blood_pressure_spans.
+    """
+    born = parse_birthday(birthday)
+    if born is None:
+        return Corridor(*_DEFAULT_AGE_SPANS), "unknown"
+    age = (today - born).days // 365
+    for limit, systolic_span, diastolic_span in _AGE_SPANS:
+        if limit is None or age < limit:
+            return Corridor(systolic_span, diastolic_span), str(age)
+
+
+def classify(values, span) -> np.ndarray:
+    """
+    BELOW, WITHIN or ABOVE of every value against the inclusive span, UNKNOWN for
+    missing values. Scalars give a 0-d array.
+    """
+    values = np.asarray(values, dtype=np.float64)
+    return np.where(
+        np.isnan(values),
+        np.int8(UNKNOWN),
+        (values >= span[0]).astype(np.int8) + (values > span[1]),
+    )
+
+
+def class_counts(values, span) -> np.ndarray:
+    """
+    Number of values below, within and above the span and of missing values.
+    """
+    return np.bincount(classify(values, span).ravel(), minlength=len(LABELS))
+
+
+def within(values, span) -> np.ndarray:
+    values = np.asarray(values)
+    return (values >= span[0]) & (values <= span[1])
+
+
+def outside(values, span) -> np.ndarray:
+    values = np.asarray(values)
+    return (values < span[0]) | (values > span[1])
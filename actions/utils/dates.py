@@ -0,0 +1,272 @@
+"""
+Resolution of the German date expressions of the change_date slot.
+
+The common forms are resolved by a few regular expressions, without dateparser:
+
+- dates: "01.03.2024", "1.3.24", "01.03.", "2024-03-01"
+- months: "März", "März 2024", "5. März", "Anfang März", "Ende Mai 2024"
+- relative: "heute", "gestern", "letzte Woche", "letzten Monat", "vor 2 Wochen",
+  "vor einem Jahr"
+
+with an optional "seit", "ab", "am", "im", ... in front. Anything else is left to
+dateparser. Like the former parser, dates without a year are the latest past
+ones and months start at their first day. Relative expressions count from the
+time of the request, not from the start of the action server, and all dates are
+resolved to the start of their day, so a result can be cached for the day.
+"""
+
+import calendar
+import os
+import re
+import threading
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from typing import Optional
+
+from actions.utils.lazy import lazy_import, on_warm_up
+
+dateparser = lazy_import("dateparser")
+
+# resolved expressions kept per day
+DATE_CACHE_SIZE = int(os.environ.get("INSIGHTS_DATE_CACHE_SIZE", "1024"))
+
+MONTHS = {
+    "januar": 1,
+    "jänner": 1,
+    "jan": 1,
+    "februar": 2,
+    "feb": 2,
+    "märz": 3,
+    "maerz": 3,
+    "mär": 3,
+    "mrz": 3,
+    "april": 4,
+    "apr": 4,
+    "mai": 5,
+    "juni": 6,
+    "jun": 6,
+    "juli": 7,
+    "jul": 7,
+    "august": 8,
+    "aug": 8,
+    "september": 9,
+    "sept": 9,
+    "sep": 9,
+    "oktober": 10,
+    "okt": 10,
+    "november": 11,
+    "nov": 11,
+    "dezember": 12,
+    "dez": 12,
+}
+NUMBERS = {
+    "ein": 1,
+    "eine": 1,
+    "einem": 1,
+    "einen": 1,
+    "einer": 1,
+    "eins": 1,
+    "zwei": 2,
+    "drei": 3,
+    "vier": 4,
+    "fünf": 5,
+    "sechs": 6,
+    "sieben": 7,
+    "acht": 8,
+    "neun": 9,
+    "zehn": 10,
+    "elf": 11,
+    "zwölf": 12,
+}
+DAYS_AGO = {"heute": 0, "gestern": 1, "vorgestern": 2}
+
+_MONTH = "(" + "|".join(sorted(MONTHS, key=len, reverse=True)) + r")\.?"
+_PREFIX = re.compile(r"^(?:seit|ab|am|im|vom|von|dem|den|der)\s+")
+_ISO = re.compile(r"^(\d{4})-(\d{1,2})-(\d{1,2})$")
+_NUMERIC = re.compile(r"^(\d{1,2})\.(\d{1,2})\.(\d{4}|\d{2})?$")
+_DAY_MONTH = re.compile(r"^(\d{1,2})\.?\s*" + _MONTH + r"(?:\s+(\d{4}))?$")
+_MONTH_NAME = re.compile(r"^(?:(anfang|mitte|ende)\s+)?" + _MONTH + r"(?:\s+(\d{4}))?$")
+_LAST = re.compile(
+    r"^(?:letzte|letzten|letzter|letztes|vorige|vorigen|voriges|vergangene"
+    r"|vergangenen|vergangenes)\s+(woche|monat|jahr)$"
+)
+_AGO = re.compile(
+    r"^(?:vor\s+)?(\d+|" + "|".join(NUMBERS) + r")\s+"
+    r"(tag|tage|tagen|woche|wochen|monat|monate|monaten|jahr|jahre|jahren)$"
+)
+
+
+def normalize(text: str) -> str:
+    """
+    Lower case, single spaces and without the prepositions in front.
+    """
+    text = " ".join(text.lower().split()).rstrip(",;!?")
+    while True:
+        stripped = _PREFIX.sub("", text)
+        if stripped == text:
+            return text
+        text = stripped
+
+
+def months_ago(day: datetime, months: int) -> datetime:
+    """
+    The same day months earlier, the last day of the month if it is shorter.
+    """
+    index = day.year * 12 + day.month - 1 - months
+    year, month = divmod(index, 12)
+    month += 1
+    return day.replace(
+        year=year, month=month, day=min(day.day, calendar.monthrange(year, month)[1])
+    )
+
+
+def _date(year: int, month: int, day: int) -> Optional[datetime]:
+    try:
+        return datetime(year, month, day)
+    except ValueError:
+        return None
+
+
+def _full_year(year: str, today: datetime) -> int:
+    if len(year) == 4:
+        return int(year)
+    # two digits like dateparser: this century unless that is in the future
+    full = 2000 + int(year)
+    return full if full <= today.year else full - 100
+
+
+def _ago(today: datetime, count: int, unit: str) -> datetime:
+    if unit.startswith("tag"):
+        return today - timedelta(days=count)
+    if unit.startswith("woche"):
+        return today - timedelta(weeks=count)
+    if unit.startswith("monat"):
+        return months_ago(today, count)
+    return months_ago(today, 12 * count)
+
+
+def resolve_fast(text: str, today: datetime) -> Optional[datetime]:
+    """
+    The date of a normalized expression with the common forms, None if it is
+    none of them. today is the start of the current day.
+    """
+    if text in DAYS_AGO:
+        return today - timedelta(days=DAYS_AGO[text])
+    match = _ISO.match(text)
+    if match:
+        return _date(*map(int, match.groups()))
+    match = _NUMERIC.match(text)
+    if match:
+        day, month, year = match.groups()
+        if year:
+            return _date(_full_year(year, today), int(month), int(day))
+        resolved = _date(today.year, int(month), int(day))
+        # the latest past one
+        if resolved is not None and resolved > today:
+            resolved = _date(today.year - 1, int(month), int(day))
+        return resolved
+    match = _DAY_MONTH.match(text)
+    if match:
+        day, month, year = match.groups()
+        if year:
+            return _date(int(year), MONTHS[month], int(day))
+        resolved = _date(today.year, MONTHS[month], int(day))
+        if resolved is not None and resolved > today:
+            resolved = _date(today.year - 1, MONTHS[month], int(day))
+        return resolved
+    match = _MONTH_NAME.match(text)
+    if match:
+        part, month, year = match.groups()
+        month = MONTHS[month]
+        if year:
+            year = int(year)
+        else:
+            year = today.year if month <= today.month else today.year - 1
+        last = calendar.monthrange(year, month)[1]
+        return datetime(
+            year, month, {None: 1, "anfang": 1, "mitte": 15}.get(part, last)
+        )
+    match = _LAST.match(text)
+    if match:
+        return _ago(today, 1, match.group(1))
+    match = _AGO.match(text)
+    if match:
+        count, unit = match.groups()
+        return _ago(today, int(count) if count.isdigit() else NUMBERS[count], unit)
+    return None
+
+
+def resolve_with_dateparser(text: str, now: datetime) -> Optional[datetime]:
+    resolved = dateparser.parse(
+        text,
+        languages=["de"],
+        settings={
+            "PREFER_DATES_FROM": "past",
+            "PREFER_DAY_OF_MONTH": "first",
+            "DATE_ORDER": "DMY",
+            "RELATIVE_BASE": now,
+        },
+    )
+    if resolved is None:
+        return None
+    return resolved.replace(hour=0, minute=0, second=0, microsecond=0, tzinfo=None)
+
+
+class DateResolver:
+    """
+    Process wide memo of resolved date expressions by normalized text and day,
+    the least recently used ones are evicted beyond max_size.
+    """
+
+    def __init__(self, max_size: int = DATE_CACHE_SIZE):
+        self.max_size = max_size
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def resolve(self, text: str, now: Optional[datetime] = None) -> Optional[datetime]:
+        """
+        The date of text as datetime at the start of its day, None if it is no
+        date. Relative expressions count from now, the time of the request by
+        default.
+        """
+        if not text:
+            return None
+        now = now or datetime.now()
+        today = now.replace(hour=0, minute=0, second=0, microsecond=0)
+        normalized = normalize(text)
+        key = (normalized, today)
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                return self._entries[key]
+        resolved = resolve_fast(normalized, today)
+        if resolved is None:
+            resolved = resolve_with_dateparser(normalized, now)
+        with self._lock:
+            self._entries[key] = resolved
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+        return resolved
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+
+date_resolver = DateResolver()
+
+
+def resolve_date(text: str, now: Optional[datetime] = None) -> Optional[datetime]:
+    """
+    See DateResolver.resolve.
+    """
+    return date_resolver.resolve(text, now)
+
+
+@on_warm_up
+def load_date_locale():
+    # dateparser loads its German locale on the first parse
+    resolve_with_dateparser("1. Januar 2024", datetime.now())
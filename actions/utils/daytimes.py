@@ -0,0 +1,88 @@
+from typing import Dict, Optional, Tuple
+
+import numpy as np
+
+
+class Daytimes:
+    """
+    Split of the day into labelled hour ranges [start, end). A range may wrap
+    around midnight, e.g. (22, 6). Hours outside all ranges get the label other.
+
+    codes() maps the readings to the index of their label in labels, with one
+    searchsorted over the hour boundaries, so the codes can be used to group
+    the readings, e.g. with stats.grouped_stats.
+    """
+
+    __slots__ = ("ranges", "other", "labels", "_boundaries", "_codes")
+
+    def __init__(self, ranges: Dict[str, Tuple[int, int]], other: Optional[str] = None):
+        self.ranges = dict(ranges)
+        self.other = other
+        self.labels = tuple(self.ranges) + ((other,) if other is not None else ())
+        self._boundaries = np.array(
+            sorted({h for bounds in self.ranges.values() for h in bounds} - {0, 24}),
+            dtype=np.int64,
+        )
+        # code of every interval between two boundaries
+        starts = np.concatenate(([0], self._boundaries))
+        codes = np.full(len(starts), -1, dtype=np.int8)
+        for code, (start, end) in enumerate(self.ranges.values()):
+            if not (0 <= start < 24 and 0 < end <= 24 and start != end):
+                raise ValueError(f"Invalid daytime range {start}-{end}.")
+            covered = (
+                (start <= starts) & (starts < end)
+                if start < end
+                else (start <= starts) | (starts < end)
+            )
+            if (codes[covered] >= 0).any():
+                raise ValueError(f"Daytime range {start}-{end} overlaps another.")
+            codes[covered] = code
+        if (codes < 0).any():
+            if other is None:
+                raise ValueError("The daytime ranges do not cover the day.")
+            codes[codes < 0] = len(self.labels) - 1
+        self._codes = codes
+
+    def codes(self, times) -> np.ndarray:
+        """
+        Label index of every reading, times are datetime64 values or hours of the
+        day.
+        """
+        times = np.asarray(times)
+        if np.issubdtype(times.dtype, np.datetime64):
+            times = (times - times.astype("datetime64[D]")).astype("timedelta64[h]")
+        hours = times.astype(np.int64)
+        return self._codes[np.searchsorted(self._boundaries, hours, side="right")]
+
+    def labels_of(self, times) -> np.ndarray:
+        """
+        Label of every reading as object array, or the label of a single one.
+        """
+        return np.array(self.labels, dtype=object)[self.codes(times)]
+
+    def code(self, label: str) -> int:
+        return self.labels.index(label)
+
+    def sql(self, column: str) -> str:
+        """
+        The same classification as SQL CASE expression over a timestamp column.
+        """
+        hour = f"EXTRACT(HOUR FROM {column})"
+        cases = []
+        for label, (start, end) in self.ranges.items():
+            conditions = [f"{hour} >= {start}" if start else None]
+            conditions.append(f"{hour} < {end}" if end != 24 else None)
+            conditions = [c for c in conditions if c]
+            joined = (" AND " if start < end else " OR ").join(conditions) or "TRUE"
+            cases.append(f"WHEN {joined} THEN '{label}'")
+        if self.other is not None:
+            cases.append(f"ELSE '{self.other}'")
+        return "CASE\n        " + "\n        ".join(cases) + "\n    END"
+
+
+# morning and evening of the daytime analyses and the rollups
+DAYTIMES = Daytimes({"Morgen": (6, 12), "Abend": (18, 24)}, other="Andere")
+# the four times of day of the outlier details
+TIMES_OF_DAY = Daytimes(
+    {"Morgen": (6, 12), "Nachmittag": (12, 16), "Abend": (16, 22), "Nacht": (22, 6)}
+)
@@ -1,6 +1,63 @@
-from typing import List, Tuple
+import asyncio
+import io
+import os
+import threading
+import time
+from contextlib import contextmanager
+from typing import Callable, Iterator, List, NamedTuple, Tuple
 
+import psycopg
 import psycopg2
+import psycopg2.pool
+from psycopg.conninfo import make_conninfo
+from psycopg2.extensions import TRANSACTION_STATUS_IDLE, TRANSACTION_STATUS_UNKNOWN
+from psycopg_pool import AsyncConnectionPool, PoolTimeout
+
+from actions.utils.queries import QUERIES, Query
+from actions.utils.series import BloodPressureSeries
+
+DB_CONFIG = {
+    "host": os.environ.get("INSIGHTS_DB_HOST", "localhost"),
+    "database": os.environ.get("INSIGHTS_DB_NAME", "insights"),
+    "user": os.environ.get("INSIGHTS_DB_USER", "insights"),
+    "port": os.environ.get("INSIGHTS_DB_PORT", "5432"),
+}
+# idle connections kept open / hard limit of concurrently checked out connections
+POOL_MIN_SIZE = int(os.environ.get("INSIGHTS_DB_POOL_MIN", "1"))
+POOL_MAX_SIZE = int(os.environ.get("INSIGHTS_DB_POOL_MAX", "10"))
+# seconds to wait for a free connection before giving up
+POOL_TIMEOUT = float(os.environ.get("INSIGHTS_DB_POOL_TIMEOUT", "30"))
+# connections idle for longer than this are pinged before they are handed out
+HEALTH_CHECK_INTERVAL = float(os.environ.get("INSIGHTS_DB_HEALTH_CHECK", "30"))
+# rows per round trip of the server side cursors of RowStream
+STREAM_CHUNK_SIZE = int(os.environ.get("INSIGHTS_DB_STREAM_CHUNK", "10000"))
+# cap of the rows and of the bytes of their text representation LLM queries return
+MAX_ROWS = int(os.environ.get("INSIGHTS_DB_MAX_ROWS", "1000"))
+MAX_BYTES = int(os.environ.get("INSIGHTS_DB_MAX_BYTES", str(256 * 1024)))
+
+# order matters, the first matching class determines the message.
+# psycopg2 serves the synchronous, psycopg (3) the asyncio queries.
+_ERROR_PREFIXES = (
+    ((psycopg2.OperationalError, psycopg.OperationalError), "Operational error: "),
+    ((psycopg2.ProgrammingError, psycopg.ProgrammingError), "Programming error: "),
+    ((psycopg2.IntegrityError, psycopg.IntegrityError), "Integrity error: "),
+    ((psycopg2.DataError, psycopg.DataError), "Data error: "),
+    ((psycopg2.InternalError, psycopg.InternalError), "Internal error: "),
+)
+DB_ERRORS = tuple(
+    error_class for error_classes, _ in _ERROR_PREFIXES for error_class in error_classes
+)
+
+
+def describe_error(e: Exception) -> str:
+    """
+    Turns a database error into the message returned to LLM tools instead of raising.
+    """
+    for error_classes, prefix in _ERROR_PREFIXES:
+        if isinstance(e, error_classes):
+            return prefix + str(e)
+    return "Database error: " + str(e)
+
 
 database_schema = """# Database Schema
 
@@ -12,6 +69,7 @@ database_schema = """# Database Schema
 - diastolic (integer, max length: None, nullable): It measures the pressure in the blood vessels when the heart is at rest between beats. A normal diastolic blood pressure is generally considered to be around 80 mmHg, but can vary depending on various factors such as age, lifestyle, and overall health. High diastolic blood pressure (a reading of 90 mmHg or higher) may indicate a condition called diastolic hypertension, which can increase the risk of cardiovascular disease if not managed properly..
 - pulse (integer, max length: None, nullable): Description.
 - recorded_at (character varying, max length: 255, nullable): Time of recording in YYYY-MM-DD HH24:MI:SS.US. These measurements are typically done once in the morning and once in the evening at similar times. 
+- recorded_ts (timestamp without time zone, max length: None, nullable): recorded_at as timestamp, indexed together with user_id.
 
 ## Table: geo_location
 
@@ -25,6 +83,7 @@ database_schema = """# Database Schema
 - just_left_geofence_time (character varying, max length: 255, nullable): Time when geofence was just left the last time.
 - connected_to_trusted_wifi (boolean, max length: None, nullable): Description.
 - recorded_at (character varying, max length: 255, nullable): Time of recording in YYYY-MM-DD HH24:MI:SS.US.
+- recorded_ts (timestamp without time zone, max length: None, nullable): recorded_at as timestamp, indexed together with user_id.
 
 ## Table: patient
 
@@ -37,83 +96,509 @@ database_schema = """# Database Schema
 - home_longitude (real, max length: None, nullable): Longitude of home.
 - home_latitude (real, max length: None, nullable): Latitude of home.
 
-To compare timestamps use: CAST(recorded_at AS timestamp)"""
+To compare or sort timestamps use the indexed recorded_ts column instead of CAST(recorded_at AS timestamp)."""
+
+
+class PreparingConnection(psycopg2.extensions.connection):
+    """
+    Connection that remembers which registry statements are prepared on it.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.prepared = set()
+
+
+class ConnectionPool:
+    """
+    Bounded pool of psycopg2 connections with health checks on checkout.
+
+    min_size connections are kept open while idle, at most max_size are handed
+    out at the same time. Callers beyond that block until a connection is returned.
+    """
+
+    def __init__(self, min_size: int, max_size: int, **connect_kwargs):
+        self._pool = psycopg2.pool.ThreadedConnectionPool(
+            min_size, max_size, **connect_kwargs
+        )
+        self._slots = threading.BoundedSemaphore(max_size)
+        self._last_used = {}
+        self.max_size = max_size
+
+    @property
+    def closed(self) -> bool:
+        return self._pool.closed
+
+    def _is_healthy(self, conn) -> bool:
+        if conn.closed:
+            return False
+        if conn.info.transaction_status == TRANSACTION_STATUS_UNKNOWN:
+            return False
+        if time.monotonic() - self._last_used.get(id(conn), 0) < HEALTH_CHECK_INTERVAL:
+            return True
+        try:
+            with conn.cursor() as cur:
+                cur.execute("SELECT 1")
+            conn.rollback()
+            return True
+        except psycopg2.Error:
+            return False
+
+    def _discard(self, conn):
+        self._last_used.pop(id(conn), None)
+        try:
+            self._pool.putconn(conn, close=True)
+        except psycopg2.pool.PoolError:
+            pass
+
+    def checkout(self, timeout: float = None):
+        """
+        Takes a healthy connection from the pool and replaces connections the
+        server has dropped in the meantime.
+        """
+        timeout = POOL_TIMEOUT if timeout is None else timeout
+        if not self._slots.acquire(timeout=timeout):
+            raise ConnectionError(
+                f"No database connection available after {timeout} seconds."
+            )
+        try:
+            for _ in range(self.max_size + 1):
+                try:
+                    conn = self._pool.getconn()
+                except psycopg2.OperationalError as e:
+                    raise ConnectionError(
+                        "Please start the database for our client first!\nError message: "
+                        + str(e)
+                    )
+                if self._is_healthy(conn):
+                    return conn
+                print("Discarding broken database connection.")
+                self._discard(conn)
+            raise ConnectionError("Could not obtain a healthy database connection.")
+        except BaseException:
+            self._slots.release()
+            raise
+
+    def checkin(self, conn, close: bool = False):
+        try:
+            if close or conn.closed:
+                self._discard(conn)
+            else:
+                if conn.info.transaction_status != TRANSACTION_STATUS_IDLE:
+                    conn.rollback()
+                self._last_used[id(conn)] = time.monotonic()
+                self._pool.putconn(conn)
+        except (psycopg2.Error, psycopg2.pool.PoolError):
+            self._discard(conn)
+        finally:
+            self._slots.release()
+
+    def closeall(self):
+        if not self._pool.closed:
+            self._pool.closeall()
+
+
+class CappedResult(NamedTuple):
+    columns: List[str]
+    rows: List[Tuple]
+    truncated: bool
+
+
+class RowStream:
+    """
+    Rows of a query read through a psycopg2 named (server side) cursor, iterated
+    in batches of itersize rows.
+
+    The pooled connection stays checked out while the iteration runs and is
+    returned once it is exhausted, hits a cap or is stopped early (the generator
+    is closed). columns is known after the first batch, truncated tells whether a
+    cap cut the rows off. A lost connection is not retried, as the batches
+    already yielded can not be taken back.
+    """
+
+    __slots__ = (
+        "query",
+        "params",
+        "itersize",
+        "max_rows",
+        "max_bytes",
+        "name",
+        "columns",
+        "truncated",
+        "row_count",
+        "byte_count",
+    )
+
+    def __init__(
+        self,
+        query,
+        params=None,
+        itersize: int = None,
+        max_rows: int = None,
+        max_bytes: int = None,
+        name: str = "stream",
+    ):
+        self.query = query
+        self.params = params
+        self.itersize = itersize or STREAM_CHUNK_SIZE
+        self.max_rows = max_rows
+        self.max_bytes = max_bytes
+        self.name = name
+        self.columns = None
+        self.truncated = False
+        self.row_count = 0
+        self.byte_count = 0
+
+    def __iter__(self) -> Iterator[List[Tuple]]:
+        db_pool = DBHandler.get_pool()
+        conn = db_pool.checkout()
+        lost = False
+        try:
+            # named cursors are DECLAREd, which takes a query but no EXECUTE
+            with conn.cursor(name=self.name) as cur:
+                cur.itersize = self.itersize
+                cur.execute(self.query, self.params)
+                while not self.truncated:
+                    batch = cur.fetchmany(self._batch_size())
+                    if self.columns is None and cur.description:
+                        self.columns = [column.name for column in cur.description]
+                    if not batch:
+                        break
+                    batch = self._cap(batch)
+                    if batch:
+                        yield batch
+        except (psycopg2.OperationalError, psycopg2.InterfaceError):
+            lost = conn.closed != 0
+            raise
+        finally:
+            # also ends the transaction the cursor lived in
+            db_pool.checkin(conn, close=lost)
+
+    def _batch_size(self) -> int:
+        if self.max_rows is None:
+            return self.itersize
+        # one row beyond the cap tells whether there were more
+        return max(1, min(self.itersize, self.max_rows - self.row_count + 1))
+
+    def _cap(self, batch: List[Tuple]) -> List[Tuple]:
+        if self.max_rows is not None and self.row_count + len(batch) > self.max_rows:
+            batch = batch[: self.max_rows - self.row_count]
+            self.truncated = True
+        if self.max_bytes is not None:
+            for i, row in enumerate(batch):
+                self.byte_count += len(repr(row).encode())
+                if self.byte_count > self.max_bytes:
+                    batch = batch[:i]
+                    self.truncated = True
+                    break
+        self.row_count += len(batch)
+        return batch
 
 
 class DBHandler:
-    conn = None
-    cur = None
+    """
+    Query helper on top of a process wide connection pool.
+
+    Every query checks out its own connection and returns it afterwards, so
+    concurrent actions never share a cursor or a transaction.
+    """
+
+    pool = None
+    _pool_lock = threading.Lock()
+    async_pool = None
+    _async_pool_lock = None
 
     def __init__(self, silent=False, output_function=print, stringify_output=False):
         self.output_function = output_function
         self.stringify = stringify_output
-        if DBHandler.conn is None:
-            try:
-                DBHandler.conn = psycopg2.connect(
-                    host="localhost",
-                    database="insights",
-                    user="insights",
-                    port="5432",
-                )
-            except psycopg2.OperationalError as e:
-                raise ConnectionError(
-                    "Please start the database for our client first!\nError message: "
-                    + str(e)
-                )
-            DBHandler.cur = self.conn.cursor()
         self.silent = silent
+        DBHandler.get_pool()
+
+    @classmethod
+    def get_pool(cls) -> ConnectionPool:
+        if cls.pool is None:
+            with cls._pool_lock:
+                if cls.pool is None:
+                    try:
+                        cls.pool = ConnectionPool(
+                            POOL_MIN_SIZE,
+                            POOL_MAX_SIZE,
+                            connection_factory=PreparingConnection,
+                            **DB_CONFIG,
+                        )
+                    except psycopg2.OperationalError as e:
+                        raise ConnectionError(
+                            "Please start the database for our client first!\nError message: "
+                            + str(e)
+                        )
+        return cls.pool
 
-    def execute_query(self, query) -> [List[Tuple], str]:
+    @classmethod
+    def configure_pool(cls, min_size: int, max_size: int):
+        """
+        Changes the pool size. Open connections are closed and the pool is
+        recreated on the next checkout.
+        """
+        global POOL_MIN_SIZE, POOL_MAX_SIZE
+        if not 0 <= min_size <= max_size or max_size < 1:
+            raise ValueError(
+                f"Invalid pool size: min {min_size}, max {max_size}. "
+                f"Expected 0 <= min <= max and max >= 1."
+            )
+        cls.close_pool()
+        POOL_MIN_SIZE, POOL_MAX_SIZE = min_size, max_size
+
+    @classmethod
+    def close_pool(cls):
+        with cls._pool_lock:
+            if cls.pool is not None:
+                cls.pool.closeall()
+            cls.pool = None
+
+    @classmethod
+    async def get_async_pool(cls) -> AsyncConnectionPool:
+        """
+        Pool for the async actions. It is opened lazily inside the running event
+        loop of the action server and independent of the synchronous pool.
+        """
+        if cls._async_pool_lock is None:
+            cls._async_pool_lock = asyncio.Lock()
+        async with cls._async_pool_lock:
+            if cls.async_pool is None:
+                async_pool = AsyncConnectionPool(
+                    make_conninfo(
+                        host=DB_CONFIG["host"],
+                        dbname=DB_CONFIG["database"],
+                        user=DB_CONFIG["user"],
+                        port=DB_CONFIG["port"],
+                    ),
+                    min_size=POOL_MIN_SIZE,
+                    max_size=POOL_MAX_SIZE,
+                    timeout=POOL_TIMEOUT,
+                    check=AsyncConnectionPool.check_connection,
+                    open=False,
+                )
+                try:
+                    await async_pool.open(wait=True, timeout=POOL_TIMEOUT)
+                except PoolTimeout as e:
+                    await async_pool.close()
+                    raise ConnectionError(
+                        "Please start the database for our client first!\nError message: "
+                        + str(e)
+                    )
+                cls.async_pool = async_pool
+        return cls.async_pool
+
+    @classmethod
+    async def close_async_pool(cls):
+        if cls.async_pool is not None:
+            await cls.async_pool.close()
+            cls.async_pool = None
+
+    @contextmanager
+    def connection(self):
+        db_pool = DBHandler.get_pool()
+        conn = db_pool.checkout()
+        try:
+            yield conn
+        finally:
+            db_pool.checkin(conn)
+
+    def execute_query(self, query, params=None) -> [List[Tuple], str]:
+        if not self.silent:
+            self.output_function(
+                "Executing query to database: "
+                + str(query)
+                + (f" with {params}" if params is not None else "")
+            )
+        return self._execute(query, params)
+
+    def execute_named(self, name: str, params=()) -> [List[Tuple], str]:
+        """
+        Executes a statement of the query registry by name. It is prepared once per
+        pooled connection, so PostgreSQL parses and plans it only once.
+        """
+        query = QUERIES[name]
         if not self.silent:
-            self.output_function("Executing query to database: " + str(query))
+            self.output_function(f"Executing prepared query {name} with {params}")
+        return self._execute(query.execute_statement, params, prepared=query)
+
+    def _execute(self, query, params=None, prepared: Query = None):
         try:
-            self.cur.execute(query)
-            results = self.cur.fetchall()
-            if self.stringify:
-                results = str(results)
-            return results
-        except psycopg2.OperationalError as e:
-            self.conn.rollback()
+            results = self._fetch_with_reconnect(query, params, prepared)
+        except DB_ERRORS as e:
             if self.stringify:
-                return "Operational error: " + str(e)
+                return describe_error(e)
             raise e
-        except psycopg2.ProgrammingError as e:
-            self.conn.rollback()
-            if self.stringify:
-                return "Programming error: " + str(e)
-            raise e
-        except psycopg2.IntegrityError as e:
-            self.conn.rollback()
-            if self.stringify:
-                return "Integrity error: " + str(e)
-            raise e
-        except psycopg2.DataError as e:
-            self.conn.rollback()
-            if self.stringify:
-                return "Data error: " + str(e)
-            raise e
-        except psycopg2.InternalError as e:
-            self.conn.rollback()
+        if self.stringify:
+            results = str(results)
+        return results
+
+    async def execute_query_async(self, query, params=None) -> [List[Tuple], str]:
+        """
+        Awaitable counterpart of execute_query that does not block the event loop
+        of the action server. Errors are stringified the same way.
+        """
+        if not self.silent:
+            self.output_function(
+                "Executing query to database: "
+                + str(query)
+                + (f" with {params}" if params is not None else "")
+            )
+        return await self._execute_async(query, params)
+
+    async def execute_named_async(self, name: str, params=()) -> [List[Tuple], str]:
+        query = QUERIES[name]
+        if not self.silent:
+            self.output_function(f"Executing prepared query {name} with {params}")
+        # psycopg 3 prepares the statement on each pooled connection itself
+        return await self._execute_async(query.sql, params, prepare=True)
+
+    async def _execute_async(self, query, params=None, prepare=None):
+        try:
+            async_pool = await DBHandler.get_async_pool()
+            async with async_pool.connection() as conn:
+                async with conn.cursor() as cur:
+                    await cur.execute(query, params, prepare=prepare)
+                    results = await cur.fetchall()
+                # same read only behaviour as the synchronous pool
+                await conn.rollback()
+        except DB_ERRORS as e:
             if self.stringify:
-                return "Internal error: " + str(e)
+                return describe_error(e)
             raise e
-        except psycopg2.InFailedSqlTransaction as e:
-            self.conn.rollback()
+        if self.stringify:
+            results = str(results)
+        return results
+
+    def fetch_series(self, name: str, params=()) -> BloodPressureSeries:
+        """
+        Fetches a series statement of the query registry as BloodPressureSeries.
+
+        The rows are streamed with binary COPY and decoded column wise, no tuple or
+        datetime is created per row. COPY does not accept bind parameters, so they
+        are quoted client side.
+        """
+        query = QUERIES[name]
+        if not self.silent:
+            self.output_function(f"Fetching series {name} with {params}")
+
+        def copy_series(cur):
+            buffer = io.BytesIO()
+            sql = cur.mogrify(query.sql, params).decode()
+            cur.copy_expert(f"COPY ({sql}) TO STDOUT (FORMAT binary)", buffer)
+            return BloodPressureSeries.from_copy(buffer.getvalue())
+
+        return self._run_with_reconnect(copy_series)
+
+    def stream_named(self, name: str, params=(), chunk_size: int = None) -> "RowStream":
+        """
+        Streams a statement of the query registry, see stream_query.
+        """
+        if not self.silent:
+            self.output_function(f"Streaming query {name} with {params}")
+        return RowStream(QUERIES[name].sql, params, chunk_size, name=f"stream_{name}")
+
+    def stream_query(
+        self,
+        query,
+        params=None,
+        itersize: int = None,
+        max_rows: int = None,
+        max_bytes: int = None,
+    ) -> "RowStream":
+        """
+        Runs query through a server side cursor and yields its rows in batches of
+        itersize, so only one batch is held in memory at a time. Iteration stops
+        after max_rows rows or max_bytes bytes of their text representation.
+        """
+        if not self.silent:
+            self.output_function(
+                "Streaming query from database: "
+                + str(query)
+                + (f" with {params}" if params is not None else "")
+            )
+        return RowStream(query, params, itersize, max_rows, max_bytes)
+
+    def execute_query_capped(
+        self, query, params=None, max_rows: int = None, max_bytes: int = None
+    ) -> ["CappedResult", str]:
+        """
+        execute_query for queries written by an LLM: the rows are streamed and cut
+        off at max_rows rows or max_bytes bytes (by default INSIGHTS_DB_MAX_ROWS
+        and INSIGHTS_DB_MAX_BYTES), so a careless query can not load a whole
+        table. Stringified, a cut off result ends with a note for the LLM.
+        """
+        stream = self.stream_query(
+            query,
+            params,
+            max_rows=max_rows or MAX_ROWS,
+            max_bytes=max_bytes or MAX_BYTES,
+        )
+        try:
+            rows = [row for batch in stream for row in batch]
+        except DB_ERRORS as e:
             if self.stringify:
-                return "Transaction failed and was rolled back: " + str(e)
+                return describe_error(e)
             raise e
+        result = CappedResult(stream.columns or [], rows, stream.truncated)
+        if self.stringify:
+            return str(rows) + (
+                f"\n(Result truncated to the first {len(rows)} rows.)"
+                if stream.truncated
+                else ""
+            )
+        return result
+
+    @staticmethod
+    def _fetch_with_reconnect(
+        query, params=None, prepared: Query = None
+    ) -> List[Tuple]:
+        def fetch(cur):
+            if prepared is not None and prepared.name not in cur.connection.prepared:
+                # prepared statements live as long as the session, a
+                # rollback of the surrounding transaction keeps them
+                cur.execute(prepared.prepare_statement)
+                cur.connection.prepared.add(prepared.name)
+            cur.execute(query, params)
+            return cur.fetchall()
+
+        return DBHandler._run_with_reconnect(fetch)
+
+    @staticmethod
+    def _run_with_reconnect(work: Callable):
+        """
+        Calls work with a cursor of a pooled connection and retries once on a
+        fresh connection if the server dropped the first one.
+        """
+        db_pool = DBHandler.get_pool()
+        for attempt in range(2):
+            conn = db_pool.checkout()
+            lost = False
+            try:
+                with conn.cursor() as cur:
+                    return work(cur)
+            except (psycopg2.OperationalError, psycopg2.InterfaceError):
+                # the server dropped the connection, retry once on a fresh one
+                lost = conn.closed != 0
+                if not lost or attempt == 1:
+                    raise
+                print("Database connection lost, reconnecting.")
+            finally:
+                db_pool.checkin(conn, close=lost)
 
     def close(self):
-        self.conn.close()
+        DBHandler.close_pool()
 
     def get_table_schema(self):
-        self.cur.execute(
-            "SELECT * FROM information_schema.columns WHERE table_schema = 'public' AND table_name NOT IN "
-            "('databasechangelog', 'jhi_user_authority', 'user_activity', 'jhi_user', 'jhi_user_authority', "
-            "'databasechangeloglock', 'jhi_authority') "
-            "ORDER BY table_schema, table_name, ordinal_position"
-        )
-        tables = self.cur.fetchall()
+        with self.connection() as conn, conn.cursor() as cur:
+            cur.execute(
+                "SELECT * FROM information_schema.columns WHERE table_schema = 'public' AND table_name NOT IN "
+                "('databasechangelog', 'jhi_user_authority', 'user_activity', 'jhi_user', 'jhi_user_authority', "
+                "'databasechangeloglock', 'jhi_authority') "
+                "ORDER BY table_schema, table_name, ordinal_position"
+            )
+            tables = cur.fetchall()
         tables_dict = []
         for table in tables:
             table_dict = {
@@ -1,21 +1,55 @@
-from defog import Defog
+from actions.utils.db_utils import DB_ERRORS, DBHandler, describe_error
+from actions.utils.lazy import lazy_import
+
+defog = lazy_import("defog")
 
 
 class DefogHandler:
     def __init__(self):
-        self.defog = Defog()
-        self.defog.update_glossary(
-            """
+        self.defog = defog.Defog()
+        self.defog.update_glossary("""
         - geofence_detailed_status: IN_GEOFENCE,STILL_JUST_LEFT_GEOFENCE,RETURNED_TO_GEOFENCE,JUST_LEFT_GEOFENCE,OUTSIDE_GEOFENCE -> Within geofence there usually is a known environment.
         - recorded_at (timestamp): Time of recording in YYYY-MM-DD HH24:MI:SS.US.
+        - recorded_ts (timestamp): recorded_at as indexed timestamp, use it to filter and sort by time.
         - user_id (bigint): patient identifier.
         - sex is FEMALE or MALE
         - The target corridor for systolic blood pressure is [90, 120] and for diastolic blood pressure is [60, 80].
-        """
-        )
+        """)
 
     def ask_query(self, query, user_id, backgroudn_info_string_for_llm):
-        return self.defog.run_query(
+        """
+        Lets Defog generate the SQL and runs it through the capped, streaming
+        DBHandler.execute_query_capped instead of Defog's fetch-all execution.
+        Like Defog's own results, ran_successfully tells whether there is data,
+        otherwise error_message says why.
+        """
+        generated = self.defog.get_query(
             f"User Input: {query}; Background Information: {backgroudn_info_string_for_llm}",
             f"Only consider data from patient with user_id = {user_id}",
         )
+        if not generated.get("ran_successfully", True) or not generated.get(
+            "query_generated"
+        ):
+            return {
+                "ran_successfully": False,
+                "query_generated": generated.get("query_generated"),
+                "error_message": generated.get("error_message")
+                or "Defog did not generate a query.",
+            }
+        try:
+            result = DBHandler(silent=True).execute_query_capped(
+                generated["query_generated"]
+            )
+        except DB_ERRORS as e:
+            return {
+                "ran_successfully": False,
+                "query_generated": generated["query_generated"],
+                "error_message": describe_error(e),
+            }
+        return {
+            "ran_successfully": True,
+            "query_generated": generated["query_generated"],
+            "columns": result.columns,
+            "data": result.rows,
+            "truncated": result.truncated,
+        }
@@ -0,0 +1,83 @@
+"""
+The event handler of the runs of the SQL assistant of gpt_utils, it answers the
+calls of the execute_sql_statement tool. A module of its own, as subclassing
+AssistantEventHandler imports openai, gpt_utils imports it lazily.
+"""
+
+import json
+
+from openai.lib.streaming import AssistantEventHandler
+
+from actions.utils.db_utils import DBHandler
+from actions.utils.gpt_utils import GPTHandler
+
+
+class EventHandler(AssistantEventHandler):
+
+    def __init__(
+        self, output_function: callable = None, gpt_handler=None, stream: bool = True
+    ):
+        self.gpt_handler = gpt_handler if gpt_handler else GPTHandler()
+        self.db_handler = DBHandler(
+            silent=False, output_function=output_function, stringify_output=True
+        )
+        self.output_function = output_function
+        self.stream = stream
+        super().__init__()
+
+    def on_event(self, event):
+        # Retrieve events that are denoted with 'requires_action'
+        # since these will have our tool_calls
+        if event.event == "thread.run.requires_action":
+            self.handle_requires_action(event.data)
+
+    def handle_requires_action(self, data):
+        tool_outputs = []
+
+        for tool in data.required_action.submit_tool_outputs.tool_calls:
+            if tool.function.name == "execute_sql_statement":
+                try:
+                    # streamed and capped, the query is written by the LLM
+                    result = self.db_handler.execute_query_capped(
+                        json.loads(tool.function.arguments)["query"]
+                    )
+                    tool_outputs.append({"tool_call_id": tool.id, "output": result})
+                except Exception as e:
+                    print(
+                        "During execution of the database query the following error was rasied: "
+                        + str(e)
+                    )
+                    tool_outputs.append(
+                        {
+                            "tool_call_id": tool.id,
+                            "output": "An error occurred during the execution of the query: "
+                            + str(e),
+                        }
+                    )
+
+        # Submit all tool_outputs at the same time
+        self.submit_tool_outputs(tool_outputs, data)
+
+    def submit_tool_outputs(self, tool_outputs, run: "Run" = None):
+        # Use the submit_tool_outputs_stream helper
+        print("Submitting tool outputs" + str(tool_outputs))
+        if self.stream:
+            with self.gpt_handler.client.beta.threads.runs.submit_tool_outputs_stream(
+                thread_id=self.current_run.thread_id,
+                run_id=self.current_run.id,
+                tool_outputs=tool_outputs,
+                event_handler=EventHandler(
+                    gpt_handler=self.gpt_handler, stream=self.stream
+                ),
+            ) as stream:
+                for text in stream.text_deltas:
+                    if self.output_function:
+                        self.output_function(text)
+
+                    print(text, end="", flush=True)
+        else:
+            self.gpt_handler.client.beta.threads.runs.submit_tool_outputs_and_poll(
+                thread_id=run.thread_id,
+                run_id=run.id,
+                tool_outputs=tool_outputs,
+            )
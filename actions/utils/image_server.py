@@ -0,0 +1,184 @@
+"""
+Delivery of the rendered charts without files per request.
+
+The charts are published by key into an in-memory store and served from a
+small HTTP server in a daemon thread of the action server, under
+{INSIGHTS_IMAGE_URL}/images/<key>.png, until they expire after
+INSIGHTS_IMAGE_TTL seconds. INSIGHTS_IMAGE_DELIVERY selects the delivery:
+
+- http: URLs of the built-in server (default)
+- data: data URIs with the base64 encoded PNG, nothing is served
+- file: absolute paths of the files of the plot cache, as before
+
+If the port is taken, e.g. by a second action server, the charts fall back to
+data URIs.
+
+The server listens on INSIGHTS_IMAGE_HOST, only on 127.0.0.1 by default.
+"""
+
+import base64
+import os
+import threading
+import time
+from collections import OrderedDict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Optional
+
+IMAGE_DELIVERY = os.environ.get("INSIGHTS_IMAGE_DELIVERY", "http")
+# the charts are served without authentication, only bind wider (e.g. 0.0.0.0)
+# if the clients run on other hosts and the network is trusted
+IMAGE_HOST = os.environ.get("INSIGHTS_IMAGE_HOST", "127.0.0.1")
+IMAGE_PORT = int(os.environ.get("INSIGHTS_IMAGE_PORT", "5056"))
+# base of the URLs handed to the clients
+IMAGE_URL = os.environ.get("INSIGHTS_IMAGE_URL", f"http://localhost:{IMAGE_PORT}")
+# seconds a published chart is served
+IMAGE_TTL = float(os.environ.get("INSIGHTS_IMAGE_TTL", "3600"))
+# upper bound for the published charts together
+IMAGE_MAX_BYTES = int(os.environ.get("INSIGHTS_IMAGE_MAX_BYTES", str(64 * 2**20)))
+
+
+class ImageStore:
+    """
+    Published charts by key with their expiry. Republishing a chart extends it;
+    the oldest ones are dropped once they exceed max_bytes.
+    """
+
+    def __init__(self, ttl: float = IMAGE_TTL, max_bytes: int = IMAGE_MAX_BYTES):
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._nbytes = 0
+        self._lock = threading.Lock()
+
+    def publish(self, key: str, png: bytes):
+        with self._lock:
+            self._drop(key)
+            self._expire()
+            if len(png) > self.max_bytes:
+                return
+            self._entries[key] = (png, time.monotonic() + self.ttl)
+            self._nbytes += len(png)
+            while self._nbytes > self.max_bytes:
+                self._drop(next(iter(self._entries)))
+
+    def get(self, key: str) -> Optional[bytes]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[1] <= time.monotonic():
+                return None
+            return entry[0]
+
+    @property
+    def nbytes(self) -> int:
+        return self._nbytes
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def _expire(self):
+        # ordered by expiry, as every publish moves its chart to the end
+        now = time.monotonic()
+        while self._entries:
+            key, (_, expires_at) = next(iter(self._entries.items()))
+            if expires_at > now:
+                break
+            self._drop(key)
+
+    def _drop(self, key: str):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self._nbytes -= len(entry[0])
+
+
+class _ImageHandler(BaseHTTPRequestHandler):
+    store: ImageStore = None
+
+    def do_GET(self):
+        name = self.path.split("?", 1)[0]
+        png = None
+        if name.startswith("/images/") and name.endswith(".png"):
+            png = self.store.get(name[len("/images/") : -len(".png")])
+        if png is None:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", "image/png")
+        self.send_header("Content-Length", str(len(png)))
+        # the key is the content, a URL never changes its image
+        self.send_header("Cache-Control", f"max-age={int(self.store.ttl)}, immutable")
+        self.end_headers()
+        self.wfile.write(png)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class ImageServer:
+    """
+    The HTTP server of an ImageStore, started in a daemon thread on first use.
+    """
+
+    def __init__(
+        self,
+        store: ImageStore,
+        host: str = IMAGE_HOST,
+        port: int = IMAGE_PORT,
+        url: str = IMAGE_URL,
+    ):
+        self.store = store
+        self.host = host
+        self.port = port
+        self.url = url.rstrip("/")
+        self._server = None
+        self._failed = False
+        self._lock = threading.Lock()
+
+    def start(self) -> bool:
+        """
+        Starts the server unless it runs already, False if it cannot listen.
+        """
+        with self._lock:
+            if self._server is None and not self._failed:
+                handler = type("ImageHandler", (_ImageHandler,), {"store": self.store})
+                try:
+                    self._server = ThreadingHTTPServer((self.host, self.port), handler)
+                except OSError as e:
+                    print(f"Image server not started on port {self.port}: {e}")
+                    self._failed = True
+                    return False
+                self._server.daemon_threads = True
+                threading.Thread(
+                    target=self._server.serve_forever, name="image-server", daemon=True
+                ).start()
+            return self._server is not None
+
+    def stop(self):
+        with self._lock:
+            if self._server is not None:
+                self._server.shutdown()
+                self._server.server_close()
+            self._server = None
+
+    def url_of(self, key: str) -> str:
+        return f"{self.url}/images/{key}.png"
+
+
+def data_uri(png: bytes) -> str:
+    return "data:image/png;base64," + base64.b64encode(png).decode("ascii")
+
+
+image_store = ImageStore()
+image_server = ImageServer(image_store)
+
+
+def deliver(key: str, png: bytes, path: Optional[str] = None) -> str:
+    """
+    The image for dispatcher.utter_message(image=...) of a chart: its URL, its
+    data URI or path, see INSIGHTS_IMAGE_DELIVERY.
+    """
+    if IMAGE_DELIVERY == "file" and path is not None:
+        return path
+    if IMAGE_DELIVERY == "http" and image_server.start():
+        image_store.publish(key, png)
+        return image_server.url_of(key)
+    return data_uri(png)
@@ -0,0 +1,139 @@
+"""
+Lazy loading of the heavy libraries (pandas, matplotlib, seaborn, dateparser,
+openai, defog), so the action server starts in a fraction of a second and
+actions like action_get_user_nickname answer before any of them is needed.
+
+    pd = lazy_import("pandas")
+
+binds a proxy that imports pandas on the first attribute access, e.g.
+pd.Timestamp, so the modules keep their usual aliases. lazy_object() does the
+same for objects that are expensive to build, like the OpenAI client.
+
+With INSIGHTS_WARM_UP=1 a daemon thread loads all of them INSIGHTS_WARM_UP_DELAY
+seconds (default 5) after the actions were imported, i.e. once the server is
+up, so the first answer that needs them does not pay for the import either.
+Only the main process warms up, not the processes it spawns, e.g. the plot
+workers, which import the actions as well.
+"""
+
+import importlib
+import multiprocessing
+import os
+import threading
+import time
+from typing import Callable, List
+
+# preload the lazy libraries in the background after startup
+WARM_UP = os.environ.get("INSIGHTS_WARM_UP", "0") == "1"
+WARM_UP_DELAY = float(os.environ.get("INSIGHTS_WARM_UP_DELAY", "5"))
+
+_registry: List["_Lazy"] = []
+_hooks: List[Callable] = []
+_warm_up_started = False
+_warm_up_lock = threading.Lock()
+
+
+class _Lazy:
+    __slots__ = ("_factory", "_target", "_lock", "_description")
+
+    def __init__(self, factory: Callable, description: str, warm_up: bool):
+        self._factory = factory
+        self._target = None
+        self._lock = threading.Lock()
+        self._description = description
+        if warm_up:
+            _registry.append(self)
+
+    def _load(self):
+        target = self._target
+        if target is None:
+            with self._lock:
+                if self._target is None:
+                    self._target = self._factory()
+                target = self._target
+        return target
+
+    @property
+    def loaded(self) -> bool:
+        return self._target is not None
+
+    def __getattr__(self, name):
+        return getattr(self._load(), name)
+
+    def __repr__(self) -> str:
+        state = "loaded" if self.loaded else "not loaded"
+        return f"<lazy {self._description}, {state}>"
+
+
+def lazy_import(name: str, warm_up: bool = True) -> _Lazy:
+    """
+    Proxy of module name, imported on first attribute access. Without warm_up
+    the warm-up leaves it alone, e.g. pyplot, which only the plot workers need.
+    """
+    return _Lazy(lambda: importlib.import_module(name), name, warm_up)
+
+
+def lazy_object(
+    factory: Callable, description: str = "object", warm_up: bool = True
+) -> _Lazy:
+    """
+    Proxy of the result of factory, called once on first attribute access.
+    """
+    return _Lazy(factory, description, warm_up)
+
+
+def on_warm_up(hook: Callable) -> Callable:
+    """
+    Registers hook to run with the warm-up, e.g. to start worker processes.
+    """
+    _hooks.append(hook)
+    return hook
+
+
+def warm_up():
+    """
+    Loads all lazy libraries and objects now and runs the warm-up hooks.
+    """
+    tasks = [(lazy._load, lazy._description) for lazy in _registry]
+    tasks += [(hook, hook.__name__) for hook in _hooks]
+    for task, description in tasks:
+        try:
+            task()
+        except Exception as e:
+            # e.g. an optional library that is not installed
+            print(f"Warm-up of {description} failed: {e}")
+
+
+def _in_child_process() -> bool:
+    """
+    Whether this is a process spawned by multiprocessing, e.g. a plot worker.
+    Its warm-up would run the hooks, which spawn processes again. A spawned
+    process imports the actions before it knows its parent, so this is asked
+    again after the delay.
+    """
+    return multiprocessing.parent_process() is not None
+
+
+def start_warm_up(delay: float = WARM_UP_DELAY) -> bool:
+    """
+    Runs warm_up() in a daemon thread after delay seconds, once per process and
+    only in the main process.
+    """
+    global _warm_up_started
+    if _in_child_process():
+        return False
+    with _warm_up_lock:
+        if _warm_up_started:
+            return False
+        _warm_up_started = True
+
+    def run():
+        time.sleep(delay)
+        if _in_child_process():
+            return
+        start = time.perf_counter()
+        warm_up()
+        print(f"Warm-up took {time.perf_counter() - start:.2f}s.")
+
+    threading.Thread(target=run, name="warm-up", daemon=True).start()
+    return True
@@ -0,0 +1,66 @@
+"""
+Idempotent schema bootstrap, run it with `python -m actions.utils.migrations`.
+
+recorded_at is stored as character varying, so filtering on
+CAST(recorded_at AS timestamp) can not use an index. This adds a generated,
+typed recorded_ts column and composite (user_id, recorded_ts) indexes to
+bloodpressure and geo_location. Adding the column rewrites the tables once.
+It also creates the tables of the blood pressure rollups.
+"""
+
+from typing import List
+
+from actions.utils.db_utils import DBHandler
+from actions.utils.rollups import create_statements as rollup_statements
+
+MIGRATIONS: List[str] = [
+    # CAST(text AS timestamp) is only STABLE, generated columns and indexes need an
+    # IMMUTABLE expression. The stored format YYYY-MM-DD HH24:MI:SS.US is parsed the
+    # same way independent of the DateStyle setting, so the wrapper is safe.
+    """
+    CREATE OR REPLACE FUNCTION recorded_at_ts(recorded_at text) RETURNS timestamp
+    LANGUAGE sql IMMUTABLE PARALLEL SAFE RETURNS NULL ON NULL INPUT
+    AS $$ SELECT CAST(recorded_at AS timestamp) $$
+    """,
+    """
+    ALTER TABLE bloodpressure ADD COLUMN IF NOT EXISTS recorded_ts timestamp
+    GENERATED ALWAYS AS (recorded_at_ts(recorded_at)) STORED
+    """,
+    """
+    ALTER TABLE geo_location ADD COLUMN IF NOT EXISTS recorded_ts timestamp
+    GENERATED ALWAYS AS (recorded_at_ts(recorded_at)) STORED
+    """,
+    """
+    CREATE INDEX IF NOT EXISTS bloodpressure_user_id_recorded_ts_idx
+    ON bloodpressure (user_id, recorded_ts)
+    """,
+    """
+    CREATE INDEX IF NOT EXISTS geo_location_user_id_recorded_ts_idx
+    ON geo_location (user_id, recorded_ts)
+    """,
+    "ANALYZE bloodpressure",
+    "ANALYZE geo_location",
+    # daily and monthly aggregates, see actions.utils.rollups
+    *rollup_statements(),
+]
+
+
+def apply_migrations(cur, output_function=print):
+    for statement in MIGRATIONS:
+        output_function("Applying migration: " + " ".join(statement.split()))
+        cur.execute(statement)
+
+
+def migrate(output_function=print):
+    """
+    Applies all migrations in a single transaction.
+    """
+    with DBHandler(silent=True).connection() as conn:
+        with conn.cursor() as cur:
+            apply_migrations(cur, output_function)
+        conn.commit()
+    output_function("Database schema is up to date.")
+
+
+if __name__ == "__main__":
+    migrate()
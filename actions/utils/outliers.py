@@ -0,0 +1,88 @@
+from typing import Optional, Sequence
+
+import numpy as np
+
+# readings further than this multiple of the IQR outside the quartiles
+IQR_FACTOR = 0.5
+# calendar periods the quartiles can be computed per, as datetime64 units
+PERIODS = {"day": "D", "week": "W", "month": "M", "year": "Y"}
+
+
+def period_codes(recorded_at, period: str) -> np.ndarray:
+    """
+    Index of the calendar period of every reading. Weeks start on Monday, like
+    pandas' weekly periods.
+    """
+    recorded_at = np.asarray(recorded_at, dtype="datetime64[us]")
+    if period not in PERIODS:
+        raise ValueError(
+            f"Unknown period {period}, expected one of {', '.join(PERIODS)}."
+        )
+    if period == "week":
+        # 1970-01-01 was a Thursday
+        days = recorded_at.astype("datetime64[D]").astype(np.int64)
+        return (days + 3) // 7
+    return recorded_at.astype(f"datetime64[{PERIODS[period]}]").astype(np.int64)
+
+
+def grouped_quantiles(values, codes, quantiles: Sequence[float]) -> np.ndarray:
+    """
+    Quantiles of values per group code 0..max(codes), with linear interpolation
+    like pandas, as array of shape (len(quantiles), groups). Groups without
+    values get NaN.
+    """
+    values = np.asarray(values, dtype=np.float64)
+    codes = np.asarray(codes, dtype=np.intp)
+    counts = np.bincount(codes, minlength=codes.max() + 1 if len(codes) else 0)
+    starts = np.cumsum(counts) - counts
+    # sorted by group, then by value
+    sorted_values = values[np.lexsort((values, codes))]
+    result = np.full((len(quantiles), len(counts)), np.nan)
+    present = counts > 0
+    for i, quantile in enumerate(quantiles):
+        position = quantile * (counts[present] - 1)
+        lower = np.floor(position).astype(np.intp)
+        upper = np.ceil(position).astype(np.intp)
+        low = sorted_values[starts[present] + lower]
+        high = sorted_values[starts[present] + upper]
+        result[i, present] = low + (position - lower) * (high - low)
+    return result
+
+
+def iqr_outliers(
+    values,
+    windows: Sequence,
+    recorded_at=None,
+    period: Optional[str] = None,
+    factor: float = IQR_FACTOR,
+) -> np.ndarray:
+    """
+    IQR outlier masks of values for several windows at once, e.g. the readings
+    before and after a change date, as boolean array of shape (len(windows),
+    len(values)). A window is a slice, a boolean mask or indices into values;
+    the quartiles are computed per window and, with period, per calendar period
+    of recorded_at within the window. Readings outside a window are False.
+    """
+    values = np.asarray(values, dtype=np.float64)
+    selected = np.zeros((len(windows), len(values)), dtype=bool)
+    for i, window in enumerate(windows):
+        selected[i, window] = True
+    window_index, reading = np.nonzero(selected)
+    periods = (
+        period_codes(recorded_at, period)
+        if period is not None
+        else np.zeros(len(values), dtype=np.int64)
+    )
+    _, periods = np.unique(periods, return_inverse=True)
+    n_periods = periods.max() + 1 if len(periods) else 1
+    # one group per window and period
+    codes = window_index * n_periods + periods.reshape(-1)[reading]
+    first, third = grouped_quantiles(values[reading], codes, (0.25, 0.75))
+    spread = factor * (third - first)
+    pair_values = values[reading]
+    outlier = (pair_values < (first - spread)[codes]) | (
+        pair_values > (third + spread)[codes]
+    )
+    result = np.zeros_like(selected)
+    result[window_index, reading] = outlier
+    return result
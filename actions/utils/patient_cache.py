@@ -0,0 +1,130 @@
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Optional
+
+from actions.utils.db_utils import DBHandler
+
+# number of patient profiles kept in memory, 0 disables the cache
+PATIENT_CACHE_SIZE = int(os.environ.get("INSIGHTS_PATIENT_CACHE_SIZE", "1024"))
+# seconds a cached profile is served before it is read from the database again
+PATIENT_CACHE_TTL = float(os.environ.get("INSIGHTS_PATIENT_CACHE_TTL", "300"))
+
+
+class PatientProfile:
+    """
+    Row of the patient table as returned by the patient_details statement.
+    """
+
+    __slots__ = (
+        "health",
+        "geo",
+        "user_id",
+        "nickname",
+        "title",
+        "home_longitude",
+        "home_latitude",
+        "birthday",
+        "sex",
+        "medical_preconditions",
+    )
+
+    def __init__(self, *values):
+        for field, value in zip(self.__slots__, values):
+            setattr(self, field, value)
+
+    @classmethod
+    def from_row(cls, row) -> "PatientProfile":
+        # the first column is the primary key of the patient table
+        return cls(*row[1:])
+
+    def to_dict(self) -> dict:
+        details = {field: getattr(self, field) for field in self.__slots__}
+        details["medical_preconditions"] = self.medical_preconditions or ""
+        return details
+
+    def __repr__(self) -> str:
+        return f"PatientProfile(user_id={self.user_id!r})"
+
+
+class _Entry:
+    __slots__ = ("profile", "loaded_at")
+
+    def __init__(self, profile: Optional[PatientProfile], loaded_at: float):
+        self.profile = profile
+        self.loaded_at = loaded_at
+
+
+class PatientCache:
+    """
+    Process wide LRU cache of patient profiles.
+
+    Unknown user ids are cached as None as well, so repeated questions for them do
+    not reach the database either. Profiles are read again after ttl seconds or
+    after invalidate(), e.g. when the patient details are reloaded explicitly.
+    """
+
+    def __init__(self, size: int = PATIENT_CACHE_SIZE, ttl: float = PATIENT_CACHE_TTL):
+        self.size = size
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, user_id) -> Optional[PatientProfile]:
+        key = str(user_id)
+        entry = self._lookup(key)
+        if entry is not None:
+            return entry.profile
+        loaded_at = time.monotonic()
+        result = DBHandler(silent=True).execute_named("patient_details", (user_id,))
+        return self._store(key, result, loaded_at)
+
+    async def get_async(self, user_id) -> Optional[PatientProfile]:
+        key = str(user_id)
+        entry = self._lookup(key)
+        if entry is not None:
+            return entry.profile
+        loaded_at = time.monotonic()
+        result = await DBHandler(silent=True).execute_named_async(
+            "patient_details", (user_id,)
+        )
+        return self._store(key, result, loaded_at)
+
+    def invalidate(self, user_id=None):
+        """
+        Drops the cached profile of a patient, or of all patients without user_id.
+        """
+        with self._lock:
+            if user_id is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(str(user_id), None)
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def _lookup(self, key: str) -> Optional[_Entry]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if time.monotonic() - entry.loaded_at >= self.ttl:
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return entry
+
+    def _store(self, key: str, result, loaded_at: float) -> Optional[PatientProfile]:
+        profile = PatientProfile.from_row(result[0]) if result else None
+        if self.size <= 0:
+            return profile
+        with self._lock:
+            self._entries[key] = _Entry(profile, loaded_at)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+        return profile
+
+
+patient_cache = PatientCache()
@@ -0,0 +1,195 @@
+import hashlib
+import os
+import pathlib
+import threading
+from collections import OrderedDict
+from typing import Optional
+
+import numpy as np
+
+# upper bound for the rendered charts kept in memory, 0 disables it
+PLOT_CACHE_MAX_BYTES = int(
+    os.environ.get("INSIGHTS_PLOT_CACHE_MAX_BYTES", str(32 * 2**20))
+)
+# upper bound for the chart files in the cache directory, 0 keeps the charts in
+# memory only
+PLOT_CACHE_DISK_BYTES = int(os.environ.get("INSIGHTS_PLOT_CACHE_DISK_BYTES", "0"))
+PLOT_CACHE_DIR = os.environ.get("INSIGHTS_PLOT_CACHE_DIR", "tmp_plots")
+
+
+def plot_key(spec) -> str:
+    """
+    Content address of a PlotSpec: a hash of the chart name, its options (spans,
+    change date, ...) and the data itself, so new or changed readings give a new
+    key without tracking the watermark of the series.
+    """
+    digest = hashlib.blake2b(digest_size=16)
+    digest.update(spec.chart.encode())
+    digest.update(repr(sorted(spec.options.items())).encode())
+    for name in sorted(spec.data):
+        column = np.asarray(spec.data[name])
+        digest.update(f"\0{name}\0{column.dtype.str}\0{column.shape}\0".encode())
+        if column.dtype == object:
+            digest.update("\x1f".join(map(str, column.ravel())).encode())
+        else:
+            digest.update(np.ascontiguousarray(column).tobytes())
+    return digest.hexdigest()
+
+
+class PlotCache:
+    """
+    Process wide cache of rendered charts by plot_key.
+
+    The most recently used charts are kept in memory up to max_bytes. With
+    max_disk_bytes they are also written to directory, named by their key, which
+    survives restarts; the least recently used files are deleted once they exceed
+    max_disk_bytes, and files left by earlier runs are picked up, oldest first.
+    """
+
+    def __init__(
+        self,
+        directory: str = PLOT_CACHE_DIR,
+        max_bytes: int = PLOT_CACHE_MAX_BYTES,
+        max_disk_bytes: int = PLOT_CACHE_DISK_BYTES,
+    ):
+        self.directory = pathlib.Path(directory).absolute()
+        self.max_bytes = max_bytes
+        self.max_disk_bytes = max_disk_bytes
+        self._entries = OrderedDict()
+        self._nbytes = 0
+        # key -> file size, None until the directory has been scanned
+        self._files = None
+        self._disk_bytes = 0
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> Optional[bytes]:
+        """
+        The PNG of key from memory or disk, None if it was never rendered or has
+        been evicted.
+        """
+        with self._lock:
+            png = self._entries.get(key)
+            if png is not None:
+                self._entries.move_to_end(key)
+                self._touch(key)
+                return png
+            if key not in self._scanned():
+                return None
+            try:
+                png = self._path(key).read_bytes()
+            except FileNotFoundError:
+                # removed behind our back
+                self._forget(key)
+                return None
+            self._touch(key)
+            self._remember(key, png)
+            return png
+
+    def put(self, key: str, png: bytes) -> Optional[str]:
+        """
+        Stores the PNG of key and returns the absolute path of its file, None
+        without disk cache.
+        """
+        with self._lock:
+            files = self._scanned()
+            path = self._path(key)
+            if self.max_disk_bytes <= 0:
+                self._remember(key, png)
+                return None
+            if key in files and path.exists():
+                self._touch(key)
+            else:
+                self.directory.mkdir(parents=True, exist_ok=True)
+                # written aside and renamed, readers never see half a file
+                partial = path.with_suffix(f".{threading.get_ident()}.part")
+                partial.write_bytes(png)
+                os.replace(partial, path)
+                self._forget(key)
+                files[key] = len(png)
+                self._disk_bytes += len(png)
+                self._evict_files(keep=key)
+            self._remember(key, png)
+            return str(path)
+
+    def path(self, key: str) -> Optional[str]:
+        with self._lock:
+            return str(self._path(key)) if key in self._scanned() else None
+
+    def clear(self):
+        """
+        Drops all cached charts, including their files.
+        """
+        with self._lock:
+            for key in list(self._scanned()):
+                self._path(key).unlink(missing_ok=True)
+            self._entries.clear()
+            self._nbytes = 0
+            self._files.clear()
+            self._disk_bytes = 0
+
+    @property
+    def nbytes(self) -> int:
+        return self._nbytes
+
+    @property
+    def disk_bytes(self) -> int:
+        return self._disk_bytes
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._scanned())
+
+    def _path(self, key: str) -> pathlib.Path:
+        return self.directory / f"{key}.png"
+
+    def _scanned(self) -> OrderedDict:
+        if self._files is None:
+            self._files = OrderedDict()
+            if self.max_disk_bytes > 0 and self.directory.is_dir():
+                found = [
+                    (path.stat().st_mtime, path.stem, path.stat().st_size)
+                    for path in self.directory.glob("*.png")
+                ]
+                for _, key, size in sorted(found):
+                    self._files[key] = size
+                    self._disk_bytes += size
+            self._evict_files()
+        return self._files
+
+    def _touch(self, key: str):
+        if key in self._files:
+            self._files.move_to_end(key)
+            try:
+                # keeps the order for the next start
+                os.utime(self._path(key))
+            except FileNotFoundError:
+                self._forget(key)
+
+    def _forget(self, key: str):
+        size = self._files.pop(key, None)
+        if size is not None:
+            self._disk_bytes -= size
+
+    def _remember(self, key: str, png: bytes):
+        previous = self._entries.pop(key, None)
+        if previous is not None:
+            self._nbytes -= len(previous)
+        if len(png) > self.max_bytes:
+            return
+        self._entries[key] = png
+        self._nbytes += len(png)
+        while self._nbytes > self.max_bytes:
+            _, evicted = self._entries.popitem(last=False)
+            self._nbytes -= len(evicted)
+
+    def _evict_files(self, keep: Optional[str] = None):
+        while self._disk_bytes > self.max_disk_bytes and self._files:
+            key = next(iter(self._files))
+            if key == keep:
+                # a single chart larger than the limit is still delivered
+                break
+            self._forget(key)
+            self._path(key).unlink(missing_ok=True)
+
+
+plot_cache = PlotCache()
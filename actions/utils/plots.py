@@ -0,0 +1,192 @@
+"""
+Off-thread rendering of the charts in actions.utils.charts.
+
+The charts are rendered by a pool of worker processes, each with the Agg backend
+and seaborn loaded once, so figures of concurrent actions neither share the
+global pyplot state nor block the event loop of the action server. An action
+submits a PlotSpec (chart name, columnar data, options) as soon as its data is
+ready, utters its text and awaits the image afterwards:
+
+    figure = plots.submit(PlotSpec("trends", data, options))
+    dispatcher.utter_message(text)
+    (image,) = await plots.images(figure)
+    dispatcher.utter_message(image=image)
+
+Rendered charts are kept in the plot_cache by the content of their spec, a chart
+asked for again is not rendered again. The images are delivered from memory, by
+the image_server.
+"""
+
+import asyncio
+import io
+import multiprocessing
+import os
+import threading
+from concurrent.futures import Future, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Any, Dict, List, NamedTuple
+
+import numpy as np
+
+from actions.utils.image_server import deliver
+from actions.utils.lazy import on_warm_up
+from actions.utils.plot_cache import plot_cache, plot_key
+
+# rendering processes, 0 renders in the calling process
+PLOT_WORKERS = int(os.environ.get("INSIGHTS_PLOT_WORKERS", "2"))
+
+
+class PlotSpec(NamedTuple):
+    """
+    A chart of actions.utils.charts.CHARTS by name, the columnar data it draws
+    and its keyword options. Everything has to be picklable.
+    """
+
+    chart: str
+    data: Dict[str, np.ndarray]
+    options: Dict[str, Any]
+
+
+class Figure(NamedTuple):
+    """
+    A submitted chart, future resolves to its PNG bytes.
+    """
+
+    key: str
+    future: Future
+
+
+def render(spec: PlotSpec) -> bytes:
+    """
+    Draws spec and returns the figure as PNG.
+    """
+    from matplotlib import pyplot as plt
+
+    from actions.utils.charts import CHARTS
+
+    try:
+        CHARTS[spec.chart](spec.data, **spec.options)
+        buffer = io.BytesIO()
+        plt.savefig(buffer, format="png")
+        return buffer.getvalue()
+    finally:
+        plt.close("all")
+
+
+def _warm_up():
+    import matplotlib
+
+    matplotlib.use("Agg")
+    import seaborn  # noqa: F401
+
+    import actions.utils.charts  # noqa: F401
+
+
+_pool = None
+_pool_lock = threading.Lock()
+# pyplot is not thread safe, without workers the renders take turns
+_inline_lock = threading.Lock()
+_warmed_up = False
+
+
+def _get_pool() -> ProcessPoolExecutor:
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            # spawned, forking the threads of the action server is not safe
+            _pool = ProcessPoolExecutor(
+                PLOT_WORKERS,
+                mp_context=multiprocessing.get_context("spawn"),
+                initializer=_warm_up,
+            )
+        return _pool
+
+
+def _reset_pool(broken: ProcessPoolExecutor):
+    global _pool
+    with _pool_lock:
+        if _pool is broken:
+            _pool = None
+    broken.shutdown(wait=False)
+
+
+@on_warm_up
+def start_workers():
+    """
+    Starts the plot workers ahead of the first chart, from the main process only.
+    """
+    if multiprocessing.parent_process() is not None:
+        # e.g. a plot worker, which must not start workers of its own
+        return
+    if PLOT_WORKERS <= 0:
+        with _inline_lock:
+            _warm_up_inline()
+    else:
+        # the workers are spawned with the first task
+        _get_pool().submit(int)
+
+
+def _warm_up_inline():
+    global _warmed_up
+    if not _warmed_up:
+        _warm_up()
+        _warmed_up = True
+
+
+def _render_inline(spec: PlotSpec) -> Future:
+    future = Future()
+    with _inline_lock:
+        _warm_up_inline()
+        try:
+            future.set_result(render(spec))
+        except Exception as e:
+            future.set_exception(e)
+    return future
+
+
+def submit(spec: PlotSpec) -> Figure:
+    """
+    Starts rendering spec, unless it is cached already.
+    """
+    key = plot_key(spec)
+    png = plot_cache.get(key)
+    if png is not None:
+        future = Future()
+        future.set_result(png)
+        return Figure(key, future)
+    if PLOT_WORKERS <= 0:
+        return Figure(key, _render_inline(spec))
+    pool = _get_pool()
+    try:
+        return Figure(key, pool.submit(render, spec))
+    except BrokenProcessPool:
+        # a worker died, e.g. killed for its memory, start over once
+        print("Plot workers broken, restarting them.")
+        _reset_pool(pool)
+        return Figure(key, _get_pool().submit(render, spec))
+
+
+async def rendered(*figures: Figure) -> List[bytes]:
+    """
+    Awaits the PNG bytes of submitted figures without blocking the event loop.
+    """
+    return list(await asyncio.gather(*(asyncio.wrap_future(f.future) for f in figures)))
+
+
+async def images(*figures: Figure) -> List[str]:
+    """
+    Awaits submitted figures and returns the images to utter, URLs of the image
+    server by default.
+    """
+    return [
+        deliver(figure.key, png, plot_cache.put(figure.key, png))
+        for figure, png in zip(figures, await rendered(*figures))
+    ]
+
+
+def shutdown():
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.shutdown()
+        _pool = None
@@ -0,0 +1,144 @@
+import re
+from typing import NamedTuple, Tuple
+
+INVALID_GEOFENCE_STATI = (
+    "'GEOFENCE_DISABLED', 'UNKNOWN', 'ACCURACY_NEEDS_REFINEMENT', "
+    "'ESTIMATED_MEASURE_TO_BE_IGNORED'"
+)
+
+# a missing pulse is sent as MISSING_PULSE, see actions.utils.series
+SERIES_SELECT = """SELECT CAST(systolic AS int2), CAST(diastolic AS int2),
+        CAST(COALESCE(pulse, -1) AS int2), recorded_ts
+        FROM bloodpressure
+        WHERE user_id = %s
+        AND systolic IS NOT NULL AND diastolic IS NOT NULL
+        AND recorded_ts IS NOT NULL"""
+
+
+class Query(NamedTuple):
+    """
+    Named statement with bound parameters.
+
+    sql uses %s placeholders, so it can be executed directly by psycopg as well
+    as prepared on the server, where the placeholders become $1, $2, ...
+    """
+
+    name: str
+    param_types: Tuple[str, ...]
+    sql: str
+
+    @property
+    def prepare_statement(self) -> str:
+        counter = iter(range(1, len(self.param_types) + 1))
+        body = re.sub("%s", lambda _: f"${next(counter)}", self.sql)
+        return f"PREPARE {self.name} ({', '.join(self.param_types)}) AS {body}"
+
+    @property
+    def execute_statement(self) -> str:
+        if not self.param_types:
+            return f"EXECUTE {self.name}"
+        return f"EXECUTE {self.name} ({', '.join(['%s'] * len(self.param_types))})"
+
+
+_QUERIES = (
+    # most recent readings of a patient, LIMIT NULL returns all rows
+    Query(
+        "bloodpressure_recent",
+        ("bigint", "interval", "bigint"),
+        """SELECT recorded_at, systolic, diastolic, pulse
+        FROM bloodpressure
+        WHERE user_id = %s AND recorded_ts >= NOW() - CAST(%s AS interval)
+        ORDER BY recorded_ts DESC
+        LIMIT %s""",
+    ),
+    Query(
+        "bloodpressure_all",
+        ("bigint", "bigint"),
+        """SELECT recorded_at, systolic, diastolic, pulse
+        FROM bloodpressure
+        WHERE user_id = %s
+        ORDER BY recorded_ts DESC
+        LIMIT %s""",
+    ),
+    Query(
+        "latest_bp_measurement",
+        ("bigint",),
+        """SELECT id, systolic, diastolic, pulse, recorded_at
+        FROM bloodpressure WHERE user_id = %s ORDER BY recorded_ts DESC LIMIT 1""",
+    ),
+    # Series statements for DBHandler.fetch_series, they are run through binary COPY
+    # and decoded into a BloodPressureSeries, oldest first. Readings without systolic
+    # or diastolic value are skipped as NULL fields can not be decoded column wise,
+    # a missing pulse is sent as a sentinel instead. The actions slice their
+    # windows out of the cached series, see actions.utils.bp_cache.
+    # high-water mark of the readings of a patient, ids grow in insert order, so
+    # readings that arrive late with an older recorded_ts are above it as well
+    Query(
+        "series_last_id",
+        ("bigint",),
+        """SELECT MAX(id) FROM bloodpressure WHERE user_id = %s""",
+    ),
+    # readings up to a high-water mark
+    Query(
+        "series_all",
+        ("bigint", "bigint"),
+        f"""{SERIES_SELECT}
+        AND id <= %s
+        ORDER BY recorded_ts ASC""",
+    ),
+    # readings inserted after the high-water mark of a cached series, up to a new one
+    Query(
+        "series_after",
+        ("bigint", "bigint", "bigint"),
+        f"""{SERIES_SELECT}
+        AND id > %s AND id <= %s
+        ORDER BY recorded_ts ASC""",
+    ),
+    # values of all readings since a timestamp (NULL for the whole history) in no
+    # particular order, streamed by actions.utils.streaming
+    Query(
+        "series_values_since",
+        ("bigint", "timestamp"),
+        """SELECT systolic, diastolic, pulse
+        FROM bloodpressure
+        WHERE user_id = %s
+        AND systolic IS NOT NULL AND diastolic IS NOT NULL
+        AND recorded_ts >= COALESCE(CAST(%s AS timestamp), CAST('-infinity' AS timestamp))""",
+    ),
+    # most recent valid geofence status at each of the given timestamps, in their
+    # order, one index lookup per timestamp in a single round trip
+    Query(
+        "geofence_as_of",
+        ("timestamp[]", "bigint"),
+        f"""SELECT latest.geo_fence_status
+        FROM unnest(%s) WITH ORDINALITY AS reading(ts, idx)
+        LEFT JOIN LATERAL (
+            SELECT geo_fence_status
+            FROM geo_location
+            WHERE user_id = %s
+            AND recorded_ts <= reading.ts
+            AND geo_fence_status not in ({INVALID_GEOFENCE_STATI})
+            ORDER BY recorded_ts DESC
+            LIMIT 1
+        ) AS latest ON true
+        ORDER BY reading.idx""",
+    ),
+    Query(
+        "geofence_available",
+        ("bigint",),
+        f"""SELECT 1
+        FROM geo_location
+        WHERE user_id = %s
+        AND geo_fence_status not in ({INVALID_GEOFENCE_STATI})
+        LIMIT 1""",
+    ),
+    # read through actions.utils.patient_cache
+    Query(
+        "patient_details",
+        ("bigint",),
+        """SELECT id, health, geo, user_id, nickname, title, home_longitude, home_latitude, birthday, sex,
+        medical_preconditions FROM patient WHERE user_id = %s""",
+    ),
+)
+
+QUERIES = {query.name: query for query in _QUERIES}
@@ -0,0 +1,363 @@
+"""
+Per patient daily and monthly aggregates of the blood pressure readings.
+
+Every rollup row holds count, sum, sum of squares, min and max per measure and
+how many readings lay below, within and above the target corridor of the
+patient, keyed by (user_id, bucket, daytime). The rollups are maintained
+incrementally: refresh_rollups only aggregates the readings inserted since the
+last refresh and adds them to the rows of the buckets they fall into.
+
+"Inserted since" means an id of bloodpressure above the last id of the previous
+refresh, not a later recorded_ts, so readings that arrive late with an older
+timestamp (e.g. from a device that synced after being offline) are still
+counted, in their past bucket. This relies on the ids being assigned in insert
+order; an insert that commits only after a refresh saw a higher id is missed
+until the next rebuild. Readings that are updated or deleted are not tracked
+either. If the corridor of a patient changed (e.g. at the 65th birthday) the
+rollups of the patient are rebuilt, `python -m actions.utils.rollups --rebuild`
+rebuilds those of all patients.
+
+The rollups are refreshed on read, not as readings land: the readings are
+inserted by the PRISM backend, which the action server has no hook into, and a
+trigger would put the aggregation on every insert of the devices. So
+get_rollup_stats refreshes the patient first, at most once per
+INSIGHTS_ROLLUP_REFRESH seconds (default 60) and process. Within that interval
+a process may answer from rollups that miss the newest readings, while the
+series cache (INSIGHTS_BP_CACHE_REFRESH) or another process already has them.
+Set both intervals to 0 where answers have to agree to the reading.
+
+The tables are created by actions.utils.migrations. Run
+`python -m actions.utils.rollups` regularly, e.g. from a cron job, to refresh all
+patients ahead of time, so the refresh on read only has the latest readings to
+merge and corridor changes are rebuilt there rather than while answering.
+"""
+
+import os
+import sys
+import threading
+import time
+from typing import List, Sequence
+
+from actions.utils.corridors import PULSE_RANGE
+from actions.utils.daytimes import DAYTIMES
+from actions.utils.db_utils import DBHandler
+from actions.utils.stats import MEASURES, GroupStats
+from actions.utils.utils import get_bp_range
+
+# seconds in which a patient is not refreshed again by the same process
+ROLLUP_REFRESH_INTERVAL = float(os.environ.get("INSIGHTS_ROLLUP_REFRESH", "60"))
+
+# same split as the daytime analysis of the actions
+DAYTIME_SQL = DAYTIMES.sql("recorded_ts")
+# table per granularity and the DATE_TRUNC unit of its buckets
+GRANULARITIES = {"daily": "day", "monthly": "month"}
+
+# count is the number of readings with a value of the measure, a reading without
+# pulse only counts for systolic and diastolic; min and max are NULL without any
+_COLUMN_TYPES = {
+    "count": "integer",
+    "sum": "bigint",
+    "sumsq": "bigint",
+    "min": "smallint",
+    "max": "smallint",
+    "below": "integer",
+    "within": "integer",
+    "above": "integer",
+}
+_MEASURE_COLUMNS = [
+    f"{measure}_{column}" for measure in MEASURES for column in _COLUMN_TYPES
+]
+
+
+def _table(granularity: str) -> str:
+    if granularity not in GRANULARITIES:
+        raise ValueError(
+            f"Unknown rollup granularity {granularity}, expected one of "
+            f"{', '.join(GRANULARITIES)}."
+        )
+    return f"bloodpressure_{granularity}"
+
+
+def create_statements() -> List[str]:
+    """
+    DDL of the rollup tables, applied by actions.utils.migrations.
+    """
+    measure_columns = ",\n            ".join(
+        f"{column} {_COLUMN_TYPES[column.rsplit('_', 1)[1]]}"
+        + ("" if column.endswith(("_min", "_max")) else " NOT NULL")
+        for column in _MEASURE_COLUMNS
+    )
+    # tables of before the counts per measure left out the readings without
+    # pulse, they are dropped and rebuilt from scratch
+    statements = [f"""
+        DO $$
+        BEGIN
+            IF to_regclass('{_table(granularity)}') IS NOT NULL AND NOT EXISTS (
+                SELECT 1 FROM information_schema.columns
+                WHERE table_name = '{_table(granularity)}'
+                AND column_name = 'pulse_count'
+            ) THEN
+                DROP TABLE {_table(granularity)};
+                DELETE FROM bloodpressure_rollup_state;
+            END IF;
+        END $$
+        """ for granularity in GRANULARITIES]
+    statements += [f"""
+        CREATE TABLE IF NOT EXISTS {_table(granularity)} (
+            user_id bigint NOT NULL,
+            bucket date NOT NULL,
+            daytime character varying(16) NOT NULL,
+            count integer NOT NULL,
+            {measure_columns},
+            all_within integer NOT NULL,
+            PRIMARY KEY (user_id, bucket, daytime)
+        )
+        """ for granularity in GRANULARITIES]
+    statements.append("""
+        CREATE TABLE IF NOT EXISTS bloodpressure_rollup_state (
+            user_id bigint PRIMARY KEY,
+            last_id bigint,
+            systolic_low smallint NOT NULL,
+            systolic_high smallint NOT NULL,
+            diastolic_low smallint NOT NULL,
+            diastolic_high smallint NOT NULL
+        )
+        """)
+    # the state used to hold the latest recorded_ts, which missed late readings;
+    # patients without a last_id are rebuilt on their next refresh
+    statements += [
+        "ALTER TABLE bloodpressure_rollup_state ADD COLUMN IF NOT EXISTS last_id bigint",
+        "ALTER TABLE bloodpressure_rollup_state DROP COLUMN IF EXISTS watermark",
+        """
+        CREATE INDEX IF NOT EXISTS bloodpressure_user_id_id_idx
+        ON bloodpressure (user_id, id)
+        """,
+    ]
+    return statements
+
+
+def _upsert_statement(granularity: str) -> str:
+    aggregates = []
+    for measure in MEASURES:
+        low, high = f"%({measure}_low)s", f"%({measure}_high)s"
+        aggregates += [
+            f"COUNT({measure})",
+            f"COALESCE(SUM({measure}), 0)",
+            f"COALESCE(SUM(CAST({measure} AS bigint) * {measure}), 0)",
+            f"MIN({measure})",
+            f"MAX({measure})",
+            f"COUNT(*) FILTER (WHERE {measure} < {low})",
+            f"COUNT(*) FILTER (WHERE {measure} BETWEEN {low} AND {high})",
+            f"COUNT(*) FILTER (WHERE {measure} > {high})",
+        ]
+    # a missing value does not count against the reading
+    all_within = " AND ".join(
+        f"({measure} IS NULL OR {measure} BETWEEN %({measure}_low)s AND %({measure}_high)s)"
+        for measure in MEASURES
+    )
+    merge = ["count = existing.count + EXCLUDED.count"]
+    for column in _MEASURE_COLUMNS + ["all_within"]:
+        if column.endswith("_min"):
+            merge.append(f"{column} = LEAST(existing.{column}, EXCLUDED.{column})")
+        elif column.endswith("_max"):
+            merge.append(f"{column} = GREATEST(existing.{column}, EXCLUDED.{column})")
+        else:
+            merge.append(f"{column} = existing.{column} + EXCLUDED.{column}")
+    return f"""
+    INSERT INTO {_table(granularity)} AS existing
+        (user_id, bucket, daytime, count, {", ".join(_MEASURE_COLUMNS)}, all_within)
+    SELECT
+        user_id,
+        CAST(DATE_TRUNC('{GRANULARITIES[granularity]}', recorded_ts) AS date),
+        {DAYTIME_SQL},
+        COUNT(*),
+        {", ".join(aggregates)},
+        COUNT(*) FILTER (WHERE {all_within})
+    FROM bloodpressure
+    WHERE user_id = %(user_id)s
+    AND (%(since_id)s IS NULL OR id > %(since_id)s)
+    AND id <= %(until_id)s
+    AND recorded_ts IS NOT NULL
+    AND systolic IS NOT NULL AND diastolic IS NOT NULL
+    GROUP BY 1, 2, 3
+    ON CONFLICT (user_id, bucket, daytime) DO UPDATE SET {", ".join(merge)}
+    """
+
+
+_UPSERTS = {
+    granularity: _upsert_statement(granularity) for granularity in GRANULARITIES
+}
+
+
+def _corridor_params(corridor) -> dict:
+    (systolic_low, systolic_high), (diastolic_low, diastolic_high) = corridor
+    return {
+        "systolic_low": int(systolic_low),
+        "systolic_high": int(systolic_high),
+        "diastolic_low": int(diastolic_low),
+        "diastolic_high": int(diastolic_high),
+        "pulse_low": PULSE_RANGE[0],
+        "pulse_high": PULSE_RANGE[1],
+    }
+
+
+_refreshed = {}
+_refreshed_lock = threading.Lock()
+
+
+def refresh_rollups(user_id, corridor, force=False, rebuild=False):
+    """
+    Merges the readings inserted since the last refresh into the rollups of the
+    patient, whatever their recorded_ts. corridor is (systolic_range,
+    diastolic_range) as returned by get_bp_range. rebuild aggregates all readings
+    of the patient anew.
+    """
+    params = _corridor_params(corridor)
+    corridor_key = (
+        params["systolic_low"],
+        params["systolic_high"],
+        params["diastolic_low"],
+        params["diastolic_high"],
+    )
+    key = str(user_id)
+    with _refreshed_lock:
+        refreshed_at, refreshed_corridor = _refreshed.get(key, (None, None))
+    if (
+        not force
+        and not rebuild
+        and refreshed_corridor == corridor_key
+        and time.monotonic() - refreshed_at < ROLLUP_REFRESH_INTERVAL
+    ):
+        return
+
+    with DBHandler(silent=True).connection() as conn:
+        with conn.cursor() as cur:
+            # concurrent refreshes of the same patient would merge readings twice
+            cur.execute("SELECT pg_advisory_xact_lock(%s)", (int(user_id),))
+            cur.execute(
+                """SELECT last_id, systolic_low, systolic_high, diastolic_low, diastolic_high
+                FROM bloodpressure_rollup_state WHERE user_id = %s""",
+                (user_id,),
+            )
+            state = cur.fetchone()
+            since_id = state[0] if state else None
+            if state is not None and tuple(state[1:]) != corridor_key:
+                print(
+                    f"Rebuilding the blood pressure rollups of patient {user_id}, "
+                    f"the corridor changed from {tuple(state[1:])} to {corridor_key}."
+                )
+            if (
+                rebuild
+                or state is None
+                or since_id is None
+                or tuple(state[1:]) != corridor_key
+            ):
+                for granularity in GRANULARITIES:
+                    cur.execute(
+                        f"DELETE FROM {_table(granularity)} WHERE user_id = %s",
+                        (user_id,),
+                    )
+                since_id = None
+            cur.execute(
+                "SELECT MAX(id) FROM bloodpressure WHERE user_id = %s",
+                (user_id,),
+            )
+            until_id = cur.fetchone()[0]
+            if until_id is not None and (since_id is None or until_id > since_id):
+                for upsert in _UPSERTS.values():
+                    cur.execute(
+                        upsert,
+                        {
+                            **params,
+                            "user_id": user_id,
+                            "since_id": since_id,
+                            "until_id": until_id,
+                        },
+                    )
+                since_id = until_id
+            cur.execute(
+                """INSERT INTO bloodpressure_rollup_state
+                (user_id, last_id, systolic_low, systolic_high, diastolic_low, diastolic_high)
+                VALUES (%s, %s, %s, %s, %s, %s)
+                ON CONFLICT (user_id) DO UPDATE SET
+                last_id = EXCLUDED.last_id,
+                systolic_low = EXCLUDED.systolic_low,
+                systolic_high = EXCLUDED.systolic_high,
+                diastolic_low = EXCLUDED.diastolic_low,
+                diastolic_high = EXCLUDED.diastolic_high""",
+                (user_id, since_id, *corridor_key),
+            )
+        conn.commit()
+    with _refreshed_lock:
+        _refreshed[key] = (time.monotonic(), corridor_key)
+
+
+def get_rollup_stats(
+    user_id,
+    corridor,
+    granularity: str = "monthly",
+    since=None,
+    before=None,
+    group_by: Sequence[str] = ("bucket",),
+) -> List[GroupStats]:
+    """
+    Refreshes the rollups of the patient and sums them up per group, ordered by
+    bucket and daytime.
+
+    since and before are compared with the bucket, so for daily rollups the
+    window is widened to whole days. group_by may contain "bucket", "month"
+    (daily buckets summed up per month) and "daytime"; without grouping a single
+    total over the window is returned.
+    """
+    refresh_rollups(user_id, corridor)
+    bucket = "NULL::date"
+    if "bucket" in group_by:
+        bucket = "bucket"
+    elif "month" in group_by:
+        bucket = "CAST(DATE_TRUNC('month', bucket) AS date)"
+    daytime = "daytime" if "daytime" in group_by else "NULL::varchar"
+    sums = []
+    for column in ["count"] + _MEASURE_COLUMNS + ["all_within"]:
+        if column.endswith("_min"):
+            sums.append(f"MIN({column})")
+        elif column.endswith("_max"):
+            sums.append(f"MAX({column})")
+        else:
+            sums.append(f"CAST(SUM({column}) AS bigint)")
+    conditions = ["user_id = %(user_id)s"]
+    if since is not None:
+        conditions.append("bucket >= CAST(%(since)s AS date)")
+    if before is not None:
+        conditions.append("bucket < CAST(%(before)s AS date)")
+    query = f"""SELECT {bucket}, {daytime}, {", ".join(sums)}
+    FROM {_table(granularity)}
+    WHERE {" AND ".join(conditions)}
+    GROUP BY 1, 2
+    ORDER BY 1, 2"""
+    result = DBHandler(silent=True).execute_query(
+        query, {"user_id": user_id, "since": since, "before": before}
+    )
+    return [GroupStats(*row) for row in result]
+
+
+def refresh_all(rebuild=False):
+    with DBHandler(silent=True).connection() as conn, conn.cursor() as cur:
+        cur.execute("SELECT user_id, birthday, medical_preconditions FROM patient")
+        patients = cur.fetchall()
+    for user_id, birthday, medical_preconditions in patients:
+        if user_id is None:
+            continue
+        refresh_rollups(
+            user_id,
+            get_bp_range(birthday, medical_preconditions not in ["", None]),
+            force=True,
+            rebuild=rebuild,
+        )
+    print(
+        f"{'Rebuilt' if rebuild else 'Refreshed'} the blood pressure rollups of "
+        f"{len(patients)} patients."
+    )
+
+
+if __name__ == "__main__":
+    refresh_all(rebuild="--rebuild" in sys.argv[1:])
@@ -0,0 +1,174 @@
+from datetime import datetime
+from typing import Sequence
+
+import numpy as np
+
+from actions.utils.lazy import lazy_import
+
+pd = lazy_import("pandas")
+
+# binary COPY header: signature, int32 flags and int32 length of the header extension
+COPY_SIGNATURE = b"PGCOPY\n\xff\r\n\x00"
+# PostgreSQL counts timestamps in microseconds since 2000-01-01
+PG_EPOCH_OFFSET_US = 946_684_800_000_000
+
+# One row of "systolic::int2, diastolic::int2, pulse::int2, recorded_ts" in binary
+# COPY format. Every field is prefixed with its length, as none of the columns can
+# be NULL all rows have the same size and can be decoded without a per row loop.
+# A missing pulse is selected as MISSING_PULSE instead of NULL for that reason.
+COPY_ROW = np.dtype(
+    [
+        ("field_count", ">i2"),
+        ("systolic_length", ">i4"),
+        ("systolic", ">i2"),
+        ("diastolic_length", ">i4"),
+        ("diastolic", ">i2"),
+        ("pulse_length", ">i4"),
+        ("pulse", ">i2"),
+        ("recorded_ts_length", ">i4"),
+        ("recorded_ts", ">i8"),
+    ]
+)
+MISSING_PULSE = -1
+
+
+class BloodPressureSeries:
+    """
+    Blood pressure readings of a patient as parallel arrays, oldest first.
+
+    systolic and diastolic are int16 arrays, pulse is a float32 array with NaN for
+    readings without pulse and recorded_at is datetime64[us]. Indexing with a slice
+    or a boolean mask returns a new series.
+    """
+
+    __slots__ = ("systolic", "diastolic", "pulse", "recorded_at")
+
+    def __init__(self, systolic, diastolic, pulse, recorded_at):
+        self.systolic = np.asarray(systolic, dtype=np.int16)
+        self.diastolic = np.asarray(diastolic, dtype=np.int16)
+        self.pulse = np.asarray(pulse, dtype=np.float32)
+        self.recorded_at = np.asarray(recorded_at, dtype="datetime64[us]")
+
+    @classmethod
+    def empty(cls) -> "BloodPressureSeries":
+        return cls([], [], [], [])
+
+    @classmethod
+    def from_copy(cls, data: bytes) -> "BloodPressureSeries":
+        """
+        Decodes the output of COPY (...) TO STDOUT (FORMAT binary) of a series
+        statement, see actions.utils.queries.
+        """
+        if not data.startswith(COPY_SIGNATURE):
+            raise ValueError("Not a binary COPY stream.")
+        extension_length = int.from_bytes(
+            data[len(COPY_SIGNATURE) + 4 : len(COPY_SIGNATURE) + 8], "big"
+        )
+        header_length = len(COPY_SIGNATURE) + 8 + extension_length
+        # the stream ends with a field count of -1
+        body = memoryview(data)[header_length:-2]
+        if len(body) % COPY_ROW.itemsize:
+            raise ValueError("Unexpected row layout in binary COPY stream.")
+        rows = np.frombuffer(body, dtype=COPY_ROW)
+        pulse = rows["pulse"].astype(np.float32)
+        pulse[rows["pulse"] == MISSING_PULSE] = np.nan
+        return cls(
+            rows["systolic"],
+            rows["diastolic"],
+            pulse,
+            (rows["recorded_ts"].astype(np.int64) + PG_EPOCH_OFFSET_US).view(
+                "datetime64[us]"
+            ),
+        )
+
+    @classmethod
+    def concatenate(cls, *series: "BloodPressureSeries") -> "BloodPressureSeries":
+        return cls(
+            np.concatenate([s.systolic for s in series]),
+            np.concatenate([s.diastolic for s in series]),
+            np.concatenate([s.pulse for s in series]),
+            np.concatenate([s.recorded_at for s in series]),
+        )
+
+    def __len__(self) -> int:
+        return len(self.recorded_at)
+
+    def __getitem__(self, index) -> "BloodPressureSeries":
+        return BloodPressureSeries(
+            self.systolic[index],
+            self.diastolic[index],
+            self.pulse[index],
+            self.recorded_at[index],
+        )
+
+    def __repr__(self) -> str:
+        if not len(self):
+            return "BloodPressureSeries(empty)"
+        return (
+            f"BloodPressureSeries({len(self)} readings from {self.recorded_at[0]} "
+            f"to {self.recorded_at[-1]})"
+        )
+
+    @property
+    def nbytes(self) -> int:
+        return (
+            self.systolic.nbytes
+            + self.diastolic.nbytes
+            + self.pulse.nbytes
+            + self.recorded_at.nbytes
+        )
+
+    @property
+    def hours(self) -> np.ndarray:
+        """
+        Hour of the day of every reading.
+        """
+        return (
+            (self.recorded_at - self.recorded_at.astype("datetime64[D]"))
+            .astype("timedelta64[h]")
+            .astype(np.int64)
+        )
+
+    @property
+    def ordinals(self) -> np.ndarray:
+        """
+        Proleptic Gregorian ordinal of the day of every reading, as date.toordinal().
+        """
+        return (
+            self.recorded_at.astype("datetime64[D]").astype(np.int64)
+            + datetime(1970, 1, 1).toordinal()
+        )
+
+    @property
+    def last_recorded_at(self):
+        return self.recorded_at[-1].item() if len(self) else None
+
+    def datetimes(self) -> list:
+        return self.recorded_at.tolist()
+
+    def since(self, start) -> "BloodPressureSeries":
+        start = np.datetime64(pd.Timestamp(start), "us")
+        return self[np.searchsorted(self.recorded_at, start, side="left") :]
+
+    def before(self, end, inclusive=False) -> "BloodPressureSeries":
+        end = np.datetime64(pd.Timestamp(end), "us")
+        side = "right" if inclusive else "left"
+        return self[: np.searchsorted(self.recorded_at, end, side=side)]
+
+    def to_frame(
+        self,
+        columns: Sequence[str] = ("systolic", "diastolic", "pulse", "recorded_at"),
+    ) -> "pd.DataFrame":
+        """
+        DataFrame with the columns systolic, diastolic, pulse and recorded_at,
+        named by columns.
+        """
+        systolic, diastolic, pulse, recorded_at = columns
+        return pd.DataFrame(
+            {
+                systolic: self.systolic,
+                diastolic: self.diastolic,
+                pulse: self.pulse,
+                recorded_at: self.recorded_at,
+            }
+        )
@@ -0,0 +1,171 @@
+import math
+from datetime import date
+from typing import Dict, NamedTuple, Optional, Sequence, Tuple
+
+import numpy as np
+
+from actions.utils.corridors import ABOVE, BELOW, LABELS, WITHIN, Corridor, classify
+
+MEASURES = ("systolic", "diastolic", "pulse")
+
+
+class GroupStats(NamedTuple):
+    """
+    Aggregates of the readings of one group. The rollups fill bucket and daytime
+    if they were grouped by them, grouped_stats leaves them None.
+
+    count is the number of readings, <measure>_count the number of them with a
+    value of the measure. Readings without pulse still count for systolic and
+    diastolic, the pulse statistics of a group without any are NaN and None.
+    """
+
+    bucket: Optional[date]
+    daytime: Optional[str]
+    count: int
+    systolic_count: int
+    systolic_sum: int
+    systolic_sumsq: int
+    systolic_min: int
+    systolic_max: int
+    systolic_below: int
+    systolic_within: int
+    systolic_above: int
+    diastolic_count: int
+    diastolic_sum: int
+    diastolic_sumsq: int
+    diastolic_min: int
+    diastolic_max: int
+    diastolic_below: int
+    diastolic_within: int
+    diastolic_above: int
+    pulse_count: int
+    pulse_sum: int
+    pulse_sumsq: int
+    pulse_min: int
+    pulse_max: int
+    pulse_below: int
+    pulse_within: int
+    pulse_above: int
+    all_within: int
+
+    def min(self, measure: str) -> int:
+        return getattr(self, f"{measure}_min")
+
+    def max(self, measure: str) -> int:
+        return getattr(self, f"{measure}_max")
+
+    def count_of(self, measure: str) -> int:
+        return getattr(self, f"{measure}_count")
+
+    def mean(self, measure: str) -> float:
+        count = self.count_of(measure)
+        return getattr(self, f"{measure}_sum") / count if count else math.nan
+
+    def std(self, measure: str) -> float:
+        """
+        Population standard deviation.
+        """
+        count = self.count_of(measure)
+        if not count:
+            return math.nan
+        mean = self.mean(measure)
+        variance = getattr(self, f"{measure}_sumsq") / count - mean**2
+        return math.sqrt(max(variance, 0.0))
+
+    def percentages(self, measure: str) -> Tuple[float, float, float]:
+        """
+        Share of the readings with a value of the measure below, within and above
+        the corridor in percent.
+        """
+        count = self.count_of(measure)
+        if not count:
+            return math.nan, math.nan, math.nan
+        return (
+            getattr(self, f"{measure}_below") / count * 100,
+            getattr(self, f"{measure}_within") / count * 100,
+            getattr(self, f"{measure}_above") / count * 100,
+        )
+
+
+def grouped_stats(
+    systolic, diastolic, pulse, codes, labels: Sequence, corridor: Corridor
+) -> Dict[object, GroupStats]:
+    """
+    GroupStats of the readings per group, keyed by labels[code] and in the order
+    of labels. codes holds the group of every reading, readings with a negative
+    code are left out, as are groups without readings. Missing values (NaN) are
+    left out of the statistics of their measure only, and all_within counts the
+    readings whose present values are all within. corridor may also be a
+    (systolic, diastolic) pair, which gets the default pulse corridor.
+    """
+    corridor = Corridor(*corridor)
+    codes = np.asarray(codes, dtype=np.intp)
+    selected = codes >= 0
+    codes = codes[selected]
+    n_groups = len(labels)
+    count = np.bincount(codes, minlength=n_groups)
+    present = np.flatnonzero(count)
+    # sorted by group, min and max are reduced over contiguous runs
+    order = np.argsort(codes, kind="stable")
+    starts = np.searchsorted(codes[order], present)
+
+    columns = [count[present]]
+    within_all = np.ones(len(codes), dtype=bool)
+    for measure, values in zip(MEASURES, (systolic, diastolic, pulse)):
+        values = np.asarray(values, dtype=np.float64)[selected]
+        present_values = ~np.isnan(values)
+        weights = np.where(present_values, values, 0.0)
+        classes = classify(values, getattr(corridor, measure))
+        within_all &= (classes == WITHIN) | ~present_values
+        per_class = np.bincount(
+            codes * len(LABELS) + classes, minlength=n_groups * len(LABELS)
+        ).reshape(n_groups, len(LABELS))
+        columns += [
+            np.bincount(codes, present_values, minlength=n_groups)[present],
+            np.bincount(codes, weights, minlength=n_groups)[present],
+            np.bincount(codes, weights * weights, minlength=n_groups)[present],
+            _extremes(np.minimum, values, order, starts, np.inf),
+            _extremes(np.maximum, values, order, starts, -np.inf),
+            per_class[present, BELOW],
+            per_class[present, WITHIN],
+            per_class[present, ABOVE],
+        ]
+    columns.append(np.bincount(codes, within_all, minlength=n_groups)[present])
+
+    rows = zip(*(np.asarray(column).tolist() for column in columns))
+    return {
+        labels[group]: GroupStats(None, None, *_integral(row))
+        for group, row in zip(present.tolist(), rows)
+    }
+
+
+def series_stats(series, corridor: Corridor, codes=None, labels: Sequence = (None,)):
+    """
+    grouped_stats of a BloodPressureSeries, all readings in one group keyed None
+    without codes.
+    """
+    if codes is None:
+        codes = np.zeros(len(series), dtype=np.intp)
+    return grouped_stats(
+        series.systolic, series.diastolic, series.pulse, codes, labels, corridor
+    )
+
+
+def _extremes(reduce, values, order, starts, missing: float) -> list:
+    """
+    Minimum or maximum of the present values per run of the sorted groups, None
+    for groups without any.
+    """
+    if not len(starts):
+        return []
+    sorted_values = np.where(np.isnan(values), missing, values)[order]
+    extremes = reduce.reduceat(sorted_values, starts).tolist()
+    return [None if value == missing else value for value in extremes]
+
+
+def _integral(row):
+    # bincount sums as floats, they are exact for integral readings
+    return [
+        int(value) if isinstance(value, float) and value.is_integer() else value
+        for value in row
+    ]
@@ -0,0 +1,167 @@
+"""
+Statistics over the whole history of a patient in constant memory.
+
+The readings are streamed from a server side cursor in chunks (see
+DBHandler.stream_named) and folded into a StreamingStats: mean and variance per
+measure with Welford's update, merged chunk wise, plus min, max and the counts
+below, within and above the corridor. Only the current chunk is held in memory,
+no matter how many years of readings a patient has.
+"""
+
+import math
+from typing import Optional, Tuple
+
+import numpy as np
+
+from actions.utils.corridors import ABOVE, BELOW, WITHIN, Corridor, classify
+from actions.utils.db_utils import DBHandler
+from actions.utils.stats import MEASURES, GroupStats
+
+
+class StreamingStats:
+    """
+    Running count, mean, sum of squared deviations (M2), min, max and corridor
+    counts of systolic, diastolic and pulse values, one entry per measure. count
+    is the number of readings, missing values (NaN, e.g. a reading without pulse)
+    only leave out their measure.
+    """
+
+    __slots__ = (
+        "corridor",
+        "count",
+        "_counts",
+        "_mean",
+        "_m2",
+        "_min",
+        "_max",
+        "_classes",
+        "all_within",
+    )
+
+    def __init__(self, corridor: Corridor):
+        self.corridor = Corridor(*corridor)
+        self.count = 0
+        self._counts = np.zeros(len(MEASURES), dtype=np.int64)
+        self._mean = np.zeros(len(MEASURES))
+        self._m2 = np.zeros(len(MEASURES))
+        self._min = np.full(len(MEASURES), np.inf)
+        self._max = np.full(len(MEASURES), -np.inf)
+        # below, within and above per measure
+        self._classes = np.zeros((len(MEASURES), 3), dtype=np.int64)
+        self.all_within = 0
+
+    def update(self, systolic, diastolic, pulse) -> "StreamingStats":
+        """
+        Folds a chunk of readings in. The chunk's mean and M2 are merged with the
+        running ones (Chan et al.), which is Welford's update for a whole chunk.
+        """
+        values = np.array([systolic, diastolic, pulse], dtype=np.float64)
+        if not values.shape[1]:
+            return self
+        within_all = np.ones(values.shape[1], dtype=bool)
+        for i, measure in enumerate(MEASURES):
+            classes = classify(values[i], getattr(self.corridor, measure))
+            self._classes[i] += np.bincount(classes, minlength=4)[
+                [BELOW, WITHIN, ABOVE]
+            ]
+            present = values[i][~np.isnan(values[i])]
+            within_all &= (classes == WITHIN) | np.isnan(values[i])
+            count = len(present)
+            if not count:
+                continue
+            mean = present.mean()
+            m2 = ((present - mean) ** 2).sum()
+            known = self._counts[i]
+            total = known + count
+            delta = mean - self._mean[i]
+            self._mean[i] += delta * (count / total)
+            self._m2[i] += m2 + delta**2 * (known * count / total)
+            self._counts[i] = total
+            self._min[i] = min(self._min[i], present.min())
+            self._max[i] = max(self._max[i], present.max())
+        self.count += values.shape[1]
+        self.all_within += int(within_all.sum())
+        return self
+
+    def update_rows(self, rows) -> "StreamingStats":
+        """
+        Folds in (systolic, diastolic, pulse) tuples as fetched from the cursor,
+        None becomes NaN.
+        """
+        if rows:
+            self.update(*np.array(rows, dtype=np.float64).T)
+        return self
+
+    def count_of(self, measure: str) -> int:
+        return int(self._counts[MEASURES.index(measure)])
+
+    def mean(self, measure: str) -> float:
+        if not self.count_of(measure):
+            return math.nan
+        return float(self._mean[MEASURES.index(measure)])
+
+    def variance(self, measure: str) -> float:
+        """
+        Population variance.
+        """
+        count = self.count_of(measure)
+        if not count:
+            return math.nan
+        return float(self._m2[MEASURES.index(measure)]) / count
+
+    def std(self, measure: str) -> float:
+        return math.sqrt(self.variance(measure))
+
+    def min(self, measure: str) -> Optional[int]:
+        return self._extreme(self._min, measure)
+
+    def max(self, measure: str) -> Optional[int]:
+        return self._extreme(self._max, measure)
+
+    def _extreme(self, extremes, measure: str) -> Optional[int]:
+        return (
+            int(extremes[MEASURES.index(measure)]) if self.count_of(measure) else None
+        )
+
+    def percentages(self, measure: str) -> Tuple[float, float, float]:
+        """
+        Share of the readings with a value of the measure below, within and above
+        the corridor in percent.
+        """
+        count = self.count_of(measure)
+        if not count:
+            return math.nan, math.nan, math.nan
+        below, within, above = self._classes[MEASURES.index(measure)].tolist()
+        return below / count * 100, within / count * 100, above / count * 100
+
+    def to_group_stats(self) -> GroupStats:
+        """
+        The statistics as GroupStats, with sums derived from mean and M2.
+        """
+        fields = [None, None, self.count]
+        for i, measure in enumerate(MEASURES):
+            total = self._mean[i] * self._counts[i]
+            fields += [
+                int(self._counts[i]),
+                float(total),
+                float(self._m2[i] + total * self._mean[i]),
+                self.min(measure),
+                self.max(measure),
+                *self._classes[i].tolist(),
+            ]
+        return GroupStats(*fields, self.all_within)
+
+
+def stream_stats(
+    user_id, corridor: Corridor, since=None, chunk_size: Optional[int] = None
+) -> Optional[StreamingStats]:
+    """
+    StreamingStats of all readings of the patient since since, or of the whole
+    history without since. None if there are no readings.
+    """
+    stats = StreamingStats(corridor)
+    for rows in DBHandler(silent=True).stream_named(
+        "series_values_since", (user_id, since), chunk_size
+    ):
+        stats.update_rows(rows)
+    return stats if stats.count else None
@@ -0,0 +1,79 @@
+from typing import NamedTuple, Sequence, Tuple
+
+import numpy as np
+
+
+class SegmentTrends(NamedTuple):
+    """
+    Least squares line y = intercept + slope * x per segment, as arrays with one
+    entry per segment. start and end are the fitted values at the first and the
+    last x of the segment.
+    """
+
+    slope: np.ndarray
+    intercept: np.ndarray
+    start: np.ndarray
+    end: np.ndarray
+    r2: np.ndarray
+    count: np.ndarray
+
+
+def segment_trends(x, y, bounds: Sequence[int]) -> SegmentTrends:
+    """
+    Linear trends of the segments [bounds[i], bounds[i + 1]) of x and y, all at
+    once from prefix sums. Like LinearRegression, a segment with a single x value
+    gets slope 0 and the mean of y as intercept.
+    """
+    x = np.asarray(x, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+    bounds = np.asarray(bounds, dtype=np.intp)
+    starts, ends = bounds[:-1], bounds[1:]
+    # centered, so the sums of squares of e.g. day ordinals do not lose precision
+    x_offset = x.mean() if len(x) else 0.0
+    y_offset = y.mean() if len(y) else 0.0
+    dx = x - x_offset
+    dy = y - y_offset
+    prefix = np.zeros((5, len(x) + 1))
+    np.cumsum(np.stack([dx, dy, dx * dx, dx * dy, dy * dy]), axis=1, out=prefix[:, 1:])
+    sx, sy, sxx, sxy, syy = prefix[:, ends] - prefix[:, starts]
+
+    count = ends - starts
+    n = np.maximum(count, 1)
+    x_mean = sx / n
+    y_mean = sy / n
+    # sums of squares around the segment means
+    ssx = np.maximum(sxx - sx * x_mean, 0.0)
+    sxy = sxy - sx * y_mean
+    ssy = np.maximum(syy - sy * y_mean, 0.0)
+    # relative, so rounding noise of a constant x does not become a slope
+    constant_x = ssx <= 1e-12 * np.maximum(sxx, 1.0)
+    slope = np.where(constant_x, 0.0, sxy / np.where(constant_x, 1.0, ssx))
+    intercept = y_mean + y_offset - slope * (x_mean + x_offset)
+    residual = np.maximum(ssy - slope * sxy, 0.0)
+    varying_y = ssy > 1e-12 * np.maximum(syy, 1.0)
+    r2 = np.where(varying_y, 1.0 - residual / np.where(varying_y, ssy, 1.0), 1.0)
+
+    last = np.maximum(ends - 1, starts)
+    first_x = x[np.minimum(starts, len(x) - 1)] if len(x) else starts * 0.0
+    last_x = x[np.minimum(last, len(x) - 1)] if len(x) else starts * 0.0
+    return SegmentTrends(
+        slope,
+        intercept,
+        intercept + slope * first_x,
+        intercept + slope * last_x,
+        r2,
+        count,
+    )
+
+
+def run_bounds(labels) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Labels and bounds of the runs of equal consecutive labels, e.g. the months of
+    readings sorted by time, for segment_trends.
+    """
+    labels = np.asarray(labels)
+    if not len(labels):
+        return labels, np.zeros(1, dtype=np.intp)
+    changes = np.flatnonzero(labels[1:] != labels[:-1]) + 1
+    bounds = np.concatenate(([0], changes, [len(labels)]))
+    return labels[bounds[:-1]], bounds
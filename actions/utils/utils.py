@@ -1,7 +1,25 @@
-from datetime import datetime
+from datetime import date, datetime
 from typing import List, Tuple
 
+import numpy as np
+
+from actions.utils.bp_cache import blood_pressure_cache
+from actions.utils.corridors import (
+    LABELS,
+    age_corridor,
+    class_counts,
+    classify,
+    outside,
+    target_corridor,
+    within,
+)
+from actions.utils.daytimes import TIMES_OF_DAY
 from actions.utils.db_utils import DBHandler
+from actions.utils.lazy import lazy_import
+from actions.utils.patient_cache import patient_cache
+from actions.utils.series import BloodPressureSeries
+
+pd = lazy_import("pandas")
 
 zeitspanne_to_timespan = {
     "Tag": "day",
@@ -40,50 +58,47 @@ at_the_last_prefix = {
 }
 
 
-def get_patient_details(user_id: str, force_reload=False, tracker=None) -> dict:
-    if not force_reload and tracker and tracker.get_slot("birthday"):
-        patient_details = {
-            "health": tracker.get_slot("health"),
-            "geo": tracker.get_slot("geo"),
-            "user_id": tracker.get_slot("user_id"),
-            "nickname": tracker.get_slot("nickname"),
-            "title": tracker.get_slot("title"),
-            "home_longitude": tracker.get_slot("home_longitude"),
-            "home_latitude": tracker.get_slot("home_latitude"),
-            "birthday": tracker.get_slot("birthday"),
-            "sex": tracker.get_slot("sex"),
-            "medical_preconditions": tracker.get_slot("medical_preconditions"),
-        }
-        return patient_details
-    query = f"""SELECT id, health, geo, user_id, nickname, title, home_longitude, home_latitude, birthday, sex, 
-                medical_preconditions FROM patient WHERE user_id = {user_id};"""
-    result = DBHandler().execute_query(query)
-    if result:
-        result = result[0]
-        patient_details = {
-            "health": result[1],
-            "geo": result[2],
-            "user_id": result[3],
-            "nickname": result[4],
-            "title": result[5],
-            "home_longitude": result[6],
-            "home_latitude": result[7],
-            "birthday": result[8],
-            "sex": result[9],
-            "medical_preconditions": result[10] or "",
-        }
-        return patient_details
-    else:
-        return None
+def get_patient_details(user_id: str, *, force_reload=False, tracker=None) -> dict:
+    if force_reload:
+        patient_cache.invalidate(user_id)
+    elif tracker and tracker.get_slot("birthday"):
+        return patient_details_from_tracker(tracker)
+    profile = patient_cache.get(user_id)
+    return profile.to_dict() if profile else None
+
+
+async def get_patient_details_async(
+    user_id: str, *, force_reload=False, tracker=None
+) -> dict:
+    if force_reload:
+        patient_cache.invalidate(user_id)
+    elif tracker and tracker.get_slot("birthday"):
+        return patient_details_from_tracker(tracker)
+    profile = await patient_cache.get_async(user_id)
+    return profile.to_dict() if profile else None
+
+
+def patient_details_from_tracker(tracker) -> dict:
+    return {
+        "health": tracker.get_slot("health"),
+        "geo": tracker.get_slot("geo"),
+        "user_id": tracker.get_slot("user_id"),
+        "nickname": tracker.get_slot("nickname"),
+        "title": tracker.get_slot("title"),
+        "home_longitude": tracker.get_slot("home_longitude"),
+        "home_latitude": tracker.get_slot("home_latitude"),
+        "birthday": tracker.get_slot("birthday"),
+        "sex": tracker.get_slot("sex"),
+        "medical_preconditions": tracker.get_slot("medical_preconditions"),
+    }
 
 
 def calculate_percentages(readings, bp_range):
     if len(readings) == 0 or bp_range == (0, 0):
         return 0, 0, 0
-    below_range = len([x for x in readings if x < bp_range[0]])
-    in_range = len([x for x in readings if bp_range[0] <= x <= bp_range[1]])
-    above_range = len([x for x in readings if x > bp_range[1]])
+    below_range, _, above_range, _ = class_counts(readings, bp_range).tolist()
     total = len(readings)
+    in_range = total - below_range - above_range
     return below_range / total * 100, in_range / total * 100, above_range / total * 100
 
 
@@ -98,56 +113,26 @@ def get_bp_range(birthdate, has_pre_existing_conditions):
     Returns:
     tuple: A tuple containing the systolic and diastolic ranges.
     """
-    # Define the blood pressure ranges based on age and pre-existing conditions
-    systolicTarget = {
-        1: [119, 131],  # <65 with pre-existing conditions
-        2: [128, 141],  # >65 with pre-existing conditions
-        3: [120, 135],  # others
-    }
+    corridor = target_corridor(
+        birthdate, bool(has_pre_existing_conditions), date.today()
+    )
+    return corridor.systolic, corridor.diastolic
 
-    diastolicTarget = {
-        1: [70, 79],  # <65 with pre-existing conditions
-        2: [70, 79],  # >65 with pre-existing conditions
-        3: [71, 84],  # others
-    }
-    category = 3
-    if birthdate not in ["", None, ""]:
-        # Calculate age from birthdate
-        birthdate = datetime.strptime(birthdate, "%Y-%m-%d")
-        today = datetime.today()
-        age = (
-            today.year
-            - birthdate.year
-            - ((today.month, today.day) < (birthdate.month, birthdate.day))
-        )
-
-        if has_pre_existing_conditions:
-            if age < 65:
-                category = 1
-            else:
-                category = 2
-        else:
-            category = 3
-
-    systolic_range = systolicTarget[category]
-    diastolic_range = diastolicTarget[category]
-    return systolic_range, diastolic_range
-
-
-def get_within(span, value) -> str:
-    if span[0] <= value <= span[1]:
-        return "within"
-    elif value < span[0]:
-        return "below"
-    elif value > span[1]:
-        return "above"
-    else:
-        return "unknown"
+
+def get_within(span, value):
+    """
+    "below", "within", "above" or "unknown" for a value, an array of them for an
+    array of values.
+    """
+    labels = LABELS[classify(value, span)]
+    return labels.item() if labels.ndim == 0 else labels
 
 
 def is_in_range(systolic, diastolic, bp_range):
-    sys_in_range = bp_range[0][0] <= systolic <= bp_range[0][1]
-    dia_in_range = bp_range[1][0] <= diastolic <= bp_range[1][1]
+    sys_in_range = within(systolic, bp_range[0])
+    dia_in_range = within(diastolic, bp_range[1])
+    if sys_in_range.ndim == 0:
+        return sys_in_range.item(), dia_in_range.item()
     return sys_in_range, dia_in_range
 
 
@@ -163,45 +148,84 @@ def get_trend(prev, curr) -> str:
 def is_critical(
     systolic, diastolic, pulse, systolic_span, diastolic_span, pulse_span=(60, 160)
 ):
-    if systolic > systolic_span[1] or systolic < systolic_span[0]:
-        return True
-    if diastolic > diastolic_span[1] or diastolic < diastolic_span[0]:
-        return True
-    if pulse > pulse_span[1] or pulse < pulse_span[0]:
-        return True
-    return False
+    """
+    Whether any measure lies outside of its span, elementwise for arrays.
+    """
+    critical = (
+        outside(systolic, systolic_span)
+        | outside(diastolic, diastolic_span)
+        | outside(pulse, pulse_span)
+    )
+    return critical.item() if critical.ndim == 0 else critical
 
 
 def get_bloodpressure(user_id, limit=100, interval="3 MONTHS") -> List:
-    query = f"""
-    SELECT recorded_at, systolic, diastolic, pulse
-    FROM bloodpressure
-    WHERE user_id = {user_id}
-    """
-    print("shit")
+    return DBHandler().execute_named(
+        *_bloodpressure_statement(user_id, limit, interval)
+    )
+
+
+async def get_bloodpressure_async(user_id, limit=100, interval="3 MONTHS") -> List:
+    return await DBHandler().execute_named_async(
+        *_bloodpressure_statement(user_id, limit, interval)
+    )
+
+
+def _bloodpressure_statement(user_id, limit, interval) -> Tuple[str, tuple]:
+    # LIMIT NULL is the same as no limit
+    limit = limit if limit != 0 else None
     if interval:
-        query += f"AND CAST(recorded_at AS timestamp) >= NOW() - INTERVAL '{interval}' "
-    query += "ORDER BY recorded_at DESC "
-    if limit != 0:
-        query += f"LIMIT {limit}"
-    query += ";"
-    results = DBHandler().execute_query(query)
-    return results
-
-
-def check_most_recent_geofence(timestamp: str, user_id: str):
-    query = f"""
-    SELECT geo_fence_status
-    FROM geo_location
-    WHERE user_id = {user_id} 
-    AND CAST(recorded_at AS timestamp) <= CAST('{timestamp}' AS timestamp) AND geo_fence_status
-    not in ('GEOFENCE_DISABLED', 'UNKNOWN', 'ACCURACY_NEEDS_REFINEMENT', 'ESTIMATED_MEASURE_TO_BE_IGNORED')
-    ORDER BY recorded_at DESC
-    LIMIT 1;
+        return "bloodpressure_recent", (user_id, interval, limit)
+    return "bloodpressure_all", (user_id, limit)
+
+
+def get_bloodpressure_series(user_id) -> BloodPressureSeries:
+    """
+    All readings of the patient, served from the process wide cache.
+    """
+    return blood_pressure_cache.get(user_id)
+
+
+def get_bloodpressure_since(user_id, since) -> BloodPressureSeries:
+    """
+    Readings recorded at or after since.
+    """
+    return get_bloodpressure_series(user_id).since(since)
+
+
+def get_bloodpressure_within(user_id, interval: str) -> BloodPressureSeries:
+    """
+    Readings of the last interval (e.g. '3 month').
+    """
+    return get_bloodpressure_series(user_id).since(interval_start(interval))
+
+
+def get_bloodpressure_before(user_id, before, inclusive=False) -> BloodPressureSeries:
+    """
+    Readings recorded before the given timestamp.
+    """
+    return get_bloodpressure_series(user_id).before(before, inclusive)
+
+
+def interval_start(interval: str) -> "pd.Timestamp":
     """
-    result = DBHandler(silent=False).execute_query(query)
-    print(result)
-    return result[0][0] if result else "unknown"
+    NOW() - INTERVAL for intervals like '3 month' or '1 WEEKS'.
+    """
+    amount, unit = interval.split()
+    unit = unit.lower().rstrip("s") + "s"
+    return pd.Timestamp.now() - pd.DateOffset(**{unit: int(amount)})
+
+
+def get_geofence_stati(user_id, timestamps: np.ndarray) -> np.ndarray:
+    """
+    Most recent valid geofence status of the user at each of the timestamps, or
+    "unknown" if there is none yet.
+    """
+    if not len(timestamps):
+        return np.array([], dtype=object)
+    timestamps = np.asarray(timestamps, dtype="datetime64[us]").tolist()
+    result = DBHandler().execute_named("geofence_as_of", (timestamps, user_id))
+    return np.array([status or "unknown" for status, in result], dtype=object)
 
 
 def get_days_ago(date):
@@ -215,36 +239,12 @@ def get_days_ago(date):
 def get_blood_pressure_spans(
     tracker, user_id
 ) -> Tuple[Tuple[int, int], Tuple[int, int], str]:
-    birthday = (
-        datetime.strptime(tracker.get_slot("birthday"), "%Y-%m-%d")
-        if tracker.get_slot("birthday") is not None
-        else None
-    )
+    birthday = tracker.get_slot("birthday")
     if not birthday:
-        query = f"""SELECT birthday FROM patient WHERE user_id = {user_id};"""
-        result = DBHandler().execute_query(query)[0]
-        print(result)
-        birthday = datetime.strptime(result[0], "%Y-%m-%d") if result else None
-    if birthday:
-        age = (datetime.now() - birthday).days // 365
-        if age < 18:
-            systolic_span = (90, 120)
-            diastolic_span = (60, 80)
-        elif age < 40:
-            systolic_span = (110, 130)
-            diastolic_span = (70, 85)
-        elif age < 60:
-            systolic_span = (120, 140)
-            diastolic_span = (75, 90)
-        else:
-            systolic_span = (130, 150)
-            diastolic_span = (80, 95)
-
-    else:
-        systolic_span = (120, 130)
-        diastolic_span = (80, 85)
-        age = "unknown"
-    return systolic_span, diastolic_span, str(age)
+        profile = patient_cache.get(user_id)
+        birthday = profile.birthday if profile else None
+    corridor, age = age_corridor(birthday, date.today())
+    return corridor.systolic, corridor.diastolic, age
 
 
 def geofence_data_available(user_id) -> bool:
@@ -253,46 +253,23 @@ def geofence_data_available(user_id) -> bool:
     :param user_id:
     :return: boolean
     """
-    query = f"""SELECT *
-FROM geo_location
-WHERE user_id = {user_id}
-  AND geo_fence_status
-    not in ('GEOFENCE_DISABLED', 'UNKNOWN', 'ACCURACY_NEEDS_REFINEMENT', 'ESTIMATED_MEASURE_TO_BE_IGNORED')
-ORDER BY recorded_at DESC
-LIMIT 1;"""
-    return bool(DBHandler().execute_query(query))
+    return bool(DBHandler().execute_named("geofence_available", (user_id,)))
 
 
 def fetch_latest_bp_measurement(user_id):
     # Placeholder function to fetch the latest measurement
     # Replace this with your actual function to fetch the data
-    result = DBHandler().execute_query(
-        f"SELECT id, systolic, diastolic, pulse, recorded_at"
-        f" FROM bloodpressure WHERE user_id = {user_id} ORDER BY recorded_at DESC LIMIT 1"
-    )
-    print("result", result)
+    result = DBHandler().execute_named("latest_bp_measurement", (user_id,))
     return result[0] if result else None
 
 
 def get_time_of_day(recorded_at):
-    if 6 <= recorded_at.hour < 12:
-        return "Morgen"
-    elif 12 <= recorded_at.hour < 16:
-        return "Nachmittag"
-    elif 16 <= recorded_at.hour < 22:
-        return "Abend"
-    elif 22 <= recorded_at.hour < 24 or 0 <= recorded_at.hour < 6:
-        return "Nacht"
-
-
-def recorded_at_to_datetime(results):
-    results = [
-        (
-            systolic,
-            diastolic,
-            pulse,
-            datetime.strptime(recorded_at, "%Y-%m-%d %H:%M:%S.%f"),
-        )
-        for systolic, diastolic, pulse, recorded_at in results
-    ]
-    return results
+    return TIMES_OF_DAY.labels_of(recorded_at.hour)
+
+
+def get_times_of_day(times: np.ndarray) -> np.ndarray:
+    """
+    Vectorized get_time_of_day for datetime64 values or hours, e.g.
+    BloodPressureSeries.hours.
+    """
+    return TIMES_OF_DAY.labels_of(times)
@@ -0,0 +1,125 @@
+"""
+Compares the changepoint backends of actions.utils.changepoints with ruptures.Dynp
+on synthetic blood pressure series with three level shifts, for accuracy and
+runtime, and a joint search over systolic and diastolic values with two
+separate ones:
+
+    python -m benchmarks.bench_changepoints --sizes 200 2000 20000
+
+ruptures.Dynp needs hours for 20k points, beyond --dynp-limit the exact dynp
+backend is the reference instead.
+"""
+
+import argparse
+import time
+
+import numpy as np
+import ruptures as rpt
+
+from actions.utils.changepoints import BACKENDS, L2Cost, detect_changepoints
+
+N_BKPS = 3
+MIN_SIZE = 10
+JUMP = 2
+
+
+def synthetic_series(n_samples, rng):
+    """
+    Twice daily systolic readings around four levels with a daily rhythm.
+    """
+    bkps = np.sort(rng.choice(np.arange(1, 8), N_BKPS, replace=False)) * n_samples // 8
+    levels = rng.integers(115, 155, N_BKPS + 1)
+    signal = np.repeat(levels, np.diff(np.concatenate(([0], bkps, [n_samples]))))
+    signal = signal + np.tile([4, -4], n_samples // 2 + 1)[:n_samples]
+    return (signal + rng.normal(0, 9, n_samples)).round().astype(np.int16)
+
+
+def timed(function, repeat):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = function()
+        timings.append(time.perf_counter() - start)
+    return result, min(timings)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--sizes", type=int, nargs="+", default=[200, 2000, 20000])
+    parser.add_argument("--series", type=int, default=5, help="series per size")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument(
+        "--dynp-limit",
+        type=int,
+        default=2000,
+        help="largest series ruptures.Dynp is run on",
+    )
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    rng = np.random.default_rng(args.seed)
+    backends = [backend for backend in BACKENDS if backend != "ruptures"]
+
+    print(
+        f"{'points':>7} {'backend':<9} {'runtime':>11} {'exact':>7} "
+        f"{'cost ratio':>11} {'max shift':>10}"
+    )
+    for n_samples in args.sizes:
+        series = [synthetic_series(n_samples, rng) for _ in range(args.series)]
+        reference = "ruptures" if n_samples <= args.dynp_limit else "dynp"
+        results = {}
+        for backend in [reference] + [b for b in backends if b != reference]:
+            runtime = 0.0
+            results[backend] = []
+            for signal in series:
+                bkps, seconds = timed(
+                    lambda: detect_changepoints(
+                        signal,
+                        n_bkps=N_BKPS,
+                        backend=backend,
+                        min_size=MIN_SIZE,
+                        jump=JUMP,
+                    ),
+                    1 if backend == "ruptures" else args.repeat,
+                )
+                results[backend].append(bkps)
+                runtime += seconds
+            exact = cost_ratio = shift = 0
+            for signal, expected, bkps in zip(
+                series, results[reference], results[backend]
+            ):
+                cost = L2Cost(signal)
+                exact += bkps == expected
+                cost_ratio = max(
+                    cost_ratio, cost.sum_of_costs(bkps) / cost.sum_of_costs(expected)
+                )
+                if len(bkps) == len(expected):
+                    shift = max(shift, int(np.abs(np.subtract(bkps, expected)).max()))
+            label = f"{backend}*" if backend == reference else backend
+            print(
+                f"{n_samples:>7} {label:<9} {runtime / len(series) * 1000:>8.1f} ms "
+                f"{exact:>3}/{len(series):<3} {cost_ratio:>11.4f} {shift:>10}"
+            )
+    print("* reference; cost ratio and shift are the worst over all series")
+
+    # systolic and diastolic values: two searches against one joint search
+    print(f"\n{'points':>7} {'separate':>11} {'joint':>11}")
+    for n_samples in args.sizes:
+        signal = np.column_stack(
+            [synthetic_series(n_samples, rng), synthetic_series(n_samples, rng) - 45]
+        )
+        _, separate = timed(
+            lambda: [
+                detect_changepoints(signal[:, i], n_bkps=N_BKPS, backend="dynp")
+                for i in range(2)
+            ],
+            args.repeat,
+        )
+        _, joint = timed(
+            lambda: detect_changepoints(signal, n_bkps=N_BKPS, backend="dynp"),
+            args.repeat,
+        )
+        print(f"{n_samples:>7} {separate * 1000:>8.1f} ms {joint * 1000:>8.1f} ms")
+
+
+if __name__ == "__main__":
+    main()
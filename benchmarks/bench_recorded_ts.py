@@ -0,0 +1,118 @@
+"""
+Compares the typical per patient window query before and after the recorded_ts
+migration on a synthetic bloodpressure table.
+
+The table is created in a scratch schema of the configured insights database
+(see actions.utils.db_utils.DB_CONFIG) and dropped afterwards:
+
+    python -m benchmarks.bench_recorded_ts --rows 10000000 --users 1000
+"""
+
+import argparse
+import statistics
+import time
+
+from actions.utils.db_utils import DBHandler
+from actions.utils.migrations import apply_migrations
+
+SCHEMA = "bench_recorded_ts"
+
+BEFORE = """SELECT systolic, diastolic, pulse, recorded_at
+FROM bloodpressure
+WHERE user_id = %s AND CAST(recorded_at AS timestamp) >= NOW() - INTERVAL '3 MONTHS'
+ORDER BY CAST(recorded_at AS timestamp) ASC"""
+
+AFTER = """SELECT systolic, diastolic, pulse, recorded_at
+FROM bloodpressure
+WHERE user_id = %s AND recorded_ts >= NOW() - INTERVAL '3 MONTHS'
+ORDER BY recorded_ts ASC"""
+
+
+def create_table(cur, rows, users):
+    cur.execute(f"DROP SCHEMA IF EXISTS {SCHEMA} CASCADE")
+    cur.execute(f"CREATE SCHEMA {SCHEMA}")
+    cur.execute(f"SET search_path TO {SCHEMA}")
+    cur.execute("""CREATE TABLE bloodpressure (
+            id bigserial PRIMARY KEY,
+            user_id bigint,
+            systolic integer,
+            diastolic integer,
+            pulse integer,
+            recorded_at character varying(255)
+        )""")
+    cur.execute("""CREATE TABLE geo_location (
+            id bigserial PRIMARY KEY,
+            user_id bigint,
+            geo_fence_status character varying(255),
+            recorded_at character varying(255)
+        )""")
+    # the old schema only has the implicit primary key index and one on user_id
+    cur.execute("CREATE INDEX ON bloodpressure (user_id)")
+    # two readings a day per patient, going back as far as the row count requires
+    cur.execute(
+        """INSERT INTO bloodpressure (user_id, systolic, diastolic, pulse, recorded_at)
+        SELECT i %% %s,
+               110 + (random() * 50)::int,
+               65 + (random() * 30)::int,
+               55 + (random() * 40)::int,
+               to_char(NOW() - (i / %s) * INTERVAL '12 hours' - random() * INTERVAL '1 hour',
+                       'YYYY-MM-DD HH24:MI:SS.US')
+        FROM generate_series(0, %s - 1) AS i""",
+        (users, users, rows),
+    )
+    cur.execute("ANALYZE bloodpressure")
+
+
+def time_query(cur, query, users, repeat):
+    timings = []
+    for run in range(repeat):
+        start = time.perf_counter()
+        cur.execute(query, (run * 7919 % users,))
+        cur.fetchall()
+        timings.append(time.perf_counter() - start)
+    return timings
+
+
+def report(label, timings):
+    print(
+        f"{label:<7} median {statistics.median(timings) * 1000:9.2f} ms"
+        f"   min {min(timings) * 1000:9.2f} ms   max {max(timings) * 1000:9.2f} ms"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--rows", type=int, default=10_000_000)
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument("--repeat", type=int, default=20)
+    parser.add_argument(
+        "--keep", action="store_true", help="keep the scratch schema afterwards"
+    )
+    args = parser.parse_args()
+
+    with DBHandler(silent=True).connection() as conn:
+        try:
+            with conn.cursor() as cur:
+                print(f"Creating {args.rows} rows for {args.users} users ...")
+                create_table(cur, args.rows, args.users)
+                conn.commit()
+
+                report("before", time_query(cur, BEFORE, args.users, args.repeat))
+
+                migration_start = time.perf_counter()
+                apply_migrations(cur, output_function=lambda _: None)
+                conn.commit()
+                print(f"Migration took {time.perf_counter() - migration_start:.1f} s")
+
+                report("after", time_query(cur, AFTER, args.users, args.repeat))
+        finally:
+            conn.rollback()
+            with conn.cursor() as cur:
+                if not args.keep:
+                    cur.execute(f"DROP SCHEMA IF EXISTS {SCHEMA} CASCADE")
+                cur.execute("RESET search_path")
+            conn.commit()
+
+
+if __name__ == "__main__":
+    main()
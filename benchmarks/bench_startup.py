@@ -0,0 +1,133 @@
+"""
+Measures the cold start of the action server: the import of all actions, as
+rasa_sdk does on startup, and the first answer of an action, each in a fresh
+interpreter. Also lists the heavy libraries that were loaded by then:
+
+    python -m benchmarks.bench_startup --user-id 25601 --repeat 5
+
+The default action_get_user_nickname needs the patient profile from the
+configured insights database, see actions.utils.db_utils.DB_CONFIG.
+"""
+
+import argparse
+import asyncio
+import inspect
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+HEAVY = (
+    "pandas",
+    "matplotlib",
+    "seaborn",
+    "dateparser",
+    "ruptures",
+    "openai",
+    "defog",
+)
+
+
+def find_action(name):
+    from rasa_sdk.interfaces import Action
+
+    pending = list(Action.__subclasses__())
+    while pending:
+        action = pending.pop()
+        pending.extend(action.__subclasses__())
+        try:
+            if action().name() == name:
+                return action()
+        except Exception:
+            continue
+    raise ValueError(f"Unknown action {name}.")
+
+
+def child(args):
+    """
+    One cold start, reported as JSON on stdout.
+    """
+    start = time.perf_counter()
+    from rasa_sdk.executor import ActionExecutor, CollectingDispatcher
+    from rasa_sdk.interfaces import Tracker
+
+    ActionExecutor().register_package("actions")
+    imported = time.perf_counter()
+
+    dispatcher = CollectingDispatcher()
+    tracker = Tracker(
+        sender_id="bench",
+        slots={"user_id": args.user_id},
+        latest_message={},
+        events=[],
+        paused=False,
+        followup_action=None,
+        active_loop={},
+        latest_action_name=None,
+    )
+    result = find_action(args.action).run(dispatcher, tracker, {})
+    if inspect.isawaitable(result):
+        asyncio.run(result)
+    answered = time.perf_counter()
+    print(
+        json.dumps(
+            {
+                "import": imported - start,
+                "first_response": answered - imported,
+                "total": answered - start,
+                "loaded": [name for name in HEAVY if name in sys.modules],
+                "messages": len(dispatcher.messages),
+            }
+        )
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--action", default="action_get_user_nickname")
+    parser.add_argument("--user-id", default="25601")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument(
+        "--warm-up",
+        action="store_true",
+        help="start the background warm-up right away (INSIGHTS_WARM_UP=1)",
+    )
+    parser.add_argument("--child", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.child:
+        child(args)
+        return
+
+    env = dict(os.environ)
+    if args.warm_up:
+        env.update(INSIGHTS_WARM_UP="1", INSIGHTS_WARM_UP_DELAY="0")
+    runs = []
+    for _ in range(args.repeat):
+        output = subprocess.run(
+            [
+                sys.executable,
+                "-m",
+                "benchmarks.bench_startup",
+                "--child",
+                "--action",
+                args.action,
+                "--user-id",
+                args.user_id,
+            ],
+            env=env,
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout
+        runs.append(json.loads(output.strip().splitlines()[-1]))
+
+    print(f"{args.action}, median of {args.repeat} cold starts:")
+    for key in ("import", "first_response", "total"):
+        print(f"  {key:<15} {statistics.median(run[key] for run in runs):8.3f}s")
+    print(f"  loaded          {', '.join(runs[-1]['loaded']) or '-'}")
+
+
+if __name__ == "__main__":
+    main()
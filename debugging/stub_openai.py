@@ -0,0 +1,269 @@
+"""
+A local stand-in for the parts of the OpenAI Assistants API the actions use:
+assistants, threads, messages and runs, blocking as well as streamed. Every run
+completes right away with the answer "Stub answer: <question>", and GET /stats
+lists how often each endpoint was called, e.g. to check that assistants and
+threads are reused:
+
+    python -m debugging.stub_openai --port 5057
+    OPENAI_BASE_URL=http://127.0.0.1:5057/v1 OPENAI_API_KEY=stub rasa run actions
+"""
+
+import argparse
+import itertools
+import json
+import re
+import threading
+import time
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List, Optional, Tuple
+from urllib.parse import parse_qs, urlparse
+
+_ids = itertools.count(1)
+
+
+def _id(prefix: str) -> str:
+    return f"{prefix}_stub{next(_ids)}"
+
+
+def _page(data: List[Dict]) -> Dict:
+    return {
+        "object": "list",
+        "data": data,
+        "first_id": data[0]["id"] if data else None,
+        "last_id": data[-1]["id"] if data else None,
+        "has_more": False,
+    }
+
+
+class StubState:
+    """
+    The objects created so far and the number of calls per endpoint.
+    """
+
+    def __init__(self):
+        self.assistants: Dict[str, Dict] = {}
+        self.threads: Dict[str, Dict] = {}
+        self.messages: Dict[str, List[Dict]] = {}
+        self.runs: Dict[str, Dict] = {}
+        self.calls = Counter()
+        self.lock = threading.Lock()
+
+    def create_assistant(self, body: Dict) -> Dict:
+        assistant = {
+            "id": _id("asst"),
+            "object": "assistant",
+            "created_at": int(time.time()),
+            "name": body.get("name"),
+            "description": None,
+            "model": body.get("model"),
+            "instructions": body.get("instructions"),
+            "tools": body.get("tools", []),
+            "metadata": body.get("metadata", {}),
+        }
+        self.assistants[assistant["id"]] = assistant
+        return assistant
+
+    def create_thread(self, body: Dict) -> Dict:
+        thread = {
+            "id": _id("thread"),
+            "object": "thread",
+            "created_at": int(time.time()),
+            "metadata": body.get("metadata", {}),
+        }
+        self.threads[thread["id"]] = thread
+        self.messages[thread["id"]] = []
+        return thread
+
+    def create_message(
+        self,
+        thread_id: str,
+        role: str,
+        text: str,
+        run_id: Optional[str] = None,
+        assistant_id: Optional[str] = None,
+    ) -> Dict:
+        message = {
+            "id": _id("msg"),
+            "object": "thread.message",
+            "created_at": int(time.time()),
+            "thread_id": thread_id,
+            "role": role,
+            "status": "completed",
+            "content": [{"type": "text", "text": {"value": text, "annotations": []}}],
+            "assistant_id": assistant_id,
+            "run_id": run_id,
+            "attachments": [],
+            "metadata": {},
+        }
+        self.messages[thread_id].append(message)
+        return message
+
+    def create_run(self, thread_id: str, body: Dict) -> Tuple[Dict, Dict]:
+        now = int(time.time())
+        run = {
+            "id": _id("run"),
+            "object": "thread.run",
+            "created_at": now,
+            "thread_id": thread_id,
+            "assistant_id": body["assistant_id"],
+            "status": "completed",
+            "required_action": None,
+            "last_error": None,
+            "started_at": now,
+            "completed_at": now,
+            "model": self.assistants[body["assistant_id"]]["model"],
+            "instructions": "\n".join(
+                filter(
+                    None,
+                    [
+                        self.assistants[body["assistant_id"]]["instructions"],
+                        body.get("additional_instructions"),
+                    ],
+                )
+            ),
+            "tools": [],
+            "metadata": {},
+        }
+        self.runs[run["id"]] = run
+        questions = [m for m in self.messages[thread_id] if m["role"] == "user"]
+        question = questions[-1]["content"][0]["text"]["value"] if questions else ""
+        answer = self.create_message(
+            thread_id,
+            "assistant",
+            f"Stub answer: {question}",
+            run["id"],
+            run["assistant_id"],
+        )
+        return run, answer
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    state: StubState = None
+
+    def _send(self, status: int, payload: Dict):
+        body = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _stream(self, run: Dict, answer: Dict):
+        # the server sent events of a run, the answer in one delta
+        events = [
+            ("thread.run.created", dict(run, status="queued")),
+            ("thread.run.in_progress", dict(run, status="in_progress")),
+            ("thread.message.created", dict(answer, status="in_progress", content=[])),
+            (
+                "thread.message.delta",
+                {
+                    "id": answer["id"],
+                    "object": "thread.message.delta",
+                    "delta": {"content": [dict(answer["content"][0], index=0)]},
+                },
+            ),
+            ("thread.message.completed", answer),
+            ("thread.run.completed", run),
+        ]
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.end_headers()
+        for event, data in events:
+            self.wfile.write(f"event: {event}\ndata: {json.dumps(data)}\n\n".encode())
+        self.wfile.write(b"event: done\ndata: [DONE]\n\n")
+
+    def _body(self) -> Dict:
+        length = int(self.headers.get("Content-Length") or 0)
+        return json.loads(self.rfile.read(length) or b"{}")
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        state = self.state
+        with state.lock:
+            if url.path == "/stats":
+                return self._send(200, dict(state.calls))
+            state.calls[f"GET {_route(url.path)}"] += 1
+            match = re.fullmatch(r"/v1/threads/([^/]+)/messages", url.path)
+            if match and match.group(1) in state.messages:
+                query = parse_qs(url.query)
+                messages = state.messages[match.group(1)]
+                if "run_id" in query:
+                    messages = [
+                        m for m in messages if m["run_id"] == query["run_id"][0]
+                    ]
+                if query.get("order", ["desc"])[0] == "desc":
+                    messages = messages[::-1]
+                return self._send(200, _page(messages))
+            match = re.fullmatch(r"/v1/threads/[^/]+/runs/([^/]+)", url.path)
+            if match and match.group(1) in state.runs:
+                return self._send(200, state.runs[match.group(1)])
+            match = re.fullmatch(r"/v1/assistants/([^/]+)", url.path)
+            if match and match.group(1) in state.assistants:
+                return self._send(200, state.assistants[match.group(1)])
+        self._send(404, {"error": {"message": f"Unknown path {url.path}."}})
+
+    def do_POST(self):
+        path = urlparse(self.path).path
+        body = self._body()
+        state = self.state
+        with state.lock:
+            state.calls[f"POST {_route(path)}"] += 1
+            if path == "/v1/assistants":
+                return self._send(200, state.create_assistant(body))
+            if path == "/v1/threads":
+                return self._send(200, state.create_thread(body))
+            match = re.fullmatch(r"/v1/threads/([^/]+)/messages", path)
+            if match and match.group(1) in state.threads:
+                message = state.create_message(
+                    match.group(1), body.get("role", "user"), str(body.get("content"))
+                )
+                return self._send(200, message)
+            match = re.fullmatch(r"/v1/threads/([^/]+)/runs", path)
+            if match and match.group(1) in state.threads:
+                run, answer = state.create_run(match.group(1), body)
+                if body.get("stream"):
+                    return self._stream(run, answer)
+                return self._send(200, run)
+        self._send(404, {"error": {"message": f"Unknown path {path}."}})
+
+    def log_message(self, format, *args):
+        pass
+
+
+def _route(path: str) -> str:
+    """
+    The path with the object ids replaced, to count the calls per endpoint.
+    """
+    return re.sub(r"/(asst|thread|msg|run)_[^/]+", r"/{\1}", path)
+
+
+def serve(host: str = "127.0.0.1", port: int = 5057) -> ThreadingHTTPServer:
+    """
+    Starts the stub in a daemon thread, the server has the StubState as state.
+    """
+    handler = type("Handler", (StubHandler,), {"state": StubState()})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.state = handler.state
+    threading.Thread(
+        target=server.serve_forever, name="stub-openai", daemon=True
+    ).start()
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=5057)
+    args = parser.parse_args()
+    server = serve(args.host, args.port)
+    print(f"Stub OpenAI API on http://{args.host}:{args.port}/v1, stats on /stats.")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
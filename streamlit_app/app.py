@@ -1,3 +1,5 @@
+import base64
+
 import streamlit as st
 import requests
 from urllib.parse import urlparse, parse_qs
@@ -20,6 +22,17 @@ def get_bot_response(message):
     response = requests.post(url, json=payload, headers=headers)
     return response.json()
 
+def load_image(image):
+    # charts come as URLs of the image server of the action server, as data
+    # URIs or, with file delivery, as local paths
+    if image.startswith("data:"):
+        return base64.b64decode(image.split(",", 1)[1])
+    if image.startswith(("http://", "https://")):
+        response = requests.get(image, timeout=10)
+        response.raise_for_status()
+        return response.content
+    return image
+
 def main():
     user_id = get_user_id()
     if not user_id:
@@ -96,7 +109,10 @@ def main():
             )
         else:
             if "image" in msg:
-                st.image(msg["image"])
+                try:
+                    st.image(load_image(msg["image"]))
+                except requests.RequestException:
+                    st.warning("Die Grafik ist nicht mehr verfügbar.")
             else:
                 if msg['message'] == "":
                     continue